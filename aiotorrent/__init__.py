@@ -1,6 +1,7 @@
 from aiotorrent.aiotorrent import Torrent
 from aiotorrent.core.util import DownloadStrategy
+from aiotorrent.core.rate_limiter import set_global_rate_limit
 
 
 # Define what is accessible when "from aiotorrent import *" is used
-__all__ = ["Torrent", "DownloadStrategy"]
+__all__ = ["Torrent", "DownloadStrategy", "set_global_rate_limit"]
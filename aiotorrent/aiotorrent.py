@@ -6,12 +6,18 @@ import logging
 import platform
 
 import json
-from aiotorrent.peer import Peer
+from aiotorrent.connection_manager import ConnectionManager
+from aiotorrent.core.rate_limiter import RateLimits, GLOBAL_RATE_LIMITS
 from aiotorrent.core.bencode_utils import bencode_util
-from aiotorrent.core.util import chunk, PieceWriter
+from aiotorrent.core.util import chunk
 from aiotorrent.core.file_utils import FileTree
 from aiotorrent.tracker_factory import TrackerFactory
 from aiotorrent.downloader import FilesDownloadManager
+from aiotorrent.core.piece_verifier import PieceVerifier
+from aiotorrent.core.resume import ResumeData
+from aiotorrent.core.storage import Storage
+from aiotorrent.core.disk_writer import DiskWriter
+from aiotorrent.core.recheck import PieceChecker
 from aiotorrent.core.util import DownloadStrategy
 from aiotorrent.DHTv4 import SimpleDHTCrawler
 
@@ -41,6 +47,14 @@ class Torrent:
 
 		self.trackers = list()
 		self.peers = list()
+		self.connection_manager = None
+		# Bandwidth limits of this torrent, below the global ones
+		self.rate_limits = RateLimits(parent=GLOBAL_RATE_LIMITS)
+		# Hashes the downloaded pieces off the event loop, created in init()
+		self.verifier = None
+		self.disk_writer = None
+		# Task saving the resume data while downloading
+		self._saving = None
 		self.name = data['info']['name']
 		self.files = None # This will be replaced with a file_tree object
 
@@ -75,6 +89,7 @@ class Torrent:
 
 		self.torrent_info = {
 			'name': data['info']['name'],
+			'private': bool(data['info'].get('private')),
 			'size': size,
 			'files': files,
 			'piece_len': piece_len,
@@ -97,6 +112,12 @@ class Torrent:
 
 		self.files = FileTree(self.torrent_info)
 
+		# Pieces downloaded before a restart are not downloaded again
+		self.resume = ResumeData(self.torrent_info, self.files)
+		self.resume.load()
+		# Pieces are written to every file they belong to
+		self.storage = Storage(self.torrent_info, self.files)
+
 		# for file in self.files:
 		# 	logger.debug(f"File: {file}")
 
@@ -140,12 +161,42 @@ class Torrent:
 		return peers
 
 
+	def set_rate_limit(self, download = None, upload = None, peer_download = None, peer_upload = None):
+		"""
+		Limits the bandwidth of this torrent, and of each of its peers, in bytes
+		per second. None removes a limit. Can be changed at any time.
+		"""
+		self.rate_limits.set(download, upload, peer_download, peer_upload)
+
+
+	async def recheck(self, workers = None, progress = None):
+		"""
+		Checks the data on disk against the piece hashes, in `workers` processes,
+		and saves the verified pieces as the resume data. For use when the resume
+		data is missing or stale. `progress` is called with the number of pieces
+		checked and the total as the check goes on. Returns the number of
+		verified pieces.
+		"""
+		checker = PieceChecker(self.torrent_info, self.files, workers)
+		async for checked in checker.run():
+			if progress: progress(checked, checker.total)
+
+		self.resume.set_verified(checker.verified)
+		self.resume.save()
+		return checker.verified.count(1)
+
+
 	def show_files(self):
 		for file in self.files:
 			logger.info(f"File: {file}")
 
 
-	async def init(self, dht_enabled = False):
+	async def init(self, dht_enabled = False, max_connections = ConnectionManager.MAX_CONNECTIONS, peer_timeout = 30, utp = False, hash_workers = PieceVerifier.WORKERS, hash_queue = None, disk_workers = DiskWriter.WORKERS, disk_cache = DiskWriter.CACHE_SIZE):
+		# Pieces are verified by hash_workers threads, with at most hash_queue pieces waiting
+		self.verifier = PieceVerifier(hash_workers, hash_queue)
+		# and written by disk_workers threads, with at most disk_cache bytes waiting
+		self.disk_writer = DiskWriter(self.storage, disk_workers, disk_cache, on_written=self._on_written)
+
 		# Contact Trackers and get peers
 		await self._contact_trackers()
 		peer_addrs = self._get_peers() #TODO: Rename get_peers to add_peers
@@ -153,30 +204,19 @@ class Torrent:
 		dht_peers = set()
 		if dht_enabled:
 			dht_peers = await self._get_peers_dht(timeout=30)
-			peer_addrs |= dht_peers
 
-		# If there are more than 512 peers, randomly shortlist them
-		#TODO: Use a better strategy to shortlist peers. 
-		# When I tried opening connections to ~1300 peers parallely
-		# Error: ValueError: too many file descriptors in select() 
-		# ConnectionResetError: [WinError 10054] An existing connection was forcibly closed by the remote host
-		# if len(peer_addrs) > 128:
-		# 	shortlisted_peers = set()
-		# 	for _ in range(128):
-		# 		shortlisted_peers.add(peer_addrs.pop())
+		# Addresses wait in the reserve pool of the connection manager, which keeps
+		# the number of open sockets below max_connections and replaces lost peers
+		self.connection_manager = ConnectionManager(self.torrent_info, max_connections, utp=utp, rate_limits=self.rate_limits)
+		self.connection_manager.add_addresses(peer_addrs, source='tracker')
+		self.connection_manager.add_addresses(dht_peers, source='dht')
+		peer_addrs |= dht_peers
 
-		# Initialize and attach all aggregated peers objects to self
-		self.peers = [Peer(peer, self.torrent_info) for peer in peer_addrs]
-
-		# Use list comprehension to create and execute peer functions in parallel
-		connections = [peer.connect() for peer in self.peers]
-		await asyncio.gather(*connections)
-
-		handshakes = [peer.handshake() for peer in self.peers]
-		await asyncio.gather(*handshakes)
-
-		interested_msgs = [peer.intrested() for peer in self.peers]
-		await asyncio.gather(*interested_msgs)
+		# Every peer is brought up on its own. Downloading can start as soon as the
+		# first one unchokes us, the others join the pool while the download runs.
+		self.connection_manager.start()
+		await self.connection_manager.wait_for_peers(timeout=peer_timeout)
+		self.peers = self.connection_manager.peers
 
 		# Add peers addresses to torrent_info
 		self.torrent_info['peers'] = peer_addrs
@@ -191,27 +231,66 @@ class Torrent:
 	async def download(self, file, strategy=DownloadStrategy.DEFAULT):
 		#TODO: Add a peer_list parameter with the default value of self.peers
 		active_peers = [peer for peer in self.peers if peer.has_handshaked]
-		fd_man = FilesDownloadManager(self.torrent_info, active_peers)
-		directory = self.torrent_info['name']
+		fd_man = FilesDownloadManager(self.torrent_info, active_peers, self.verifier, self.resume, self.storage, self.disk_writer)
 		logger.info(f"Using strategy {strategy} to download file {file}")
 
-		with PieceWriter(directory, file) as piece_writer:
+		# Peers connected while downloading are handed to the download manager as well
+		self.connection_manager.subscribe(fd_man.add_peer)
+		try:
+			# Empty files are created as well
+			self.storage.open(file)
+
 			if strategy == DownloadStrategy.DEFAULT:
 				async for piece in fd_man.get_file(file):
-					piece_writer.write(piece)
+					await self._store_piece(piece)
 
 			elif strategy == DownloadStrategy.SEQUENTIAL:
 				piece_len = self.torrent_info['piece_len']
-				async for piece in fd_man.get_file_sequential(file, piece_len):
-					piece_writer.write(piece)
+				async for piece in fd_man.get_file_sequential(file, piece_len, include_present=False):
+					await self._store_piece(piece)
+		finally:
+			self.connection_manager.unsubscribe(fd_man.add_peer)
+			try:
+				await self.disk_writer.flush()
+			finally:
+				if self._saving is not None: await self._saving
+				await self.disk_writer.run(self.resume.save)
+
+
+	async def _store_piece(self, piece):
+		# Pieces shared with other files are written to all of them, so they are not downloaded again.
+		# The write happens in the background, this only waits while the write-back cache is full.
+		await self.disk_writer.write(piece.num, piece.data)
+
+
+	def _on_written(self, num):
+		logger.info(f"Wrote piece {num} to {self.storage}")
+
+		# The resume data is saved every now and then, once the pieces it lists are on disk
+		self.resume.add(num)
+		if self.resume.due() and (self._saving is None or self._saving.done()):
+			self._saving = asyncio.create_task(self._save_resume())
+
+
+	async def _save_resume(self):
+		pieces = self.resume.snapshot()
+		try:
+			await self.disk_writer.sync()
+			await self.disk_writer.run(self.resume.save, pieces)
+		except OSError as E:
+			logger.warning(f"Could not save the resume data: {E}")
 
 
 	async def __generate_torrent_stream(self, file):
 		active_peers = [peer for peer in self.peers if peer.has_handshaked]
-		fd_man = FilesDownloadManager(self.torrent_info, active_peers)
+		fd_man = FilesDownloadManager(self.torrent_info, active_peers, self.verifier, self.resume, self.storage, self.disk_writer)
 		piece_len = self.torrent_info['piece_len']
-		async for piece in fd_man.get_file_sequential(file, piece_len):
-			yield piece.data
+		self.connection_manager.subscribe(fd_man.add_peer)
+		try:
+			async for piece in fd_man.get_file_sequential(file, piece_len):
+				yield fd_man.file_slice(file, piece)
+		finally:
+			self.connection_manager.unsubscribe(fd_man.add_peer)
 
 
 	async def stream(self, file, host="127.0.0.1", port=8080):
@@ -238,6 +317,35 @@ class Torrent:
 		await server.serve()
 
 
+	async def close(self):
+		"""
+		Disconnects the peers, writes the pieces still in the write-back cache,
+		stops the hashing and writing threads and closes the files. The
+		torrent can not be downloaded from afterwards.
+		"""
+		if self.connection_manager is not None:
+			await self.connection_manager.stop()
+		if self.verifier is not None:
+			self.verifier.close()
+		try:
+			if self.disk_writer is not None:
+				try:
+					await self.disk_writer.flush()
+				finally:
+					if self._saving is not None: await self._saving
+					self.disk_writer.close()
+		finally:
+			self.storage.close()
+
+
+	async def __aenter__(self):
+		return self
+
+
+	async def __aexit__(self, *exc_info):
+		await self.close()
+
+
 	def get_torrent_info(self, format='json', verbose=False):
 		# TODO: Add Yaml as an export format
 		torrent_info = copy.deepcopy(self.torrent_info)
@@ -0,0 +1,302 @@
+import asyncio
+import logging
+from itertools import count
+
+from aiotorrent.peer import Peer
+from aiotorrent.core.rate_limiter import RateLimits, GLOBAL_RATE_LIMITS
+from aiotorrent.core.peer_exchange import parse_pex
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class ConnectionManager:
+	"""
+	Keeps the number of open peer connections below a global cap.
+
+	Peer addresses which are not connected wait in a reserve pool ranked by
+	where they were discovered and how often connecting to them has failed.
+	Connections are opened from the best ranked addresses at a controlled
+	rate, and whenever a peer disconnects or turns out to be useless its slot
+	is handed to the next address in the reserve.
+
+	Every peer is brought up on its own (connect, handshake, bitfield,
+	interested) and joins the usable pool the moment it unchokes us, so
+	slow or dead addresses never hold up the fast ones.
+
+	Addresses received from connected peers through peer exchange (ut_pex)
+	go straight into the reserve pool, ranked before tracker and DHT addresses.
+
+	A peer which snubs us gives up its slot to a new address but keeps its
+	connection, so that it can be retried later. Once it sends blocks again
+	it takes the next free slot. Only MAX_SNUBBED peers are kept around
+	without a slot, those still snubbing us are dropped first.
+	"""
+	MAX_CONNECTIONS = 100
+	# Connection attempts per second
+	CONNECT_RATE = 50
+	# Seconds to wait for the bitfield after the handshake, and for the first unchoke
+	BITFIELD_TIMEOUT = 3
+	UNCHOKE_TIMEOUT = 20
+	# Addresses which failed this many times are dropped from the reserve
+	MAX_FAILURES = 3
+	# Snubbed peers kept connected on top of max_connections
+	MAX_SNUBBED = 10
+	# Lower ranks are tried first
+	SOURCE_RANKS = {'pex': 0, 'tracker': 1, 'dht': 2}
+
+	def __init__(self, torrent_info: dict, max_connections: int = MAX_CONNECTIONS, connect_rate: int = CONNECT_RATE, utp: bool = False, rate_limits: RateLimits = None) -> None:
+		self.torrent_info = torrent_info
+		self.max_connections = max_connections
+		self.connect_rate = connect_rate
+		# Connect over uTP first, falling back to TCP
+		self.utp = utp
+		# Bandwidth limits of the torrent, every peer gets its own below them
+		self.rate_limits = rate_limits if rate_limits is not None else RateLimits(parent=GLOBAL_RATE_LIMITS)
+
+		# Peers which completed the handshake and can be used for downloading
+		self.peers = list()
+
+		self._reserve = asyncio.PriorityQueue()
+		self._sequence = count() # Keeps the reserve FIFO for equally ranked addresses
+		self._failures = dict()  # Every address we know of, mapped to its failed attempts
+		self._sources = dict()
+		self._slots = asyncio.Semaphore(max_connections)
+		self._open = set()       # Peers holding a connection slot
+		self._snubbed = list()   # Peers kept connected without a slot, oldest first
+		self._tasks = set()
+		self._subscribers = list()
+		self._maintain_task = None
+		# Set whenever a peer is admitted or a connection attempt ends
+		self._changed = asyncio.Event()
+
+
+	def __repr__(self):
+		return f"ConnectionManager({len(self.peers)} peers, {self._reserve.qsize()} in reserve)"
+
+
+	def add_addresses(self, addresses, source: str = 'tracker') -> None:
+		"""Adds peer addresses which have not been seen before to the reserve pool"""
+		for address in addresses:
+			if address in self._failures: continue
+			self._failures[address] = 0
+			self._sources[address] = source
+			self._requeue(address)
+
+
+	def _requeue(self, address) -> None:
+		failures = self._failures[address]
+		if failures >= self.MAX_FAILURES:
+			logger.debug(f"Dropping {address} after {failures} failed attempts")
+			return
+
+		source = self._sources[address]
+		rank = self.SOURCE_RANKS.get(source, len(self.SOURCE_RANKS)) + failures * len(self.SOURCE_RANKS)
+		self._reserve.put_nowait((rank, next(self._sequence), address))
+
+
+	async def _connect(self, address) -> Peer:
+		# The caller must hold a slot, which is released again if the connection fails
+		peer = Peer(address, self.torrent_info, utp=self.utp, rate_limits=self.rate_limits.peer())
+		await peer.connect()
+
+		if not peer.active:
+			self._failures[address] += 1
+			self._requeue(address)
+			self._slots.release()
+			self._changed.set()
+			return None
+
+		self._open.add(peer)
+		peer.subscribe('disconnect', self._on_disconnect)
+		peer.subscribe('snubbed', self._on_snubbed)
+		peer.subscribe('unsnubbed', self._on_unsnubbed)
+		peer.subscribe('extended', self._on_extended)
+		return peer
+
+
+	def admit(self, peer: Peer) -> bool:
+		"""
+		Adds a peer to the usable pool once it has completed the handshake and
+		unchoked us, or allowed us to download some pieces while choked (BEP 6).
+		Returns True if the peer is in the pool.
+		"""
+		if peer in self.peers:
+			return True
+
+		if not peer.active or not peer.has_handshaked or (peer.choking_me and not peer.allowed_fast):
+			return False
+
+		self.peers.append(peer)
+		self._changed.set()
+		logger.debug(f"{peer} is ready, {self}")
+		for callback in self._subscribers:
+			callback(peer)
+		return True
+
+
+	def _on_disconnect(self, peer: Peer) -> None:
+		# A disconnect may be reported more than once, the slot is released only once
+		if peer in self._open:
+			self._open.remove(peer)
+			self._slots.release()
+		elif peer in self._snubbed:
+			self._snubbed.remove(peer)
+		else:
+			return
+
+		if peer in self.peers: self.peers.remove(peer)
+		# Peers banned for sending corrupt data are not connected to again
+		if peer.banned:
+			self._failures[peer.address] = self.MAX_FAILURES
+		else:
+			self._failures[peer.address] += 1
+		self._requeue(peer.address)
+		self._changed.set()
+		logger.debug(f"Lost {peer}, {self}")
+
+
+	def _on_snubbed(self, peer: Peer) -> None:
+		if peer not in self._open: return
+
+		# The peer stays connected, but its slot is handed to the next address in the reserve
+		self._open.remove(peer)
+		self._snubbed.append(peer)
+		self._slots.release()
+		logger.debug(f"{peer} is snubbing us, looking for a replacement, {self}")
+
+		# Every snub adds one peer, so dropping the oldest keeps the list at MAX_SNUBBED.
+		# Peers which recovered and wait for a slot are only dropped if no other is left.
+		if len(self._snubbed) > self.MAX_SNUBBED:
+			stale = [other for other in self._snubbed if other.snubbed] or self._snubbed
+			self._spawn(stale[0].disconnect("Peer kept snubbing us!"))
+
+
+	def _on_unsnubbed(self, peer: Peer) -> None:
+		if peer in self._snubbed: self._spawn(self._reclaim_slot(peer))
+
+
+	async def _reclaim_slot(self, peer: Peer) -> None:
+		"""Gives a peer which sends blocks again a slot, as soon as one is free"""
+		await self._slots.acquire()
+
+		# The peer may have disconnected, or been snubbed and recovered again, in the meantime
+		if peer not in self._snubbed or not peer.active or peer.snubbed:
+			self._slots.release()
+			return
+
+		self._snubbed.remove(peer)
+		self._open.add(peer)
+		logger.debug(f"{peer} recovered and got its slot back, {self}")
+
+
+	def _on_extended(self, peer: Peer, name: str, payload) -> None:
+		if name != 'ut_pex' or self.torrent_info.get('private'): return
+
+		try:
+			exchange = parse_pex(payload)
+		except ValueError as E:
+			logger.debug(f"Malformed ut_pex message from {peer}: {E}")
+			return
+
+		before = len(self._failures)
+		self.add_addresses(exchange['added'], source='pex')
+		logger.debug(f"{peer} sent {len(self._failures) - before} new addresses, {self}")
+
+
+	def _spawn(self, coroutine) -> None:
+		task = asyncio.create_task(coroutine)
+		self._tasks.add(task)
+		task.add_done_callback(self._tasks.discard)
+		task.add_done_callback(lambda _: self._changed.set())
+
+
+	def subscribe(self, callback) -> None:
+		"""Registers `callback` to be called as callback(peer) for every newly admitted peer"""
+		self._subscribers.append(callback)
+
+
+	def unsubscribe(self, callback) -> None:
+		if callback in self._subscribers:
+			self._subscribers.remove(callback)
+
+
+	def start(self) -> None:
+		"""Starts bringing up peers from the reserve in the background"""
+		if self._maintain_task is None:
+			self._maintain_task = asyncio.create_task(self._maintain())
+
+
+	def exhausted(self) -> bool:
+		# Nothing is connected, nothing is being connected and there is nothing left to try
+		return not self._open and not self._tasks and self._reserve.empty()
+
+
+	async def wait_for_peers(self, count: int = 1, timeout: float = None) -> int:
+		"""
+		Waits until at least `count` peers are usable, the reserve has been
+		exhausted, or `timeout` seconds have passed. Returns the number of usable peers.
+		"""
+		async def wait():
+			while len(self.peers) < count and not self.exhausted():
+				self._changed.clear()
+				await self._changed.wait()
+
+		try:
+			await asyncio.wait_for(wait(), timeout=timeout)
+		except asyncio.TimeoutError:
+			...
+		return len(self.peers)
+
+
+	async def stop(self) -> None:
+		if self._maintain_task is not None:
+			self._maintain_task.cancel()
+			self._maintain_task = None
+
+		for task in self._tasks: task.cancel()
+		for peer in list(self._open) + self._snubbed:
+			await peer.disconnect("Connection manager stopped!")
+
+
+	async def _maintain(self):
+		while True:
+			await self._slots.acquire()
+			_, _, address = await self._reserve.get()
+
+			self._spawn(self._bring_up(address))
+			await asyncio.sleep(1 / self.connect_rate)
+
+
+	async def _bring_up(self, address):
+		"""Takes a single peer from connect to unchoke, independently of all other peers"""
+		peer = await self._connect(address)
+		if peer is None: return
+
+		await peer.handshake()
+		if not peer.has_handshaked:
+			if peer.active: await peer.disconnect("Peer did not complete the handshake!")
+			return
+
+		# The bitfield, if the peer has any pieces, is the first message after the handshake
+		try:
+			await asyncio.wait_for(peer.bitfield_received.wait(), timeout=self.BITFIELD_TIMEOUT)
+		except asyncio.TimeoutError:
+			...
+
+		# Peers with nothing to offer only take up a connection
+		if not peer.pieces.any(True):
+			self._failures[peer.address] = self.MAX_FAILURES
+			return await peer.disconnect("Peer has no pieces!")
+
+		# The peer joins the usable pool as soon as (and whenever) it unchokes us
+		peer.subscribe('unchoke', self.admit)
+		await peer.intrested()
+		admitted = self.admit(peer)
+
+		try:
+			await asyncio.wait_for(peer.unchoked.wait(), timeout=self.UNCHOKE_TIMEOUT)
+		except asyncio.TimeoutError:
+			# Peers serving allowed fast pieces are kept until they disconnect
+			if not admitted: await peer.disconnect("Peer did not unchoke us!")
@@ -0,0 +1,191 @@
+import logging
+from bitstring import BitArray
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class AvailabilityIndex:
+	"""
+	Piece availability over the bitfields of all connected peers.
+
+	Bitfields are stored as Python integers in which bit i stands for piece i,
+	so a set operation over every piece of the torrent is a single integer
+	operation. The number of peers having each piece is stored bit-sliced:
+	plane j holds bit j of the count of every piece, and adding or removing a
+	bitfield is a ripple carry over the planes. Counting, finding the rarest
+	pieces and selecting what a peer can give us therefore take O(log peers)
+	integer operations instead of a Python loop over every piece.
+
+	num_pieces: int
+		Total number of pieces in the torrent
+	"""
+	def __init__(self, num_pieces: int) -> None:
+		self.num_pieces = num_pieces
+		# Pieces which still have to be downloaded
+		self.needed = 0
+
+		self._planes = list()
+		self._bitfields = dict()
+
+
+	def __repr__(self):
+		return f"AvailabilityIndex({len(self._bitfields)} peers, {self.needed.bit_count()} needed)"
+
+
+	def __len__(self):
+		return len(self._bitfields)
+
+
+	def __contains__(self, peer):
+		return peer in self._bitfields
+
+
+	@staticmethod
+	def to_mask(pieces: BitArray) -> int:
+		"""Converts a bitfield into an integer with bit i set if piece i is set"""
+		if not len(pieces): return 0
+		bits = BitArray(pieces)
+		bits.reverse()
+		return bits.uint
+
+
+	@staticmethod
+	def from_pieces(nums) -> int:
+		mask = 0
+		for num in nums: mask |= 1 << num
+		return mask
+
+
+	@staticmethod
+	def iter_pieces(mask: int):
+		"""Yields the pieces set in `mask` in ascending order"""
+		while mask:
+			lowest = mask & -mask
+			yield lowest.bit_length() - 1
+			mask ^= lowest
+
+
+	@staticmethod
+	def lowest(mask: int) -> int:
+		return (mask & -mask).bit_length() - 1
+
+
+	@staticmethod
+	def nth(mask: int, n: int) -> int:
+		"""Returns the n-th (zero based) piece set in `mask`"""
+		# Binary search for the shortest prefix of the mask holding more than n pieces
+		lo, hi = 0, mask.bit_length()
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if (mask & ((1 << (mid + 1)) - 1)).bit_count() > n:
+				hi = mid
+			else:
+				lo = mid + 1
+		return lo
+
+
+	def _add(self, mask: int) -> None:
+		carry = mask
+		for j, plane in enumerate(self._planes):
+			if not carry: break
+			self._planes[j] = plane ^ carry
+			carry &= plane
+		if carry: self._planes.append(carry)
+
+
+	def _subtract(self, mask: int) -> None:
+		borrow = mask
+		for j, plane in enumerate(self._planes):
+			if not borrow: break
+			self._planes[j] = plane ^ borrow
+			borrow &= ~plane
+		while self._planes and not self._planes[-1]:
+			self._planes.pop()
+
+
+	def set_bitfield(self, peer, pieces: BitArray) -> None:
+		"""Sets or replaces the pieces counted for `peer`"""
+		self.set_mask(peer, self.to_mask(pieces))
+
+
+	def set_mask(self, peer, mask: int) -> None:
+		previous = self._bitfields.get(peer, 0)
+		self._bitfields[peer] = mask
+		# Only the pieces which changed are carried through the planes
+		self._subtract(previous & ~mask)
+		self._add(mask & ~previous)
+
+
+	def add_piece(self, peer, num: int) -> bool:
+		"""Counts piece `num` for `peer`. Returns False if it was already counted."""
+		bit = 1 << num
+		mask = self._bitfields.get(peer, 0)
+		if mask & bit: return False
+		self._bitfields[peer] = mask | bit
+		self._add(bit)
+		return True
+
+
+	def remove_piece(self, peer, num: int) -> None:
+		bit = 1 << num
+		mask = self._bitfields.get(peer, 0)
+		if not mask & bit: return
+		self._bitfields[peer] = mask ^ bit
+		self._subtract(bit)
+
+
+	def remove(self, peer) -> None:
+		mask = self._bitfields.pop(peer, 0)
+		self._subtract(mask)
+
+
+	def want(self, nums) -> None:
+		self.needed |= self.from_pieces(nums)
+
+
+	def have(self, num: int) -> None:
+		self.needed &= ~(1 << num)
+
+
+	def counts(self) -> list[int]:
+		"""Number of peers having each piece"""
+		counts = [0] * self.num_pieces
+		for j, plane in enumerate(self._planes):
+			for num in self.iter_pieces(plane):
+				counts[num] += 1 << j
+		return counts
+
+
+	def peers_with(self, num: int) -> list:
+		"""Peers which have piece `num`"""
+		return [peer for peer, mask in self._bitfields.items() if (mask >> num) & 1]
+
+
+	def peers(self) -> list:
+		return list(self._bitfields)
+
+
+	def pieces_of(self, peer) -> int:
+		return self._bitfields.get(peer, 0)
+
+
+	def wanted_from(self, peer) -> int:
+		"""Mask of the pieces `peer` has which we still need"""
+		return self._bitfields.get(peer, 0) & self.needed
+
+
+	def interest(self, peer) -> int:
+		"""Number of needed pieces `peer` can give us, useful for ranking peers"""
+		return self.wanted_from(peer).bit_count()
+
+
+	def rarest(self, mask: int) -> int:
+		"""Returns the subset of `mask` held by the fewest peers"""
+		# Walk the planes from the most significant bit of the counts down, keeping
+		# the pieces with a zero bit whenever there are any. What is left shares the lowest count.
+		for plane in reversed(self._planes):
+			narrowed = mask & ~plane
+			if narrowed: mask = narrowed
+		return mask
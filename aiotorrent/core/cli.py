@@ -1,3 +1,4 @@
+import sys
 import asyncio
 import argparse
 import logging
@@ -7,6 +8,7 @@ from aiotorrent.aiotorrent import Torrent
 """
     aiotorrent download <path/to/file.torrent> <save_location<optional>>
     aiotorrent stream <path/to/file.torrent>
+    aiotorrent check <path/to/file.torrent>
 """
 
 LOG_LEVELS = {
@@ -22,17 +24,28 @@ LOG_LEVELS = {
 async def download_torrent(torrent_file_loc, save_loc=None):
     # TODO: Add parameter for save location
     # TODO: Add parameter for download strategy
-    torrent = Torrent(torrent_file_loc)
-    await torrent.init(dht_enabled = True)
-    for file in torrent.files:
-        await torrent.download(file)
+    async with Torrent(torrent_file_loc) as torrent:
+        await torrent.init(dht_enabled = True)
+        for file in torrent.files:
+            await torrent.download(file)
 
 
 async def stream_torrent(torrent_file_loc, host="127.0.0.0", port=8080):
+    async with Torrent(torrent_file_loc) as torrent:
+        await torrent.init(dht_enabled = True)
+        for file in torrent.files:
+            await torrent.stream(file, host=host, port=port)
+
+
+async def check_torrent(torrent_file_loc, workers=None):
     torrent = Torrent(torrent_file_loc)
-    await torrent.init(dht_enabled = True)
-    for file in torrent.files:
-        await torrent.stream(file, host=host, port=port)
+
+    def show_progress(checked, total):
+        print(f"\rChecked {checked}/{total} pieces", end="", file=sys.stderr, flush=True)
+
+    verified = await torrent.recheck(workers=workers, progress=show_progress)
+    print(file=sys.stderr)
+    print(f"{verified}/{len(torrent.torrent_info['piece_hashmap'])} pieces verified")
 
 
 def print_torrent_info(torrent_file_loc, format="json", verbose=False):
@@ -107,6 +120,26 @@ def create_info_parser(subparsers):
     return info_parser
 
 
+def create_check_parser(subparsers):
+    check_parser = subparsers.add_parser(
+        "check",
+        help="Check downloaded files against the piece hashes"
+    )
+    check_parser.add_argument(
+        "torrent_path",
+        help="Path to the .torrent file"
+    )
+    check_parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=None,
+        help="Number of processes hashing pieces (defaults to the number of CPUs)"
+    )
+
+    return check_parser
+
+
 # ================================ Main parser ================================
 async def main_parser():
     """Sets up and parses the arguments, then calls the appropriate function."""
@@ -130,10 +163,12 @@ async def main_parser():
     download_parser = create_download_parser(subparsers)
     stream_parser = create_stream_parser(subparsers)
     info_parser = create_info_parser(subparsers)
+    check_parser = create_check_parser(subparsers)
 
     download_parser.set_defaults(func=download_torrent)
     stream_parser.set_defaults(func=stream_torrent)
     info_parser.set_defaults(func=print_torrent_info)
+    check_parser.set_defaults(func=check_torrent)
     args = parser.parse_args()
 
     # Check if verbosity flag is set, if not it is set to 0
@@ -153,6 +188,8 @@ async def main_parser():
             await args.func(args.torrent_path, args.host, args.port)
         elif args.command == 'info':
             args.func(args.torrent_path, args.format, args.verbose)
+        elif args.command == 'check':
+            await args.func(args.torrent_path, args.workers)
     else:
         parser.print_help()
 
@@ -0,0 +1,177 @@
+import time
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class DiskWriter:
+	"""
+	Write-back cache in front of the Storage, written out by worker threads.
+
+	write() only queues a piece, so the event loop keeps serving the peers
+	while the disk is busy. Whenever a worker thread is free it takes the
+	lowest numbered queued piece together with the queued pieces following
+	it, up to MAX_RUN bytes, and writes them as one sequential vectored
+	write. The slower the disk, the more pieces queue up and the larger the
+	writes get. Queued pieces and those being written count towards
+	`cache_size` bytes; once the cache is full, write() waits for room and
+	wait_for_room() lets the download hold off starting new pieces.
+
+	`on_written` is called on the event loop with the number of every piece
+	once it has been handed to the operating system. Errors of the worker
+	threads are raised by the next call to write() or flush().
+
+	storage: Storage
+		Files the pieces are written to
+	workers: int
+		Number of writing threads
+	cache_size: int
+		Bytes of pieces which may be waiting to be written at once
+	on_written: callable
+		Called with the number of every piece which has been written
+	"""
+	WORKERS = 2
+	CACHE_SIZE = 64 * 2 ** 20
+	# Bytes written by a single call at most
+	MAX_RUN = 8 * 2 ** 20
+
+	def __init__(self, storage, workers: int = WORKERS, cache_size: int = CACHE_SIZE, on_written=None) -> None:
+		self.storage = storage
+		self.workers = workers
+		self.cache_size = cache_size
+		self.on_written = on_written
+
+		self._executor = ThreadPoolExecutor(workers, thread_name_prefix='aiotorrent-disk')
+		# Pieces waiting for a worker thread, by number
+		self._queued = dict()
+		self._running = 0
+		self._error = None
+		# Bytes of the queued pieces and of those being written
+		self.cached = 0
+		self._room = None
+		self._idle = None
+
+		self.pieces_written = 0
+		self.bytes_written = 0
+		self.writes = 0
+		# Seconds spent writing summed over the threads
+		self.write_time = 0.0
+
+
+	def __repr__(self):
+		return (f"DiskWriter({self.cached / 2 ** 20:.1f}/{self.cache_size / 2 ** 20:.0f} MiB cached, "
+			f"{self.pieces_written} pieces in {self.writes} writes)")
+
+
+	@property
+	def full(self) -> bool:
+		return self.cached >= self.cache_size
+
+
+	def _raise_error(self) -> None:
+		if self._error is not None:
+			error, self._error = self._error, None
+			raise error
+
+
+	def _wake_up(self, waiter: asyncio.Future) -> None:
+		if waiter is not None and not waiter.done(): waiter.set_result(None)
+
+
+	async def wait_for_room(self) -> None:
+		"""Waits until the cache is no longer full"""
+		while self.full:
+			if self._room is None or self._room.done():
+				self._room = asyncio.get_running_loop().create_future()
+			await asyncio.shield(self._room)
+
+
+	async def write(self, num: int, data) -> None:
+		"""
+		Queues piece `num` to be written, waiting while the cache is full.
+		`data` must not change until the piece has been written.
+		"""
+		self._raise_error()
+		# A piece larger than the whole cache is let in once the cache is empty
+		while self.cached and self.cached + len(data) > self.cache_size:
+			await self.wait_for_room()
+			self._raise_error()
+
+		self._queued[num] = data
+		self.cached += len(data)
+		self._dispatch()
+
+
+	def _dispatch(self) -> None:
+		loop = asyncio.get_running_loop()
+		while self._queued and self._running < self.workers:
+			# Adjacent pieces are written with a single call
+			first = min(self._queued)
+			run, size = list(), 0
+			while first + len(run) in self._queued and (not run or size + len(self._queued[first + len(run)]) <= self.MAX_RUN):
+				data = self._queued.pop(first + len(run))
+				run.append(data)
+				size += len(data)
+
+			self._running += 1
+			future = loop.run_in_executor(self._executor, self._write, first, run)
+			future.add_done_callback(lambda future, first=first, run=run, size=size: self._on_done(future, first, run, size))
+
+
+	def _write(self, first: int, run: list) -> float:
+		start = time.perf_counter()
+		self.storage.writev(first, run)
+		return time.perf_counter() - start
+
+
+	def _on_done(self, future: asyncio.Future, first: int, run: list, size: int) -> None:
+		self._running -= 1
+		self.cached -= size
+
+		if future.cancelled() or future.exception() is not None:
+			self._error = self._error or (future.exception() if not future.cancelled() else OSError("Write cancelled"))
+			logger.error(f"Writing pieces #{first}-{first + len(run) - 1} failed: {self._error}")
+		else:
+			self.write_time += future.result()
+			self.writes += 1
+			self.pieces_written += len(run)
+			self.bytes_written += size
+			if self.on_written is not None:
+				for num in range(first, first + len(run)):
+					self.on_written(num)
+
+		self._wake_up(self._room)
+		if not self._running and not self._queued: self._wake_up(self._idle)
+		self._dispatch()
+
+
+	async def run(self, function, *args):
+		"""Runs a blocking `function` in a worker thread"""
+		return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+
+	async def sync(self) -> None:
+		"""Makes sure that everything written so far is on disk"""
+		await self.run(self.storage.flush)
+
+
+	async def flush(self) -> None:
+		"""
+		Waits until every queued piece has been written and syncs the files,
+		then raises the error of a failed write if there was one.
+		"""
+		while self._running or self._queued:
+			if self._idle is None or self._idle.done():
+				self._idle = asyncio.get_running_loop().create_future()
+			await asyncio.shield(self._idle)
+		await self.sync()
+		self._raise_error()
+
+
+	def close(self) -> None:
+		"""Shuts the worker threads down once the pieces being written are done"""
+		self._executor.shutdown(wait=False)
@@ -1,3 +1,24 @@
+import os
+import re
+
+
+def safe_path(components) -> str:
+	"""
+	Joins the path components of a torrent file into a relative path.
+	The components come from the torrent, so empty ones, '.', '..',
+	absolute paths, drive letters and separators inside a component are
+	rejected with a ValueError, as they could place the file anywhere.
+	"""
+	if isinstance(components, str): components = [components]
+	if not components:
+		raise ValueError("Empty file path in torrent")
+	for part in components:
+		if (not isinstance(part, str) or part in ('', '.', '..') or '/' in part or '\\' in part
+				or '\0' in part or os.path.isabs(part) or re.match(r'^[A-Za-z]:', part)):
+			raise ValueError(f"Unsafe file path in torrent: {components!r}")
+	return os.path.join(*components)
+
+
 class File:
 	#TODO: Rename to TorrentFile
 	"""
@@ -12,11 +33,23 @@ class File:
 		# In case of single file torrent, the name is a string, and not a list of filenames[strings]
 		filename = file_info['path']
 		self.name = filename[0] if isinstance(filename, list) else filename
+		# Location of the file below the download directory
+		self.path = safe_path(filename)
 		self.__bytes_written = 0
 		self.__bytes_downloaded = 0
 
+		# Offset of the first byte of the file within the torrent
+		self.offset = counted
+
 		start_piece, start_byte = divmod(counted, piece_size)
-		end_piece, end_byte = divmod((counted + self.size), piece_size)
+		# The last piece is the one holding the last byte, so that a file ending on a
+		# piece boundary does not reach into the next piece. end_byte is exclusive.
+		end_piece, end_byte = divmod(counted + self.size - 1, piece_size)
+		end_byte += 1
+
+		# An empty file has no pieces
+		if not self.size:
+			end_piece, end_byte = start_piece - 1, start_byte
 
 		self.start_piece = start_piece
 		self.start_byte = start_byte
@@ -26,6 +59,12 @@ class File:
 
 	def __repr__(self):
 		return f"{self.name} ({self.size})"
+
+
+	@property
+	def pieces(self) -> range:
+		"""Numbers of the pieces holding data of this file"""
+		return range(self.start_piece, self.end_piece + 1)
 	
 
 	def get_bytes_written(self):
@@ -1,17 +1,20 @@
 from struct import pack
 
+from aiotorrent.core.util import FAST_EXTENSION, EXTENSION_PROTOCOL
+from aiotorrent.core.bencode_utils import bencode_util
+
 
 class MessageGenerator:
 	"""
 		This class generates messages.
 	"""
 	@staticmethod
-	def gen_handshake(info_hash):
+	def gen_handshake(info_hash, reserved=FAST_EXTENSION | EXTENSION_PROTOCOL):
 		'''
 		handshake:
 			<pstrlen>	1   byte; string length of <pstr>, as a single raw byte; strlen = 19
 			<pstr>		19 bytes; string identifier of the protocol; "BitTorrent protocol"
-			<reserved>	8  bytes; eight (8) reserved bytes
+			<reserved>	8  bytes; eight (8) reserved bytes, flags of the supported extensions
 			<info_hash>	20 bytes; info_hash
 			<peer_id>	20 bytes; peer_id
 		'''
@@ -19,7 +22,7 @@ class MessageGenerator:
 			">B19sQ20s20s",
 			19,
 			b"BitTorrent protocol",
-			00000000,
+			reserved,
 			info_hash,
 			b"ABCD" + b"X"*16			
 		)
@@ -38,4 +41,30 @@ class MessageGenerator:
 	def gen_request(index, offset, BLOCK_SIZE=(2 ** 14)):
 		mlen, mid = 13, 6
 		message = pack(">IBIII", mlen, mid, index, offset, BLOCK_SIZE)
-		return message
\ No newline at end of file
+		return message
+
+
+	@staticmethod
+	def gen_cancel(index, offset, BLOCK_SIZE=(2 ** 14)):
+		mlen, mid = 13, 8
+		message = pack(">IBIII", mlen, mid, index, offset, BLOCK_SIZE)
+		return message
+
+
+	@staticmethod
+	def gen_extended(extended_id, payload):
+		'''
+		extended (BEP 10):
+			<len=0002+X><id=20><extended_id><payload>
+		'''
+		mlen, mid = 2 + len(payload), 20
+		message = pack(">IBB", mlen, mid, extended_id) + payload
+		return message
+
+
+	@staticmethod
+	def gen_extended_handshake(extensions):
+		# The extension handshake maps the name of every supported extension
+		# to the extended message id the peer has to use for it
+		payload = bencode_util.bencode({'m': extensions, 'v': 'aiotorrent'})
+		return MessageGenerator.gen_extended(0, payload)
@@ -0,0 +1,44 @@
+import logging
+from struct import unpack_from
+from ipaddress import ip_address
+
+import fastbencode
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def decode_compact(blob: bytes, ip_len: int = 4) -> list[tuple[str, int]]:
+	"""
+	Decodes a compact list of peer addresses, every address being the IP
+	(4 bytes for IPv4, 16 for IPv6) followed by a 2 byte port
+	"""
+	addresses = list()
+	step = ip_len + 2
+	for start in range(0, len(blob) - step + 1, step):
+		ip = ip_address(blob[start:start + ip_len]).compressed
+		port = unpack_from('>H', blob, start + ip_len)[0]
+		if port: addresses.append((ip, port))
+	return addresses
+
+
+def parse_pex(payload) -> dict[str, list[tuple[str, int]]]:
+	"""
+	Decodes a ut_pex message into the addresses the peer has connected to
+	('added') and disconnected from ('dropped') since its last message.
+	Raises ValueError if the message is malformed.
+	"""
+	# The compact address lists are binary, so the message is decoded without bencode_util
+	message = fastbencode.bdecode(bytes(payload))
+	if not isinstance(message, dict):
+		raise ValueError("ut_pex message is not a dictionary")
+
+	def addresses(key, ip_len):
+		blob = message.get(key, b'')
+		return decode_compact(blob, ip_len) if isinstance(blob, bytes) else []
+
+	return {
+		'added': addresses(b'added', 4) + addresses(b'added6', 16),
+		'dropped': addresses(b'dropped', 4) + addresses(b'dropped6', 16),
+	}
@@ -0,0 +1,285 @@
+import asyncio
+import logging
+from struct import unpack_from
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+HANDSHAKE_LEN = 68
+# Largest message we are willing to buffer. Piece messages carry a single block
+# and even the bitfield of a torrent with millions of pieces fits well below this.
+MAX_MESSAGE_LEN = 2 ** 20
+
+
+class PeerProtocol(asyncio.BufferedProtocol):
+	"""
+	Transport of a peer connection.
+
+	The event loop receives straight into a preallocated buffer (recv_into on
+	the view returned by get_buffer()) and the framing layer finds the message
+	boundaries in place, so complete messages are handed out as memoryviews
+	into the buffer without being copied. When the end of the buffer is
+	reached, the incomplete message left over is moved to the front and the
+	buffer is reused. Since block payloads are views into the buffer, space
+	handed out by read_messages() is only reused after it has been given back
+	with release(). If it is still in use, reading continues in a fresh buffer.
+
+	Outgoing batches of messages are written with writelines(), which the
+	event loop sends as a single vectored write where it supports it.
+
+	If a download TokenBucket is given, every byte received is taken from it
+	and reading from the socket is paused until its debt is paid back, so the
+	sender is slowed down by flow control instead of data being dropped.
+
+	buffer_size: int
+		Size of the receive buffer. Reading is paused while this many bytes
+		of complete messages wait to be read.
+	bucket: TokenBucket
+		Optional download rate limit of the connection
+	"""
+	BUFFER_SIZE = 256 * 1024
+	# Space offered to a single recv_into() at the least
+	MIN_READ = 64 * 1024
+
+	def __init__(self, buffer_size: int = BUFFER_SIZE, bucket=None) -> None:
+		self.buffer_size = buffer_size
+		self.bucket = bucket
+		self.transport = None
+
+		self._buffer = bytearray(buffer_size)
+		self._view = memoryview(self._buffer)
+		# Everything before _start has been released, everything before _read has been
+		# handed out, [_read, _framed) are complete messages and [_framed, _end) is the
+		# start of the message being received
+		self._start = self._read = self._framed = self._end = 0
+		self._handshaken = False
+
+		self._waiter = None
+		self._eof = False
+		self._exception = None
+		# Reading is paused while the buffer is full or the rate limit is exceeded
+		self._paused_reading = False
+		self._backlogged = False
+		self._throttled = False
+
+		self._paused_writing = False
+		self._drain_waiters = list()
+		self._closed = asyncio.get_running_loop().create_future()
+
+
+	def __repr__(self):
+		return f"PeerProtocol({self._framed - self._read} bytes framed, {self._end - self._framed} partial)"
+
+
+	def connection_made(self, transport) -> None:
+		self.transport = transport
+
+
+	def connection_lost(self, exc) -> None:
+		self._eof = True
+		self._exception = exc
+		self._wake_up()
+
+		for waiter in self._drain_waiters:
+			if not waiter.done(): waiter.set_exception(ConnectionResetError("Connection lost"))
+		self._drain_waiters.clear()
+		if not self._closed.done(): self._closed.set_result(None)
+
+
+	def eof_received(self) -> bool:
+		self._eof = True
+		self._wake_up()
+		# Let the transport close itself
+		return False
+
+
+	def get_buffer(self, sizehint: int) -> memoryview:
+		# Room for the rest of the message being received, and for a decent read
+		wanted = max(self._remaining(), self.MIN_READ)
+		if len(self._buffer) - self._end < wanted:
+			self._make_room(wanted)
+		return self._view[self._end:]
+
+
+	def buffer_updated(self, nbytes: int) -> None:
+		self._end += nbytes
+		if self._handshaken: self._frame()
+		self._wake_up()
+
+		# Stop reading from the socket until the complete messages have been read
+		if self._framed - self._read >= self.buffer_size:
+			self._backlogged = True
+			self._update_reading()
+
+		if self.bucket is not None and self.bucket.limited:
+			delay = self.bucket.consume(nbytes)
+			if delay and not self._throttled:
+				self._throttled = True
+				self._update_reading()
+				asyncio.get_running_loop().call_later(delay, self._unthrottle)
+
+
+	def _unthrottle(self) -> None:
+		# Other connections may have run the shared buckets into debt again in the meantime
+		if delay := self.bucket.delay():
+			asyncio.get_running_loop().call_later(delay, self._unthrottle)
+			return
+		self._throttled = False
+		self._update_reading()
+
+
+	def _update_reading(self) -> None:
+		paused = self._backlogged or self._throttled
+		if paused == self._paused_reading or self._eof or self.transport is None: return
+		self._paused_reading = paused
+		if paused:
+			self.transport.pause_reading()
+		else:
+			self.transport.resume_reading()
+
+
+	def _remaining(self) -> int:
+		"""Number of bytes still missing from the message being received"""
+		partial = self._end - self._framed
+		if not self._handshaken: return max(HANDSHAKE_LEN - partial, 0)
+		if partial < 4: return 4 - partial
+		message_len = min(unpack_from('>I', self._buffer, self._framed)[0], MAX_MESSAGE_LEN)
+		return max(4 + message_len - partial, 0)
+
+
+	def _make_room(self, wanted: int) -> None:
+		pending = self._end - self._read
+		size = max(self.buffer_size, pending + wanted)
+
+		if self._start == self._read and size <= len(self._buffer):
+			# Nothing handed out is in use anymore, so the buffer is reused from the front
+			self._view[:pending] = self._view[self._read:self._end]
+		else:
+			# Messages handed out still point into the buffer, carry on in a fresh one
+			buffer = bytearray(size)
+			buffer[:pending] = self._view[self._read:self._end]
+			self._buffer, self._view = buffer, memoryview(buffer)
+
+		self._framed -= self._read
+		self._start = self._read = 0
+		self._end = pending
+
+
+	def _frame(self) -> None:
+		# Advance _framed over every complete message in the buffer
+		framed, end = self._framed, self._end
+		while end - framed >= 4:
+			message_len = unpack_from('>I', self._buffer, framed)[0]
+			if message_len > MAX_MESSAGE_LEN:
+				self._exception = ValueError(f"Message length {message_len} exceeds {MAX_MESSAGE_LEN} bytes")
+				self.transport.pause_reading()
+				break
+			if end - framed < 4 + message_len: break
+			framed += 4 + message_len
+		self._framed = framed
+
+
+	def _wake_up(self) -> None:
+		if self._waiter is not None and not self._waiter.done():
+			self._waiter.set_result(None)
+
+
+	async def _wait(self) -> None:
+		self._waiter = asyncio.get_running_loop().create_future()
+		try:
+			await self._waiter
+		finally:
+			self._waiter = None
+
+
+	async def read_handshake(self) -> bytes:
+		"""
+		Returns the handshake of the peer. Raises asyncio.IncompleteReadError
+		if the connection is closed first.
+		"""
+		while self._end - self._read < HANDSHAKE_LEN:
+			if self._eof:
+				raise asyncio.IncompleteReadError(bytes(self._view[self._read:self._end]), HANDSHAKE_LEN)
+			await self._wait()
+
+		handshake = bytes(self._view[self._read:self._read + HANDSHAKE_LEN])
+		self._start = self._read = self._framed = self._read + HANDSHAKE_LEN
+		self._handshaken = True
+		self._frame()
+		return handshake
+
+
+	async def read_messages(self) -> memoryview:
+		"""
+		Returns a view of every complete message received since the last call,
+		length prefixes included, waiting for at least one. The view has to be
+		given back with release() once nothing refers to it anymore. Returns an
+		empty view once the peer has closed the connection, raises the
+		connection error if it was lost and ValueError if the peer announced
+		an oversized message.
+		"""
+		while self._framed == self._read:
+			if self._exception is not None: raise self._exception
+			if self._eof: return self._view[:0]
+			await self._wait()
+
+		messages = self._view[self._read:self._framed]
+		self._read = self._framed
+
+		if self._backlogged:
+			self._backlogged = False
+			self._update_reading()
+		return messages
+
+
+	def release(self, messages: memoryview) -> None:
+		"""Gives back the space of `messages` returned by read_messages(), in the order they were read"""
+		# Views into a buffer which has been replaced in the meantime need no bookkeeping
+		if messages.obj is self._buffer:
+			self._start += len(messages)
+
+
+	def write(self, data) -> None:
+		self.transport.write(data)
+
+
+	def writelines(self, messages) -> None:
+		self.transport.writelines(messages)
+
+
+	def pause_writing(self) -> None:
+		self._paused_writing = True
+
+
+	def resume_writing(self) -> None:
+		self._paused_writing = False
+		for waiter in self._drain_waiters:
+			if not waiter.done(): waiter.set_result(None)
+		self._drain_waiters.clear()
+
+
+	async def drain(self) -> None:
+		"""Waits until the write buffer of the transport is below its high-water mark"""
+		if self.transport is None or self.transport.is_closing():
+			# Give connection_lost() a chance to run before reporting the closed connection
+			await asyncio.sleep(0)
+			if self._closed.done(): raise ConnectionResetError("Connection lost")
+
+		if not self._paused_writing: return
+		waiter = asyncio.get_running_loop().create_future()
+		self._drain_waiters.append(waiter)
+		await waiter
+
+
+	def is_closing(self) -> bool:
+		return self.transport is None or self.transport.is_closing()
+
+
+	def close(self) -> None:
+		if self.transport is not None: self.transport.close()
+
+
+	async def wait_closed(self) -> None:
+		await self._closed
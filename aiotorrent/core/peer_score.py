@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+from functools import partial
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PeerScore:
+	"""
+	Recent performance of a single peer.
+
+	Received bytes, request outcomes and hash failures are kept for the last
+	WINDOW seconds, the round trip time as a moving average. The download rate
+	only counts the time in which requests were outstanding, so a peer which
+	was given little work is not rated as slow. value() combines everything
+	into a single score, higher is better, which the downloader uses to hand
+	out work in proportion to what a peer delivers.
+	"""
+	WINDOW = 30
+	# Weight of a new sample in the RTT moving average
+	ALPHA = 0.3
+	# Every hash failure in the window divides the score by this much
+	HASH_FAILURE_PENALTY = 4
+
+	def __init__(self, window: float = WINDOW) -> None:
+		self.window = window
+		self.rtt = None		# Smoothed request round trip time in seconds
+
+		self._blocks = deque()			# (time, bytes) of every block received
+		self._outcomes = deque()		# (time, failed) of every finished request
+		self._hash_failures = deque()	# (time,) of every corrupt piece
+		self._busy = deque()			# (end, start) of the periods with requests outstanding
+		self._busy_since = None
+		self._outstanding = 0
+
+
+	def __repr__(self):
+		value = self.value()
+		return f"PeerScore({'unrated' if value is None else f'{value:.0f}'})"
+
+
+	def track(self, future: asyncio.Future, length: int) -> None:
+		"""Records the outcome of the request behind `future` once it finishes"""
+		now = time.monotonic()
+		if self._outstanding == 0: self._busy_since = now
+		self._outstanding += 1
+		future.add_done_callback(partial(self._finished, now, length))
+
+
+	def _finished(self, requested_at: float, length: int, future: asyncio.Future) -> None:
+		now = time.monotonic()
+		self._outstanding -= 1
+		if self._outstanding == 0:
+			self._busy.append((now, self._busy_since))
+			self._busy_since = None
+
+		if future.cancelled() or future.exception() is not None:
+			self._outcomes.append((now, True))
+
+		# A request resolved to None was withdrawn, which says nothing about the peer
+		elif future.result() is not None:
+			self._outcomes.append((now, False))
+			self._blocks.append((now, length))
+			rtt = now - requested_at
+			self.rtt = rtt if self.rtt is None else (1 - self.ALPHA) * self.rtt + self.ALPHA * rtt
+
+		self._expire(now)
+
+
+	def record_hash_failure(self) -> None:
+		self._hash_failures.append((time.monotonic(),))
+
+
+	def _expire(self, now: float) -> None:
+		horizon = now - self.window
+		for samples in (self._blocks, self._outcomes, self._hash_failures, self._busy):
+			while samples and samples[0][0] < horizon:
+				samples.popleft()
+
+
+	@property
+	def rate(self) -> float:
+		"""Bytes per second received while requests were outstanding"""
+		now = time.monotonic()
+		self._expire(now)
+		horizon = now - self.window
+
+		busy = sum(end - max(start, horizon) for end, start in self._busy)
+		if self._busy_since is not None: busy += now - max(self._busy_since, horizon)
+		if not busy: return 0.0
+		return sum(length for _, length in self._blocks) / busy
+
+
+	@property
+	def error_rate(self) -> float:
+		"""Share of the requests in the window which timed out or failed"""
+		self._expire(time.monotonic())
+		if not self._outcomes: return 0.0
+		return sum(failed for _, failed in self._outcomes) / len(self._outcomes)
+
+
+	@property
+	def hash_failures(self) -> int:
+		self._expire(time.monotonic())
+		return len(self._hash_failures)
+
+
+	def value(self) -> float:
+		"""
+		Returns the score of the peer, or None if it has not finished any
+		request in the window yet.
+		"""
+		self._expire(time.monotonic())
+		if not self._outcomes: return None
+
+		value = self.rate * (1 - self.error_rate)
+		value /= self.HASH_FAILURE_PENALTY ** self.hash_failures
+		# Of two equally fast peers, the one with data in flight for less time is preferred
+		if self.rtt is not None: value /= 1 + self.rtt
+		return value
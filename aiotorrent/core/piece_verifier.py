@@ -0,0 +1,130 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PieceVerifier:
+	"""
+	Checks the SHA-1 hashes of pieces in a thread pool, off the event loop.
+
+	hashlib releases the GIL while hashing large buffers, so the pool hashes
+	several pieces in parallel while the event loop keeps serving the peer
+	sockets. At most `max_pending` pieces are queued for or being hashed at a
+	time; further calls to submit() wait for a slot, which slows down the
+	downloads feeding the pool instead of letting completed pieces pile up
+	in memory. Pieces below INLINE_SIZE are hashed on the event loop, where
+	that is cheaper than handing them to a thread.
+
+	workers: int
+		Number of hashing threads
+	max_pending: int
+		Pieces which may be queued or hashed at once, defaults to twice the workers
+	"""
+	WORKERS = min(4, os.cpu_count() or 1)
+	INLINE_SIZE = 64 * 1024
+
+	def __init__(self, workers: int = WORKERS, max_pending: int = None) -> None:
+		self.workers = workers
+		self.max_pending = max_pending or 2 * workers
+		self._executor = None
+		# Created on first use, in the event loop which uses the verifier
+		self._slots = None
+		self._loop = None
+
+		self.pieces = 0
+		self.bytes_hashed = 0
+		# Seconds spent hashing summed over the threads, and seconds pieces waited for a thread
+		self.hash_time = 0.0
+		self.wait_time = 0.0
+
+
+	def __repr__(self):
+		return f"PieceVerifier({self.workers} workers, {self.pieces} pieces, {self.throughput() / 2 ** 20:.0f} MiB/s)"
+
+
+	@staticmethod
+	def _hash(data, hasher=None) -> tuple[bytes, float]:
+		start = time.perf_counter()
+		hasher = hasher if hasher is not None else hashlib.sha1()
+		hasher.update(data)
+		return hasher.digest(), time.perf_counter() - start
+
+
+	def _count(self, data, elapsed: float) -> None:
+		self.pieces += 1
+		self.bytes_hashed += len(data)
+		self.hash_time += elapsed
+
+
+	async def submit(self, data, expected: bytes, hasher=None) -> asyncio.Future:
+		"""
+		Queues `data` to be hashed, waiting while the queue is full. Returns a
+		future which resolves to True if the SHA-1 hash of `data` is `expected`.
+		`data` must not change until then.
+
+		If the start of the piece has been hashed already, `data` is the rest
+		of it and `hasher` the running hash of the start, which is updated.
+		"""
+		loop = asyncio.get_running_loop()
+		result = loop.create_future()
+
+		if len(data) < self.INLINE_SIZE:
+			digest, elapsed = self._hash(data, hasher)
+			self._count(data, elapsed)
+			result.set_result(digest == expected)
+			return result
+
+		if self._loop is not loop:
+			self._loop, self._slots = loop, asyncio.Semaphore(self.max_pending)
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='aiotorrent-hash')
+
+		queued = time.perf_counter()
+		await self._slots.acquire()
+
+		def on_hashed(future):
+			self._slots.release()
+			if result.cancelled(): return
+			if future.cancelled():
+				result.cancel()
+				return
+			if future.exception() is not None:
+				result.set_exception(future.exception())
+				return
+			digest, elapsed = future.result()
+			self.wait_time += time.perf_counter() - queued - elapsed
+			self._count(data, elapsed)
+			result.set_result(digest == expected)
+
+		loop.run_in_executor(self._executor, self._hash, data, hasher).add_done_callback(on_hashed)
+		return result
+
+
+	def throughput(self) -> float:
+		"""Bytes hashed per second by a single thread, the pool hashes up to `workers` times as much"""
+		return self.bytes_hashed / self.hash_time if self.hash_time else 0.0
+
+
+	def stats(self) -> dict:
+		return {
+			'workers': self.workers,
+			'pieces': self.pieces,
+			'bytes': self.bytes_hashed,
+			'hash_time': self.hash_time,
+			'wait_time': self.wait_time,
+			'throughput': self.throughput(),
+		}
+
+
+	def close(self) -> None:
+		"""Shuts the thread pool down, it is started again when needed"""
+		if self._executor is not None:
+			self._executor.shutdown(wait=False, cancel_futures=True)
+			self._executor = None
@@ -0,0 +1,188 @@
+import time
+import asyncio
+import logging
+import weakref
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+def _check_rate(rate: float) -> None:
+	# A bucket with a rate of 0 would never pay its debt back
+	if rate is not None and not rate > 0:
+		raise ValueError(f"Rate must be greater than 0 or None, not {rate}")
+
+
+
+class TokenBucket:
+	"""
+	Token bucket limiting a byte rate, optionally below a parent bucket.
+
+	Tokens refill at `rate` bytes per second up to `burst`. Transfers are
+	never split or dropped: consume() takes the tokens from the bucket and
+	all its ancestors at once, even if that leaves them in debt, and returns
+	how long the caller has to hold off until every bucket in the chain has
+	paid its debt back. The long-term rate therefore matches the slowest
+	bucket in the chain exactly. A bucket without a rate is unlimited and
+	only passes the tokens up to its parent.
+
+	Data which has been requested but not received yet is accounted for
+	separately with reserve() and settle(), so that no more is requested
+	than the limits let through within REQUEST_HORIZON seconds.
+
+	rate: float
+		Bytes per second, greater than 0, None for no limit
+	burst: float
+		Bytes which may be transferred at once after being idle, defaults
+		to BURST_TIME seconds worth of the rate
+	parent: TokenBucket
+		Bucket of the level above, e.g. the torrent of a peer
+	"""
+	BURST_TIME = 0.25
+	# Seconds worth of data which may be requested ahead of receiving it
+	REQUEST_HORIZON = 2
+
+	def __init__(self, rate: float = None, burst: float = None, parent: 'TokenBucket' = None) -> None:
+		self.parent = parent
+		self.pending = 0	# Bytes requested but not received yet
+		self._waiters = list()
+		self.set_rate(rate, burst)
+
+
+	def __repr__(self):
+		return f"TokenBucket({'unlimited' if self.rate is None else f'{self.rate:.0f} B/s'}, {self.tokens:.0f} tokens)"
+
+
+	def set_rate(self, rate: float = None, burst: float = None) -> None:
+		_check_rate(rate)
+		self.rate = rate
+		self.burst = burst if burst is not None else (rate * self.BURST_TIME if rate else 0)
+		self.tokens = self.burst
+		self._updated = time.monotonic()
+		self._wake_up()
+
+
+	@property
+	def limited(self) -> bool:
+		"""True if this bucket or any of its ancestors has a rate"""
+		return any(bucket.rate is not None for bucket in self._chain())
+
+
+	def _chain(self):
+		bucket = self
+		while bucket is not None:
+			yield bucket
+			bucket = bucket.parent
+
+
+	def _refill(self, now: float) -> None:
+		self.tokens = min(self.tokens + (now - self._updated) * self.rate, self.burst)
+		self._updated = now
+
+
+	def delay(self) -> float:
+		"""Seconds until no bucket in the chain is in debt"""
+		return self.consume(0)
+
+
+	def consume(self, nbytes: int) -> float:
+		"""Takes `nbytes` from every bucket in the chain. Returns the delay() afterwards."""
+		now, delay = time.monotonic(), 0.0
+		for bucket in self._chain():
+			if bucket.rate is None: continue
+			bucket._refill(now)
+			bucket.tokens -= nbytes
+			if bucket.tokens < 0: delay = max(delay, -bucket.tokens / bucket.rate)
+		return delay
+
+
+	def _admits(self, nbytes: int) -> bool:
+		# Anything may be requested while nothing is pending, so no request is too large
+		for bucket in self._chain():
+			if bucket.rate is None or not bucket.pending: continue
+			if bucket.pending + nbytes > bucket.rate * self.REQUEST_HORIZON: return False
+		return True
+
+
+	async def reserve(self, nbytes: int) -> None:
+		"""Waits until `nbytes` more may be requested, and counts them as pending"""
+		while not self._admits(nbytes):
+			waiter = asyncio.get_running_loop().create_future()
+			for bucket in self._chain():
+				if bucket.rate is not None: bucket._waiters.append(waiter)
+			await waiter
+
+		for bucket in self._chain():
+			bucket.pending += nbytes
+
+
+	def settle(self, nbytes: int) -> None:
+		"""Stops counting `nbytes` reserved earlier as pending, because they arrived or never will"""
+		for bucket in self._chain():
+			bucket.pending -= nbytes
+			bucket._wake_up()
+
+
+	def _wake_up(self) -> None:
+		waiters, self._waiters = self._waiters, list()
+		for waiter in waiters:
+			if not waiter.done(): waiter.set_result(None)
+
+
+	async def throttle(self, nbytes: int) -> None:
+		"""Takes `nbytes` and waits for the debt to be paid back"""
+		if delay := self.consume(nbytes):
+			await asyncio.sleep(delay)
+
+
+
+class RateLimits:
+	"""
+	Download and upload buckets of one level of the hierarchy: the global
+	limits, the limits of a torrent and those of a single peer.
+	peer_download and peer_upload are the limits given to every child
+	created with peer(), and are applied to the existing ones when changed.
+	"""
+	def __init__(self, download: float = None, upload: float = None, parent: 'RateLimits' = None) -> None:
+		self.download = TokenBucket(download, parent=parent.download if parent else None)
+		self.upload = TokenBucket(upload, parent=parent.upload if parent else None)
+		self.peer_download = None
+		self.peer_upload = None
+		self._peers = weakref.WeakSet()
+
+
+	def __repr__(self):
+		return f"RateLimits(download={self.download}, upload={self.upload})"
+
+
+	def set(self, download: float = None, upload: float = None, peer_download: float = None, peer_upload: float = None) -> None:
+		"""Sets the limits in bytes per second, None removes a limit"""
+		# Nothing is changed if any of the rates is invalid
+		for rate in (download, upload, peer_download, peer_upload):
+			_check_rate(rate)
+		self.download.set_rate(download)
+		self.upload.set_rate(upload)
+		self.peer_download, self.peer_upload = peer_download, peer_upload
+		for peer in self._peers:
+			peer.set(peer_download, peer_upload)
+
+
+	def peer(self) -> 'RateLimits':
+		"""Returns the limits for a new peer below this level"""
+		limits = RateLimits(self.peer_download, self.peer_upload, parent=self)
+		self._peers.add(limits)
+		return limits
+
+
+
+# Limits shared by every torrent
+GLOBAL_RATE_LIMITS = RateLimits()
+
+
+def set_global_rate_limit(download: float = None, upload: float = None) -> None:
+	"""Limits the bandwidth of all torrents together, in bytes per second. None removes a limit."""
+	_check_rate(download)
+	_check_rate(upload)
+	GLOBAL_RATE_LIMITS.download.set_rate(download)
+	GLOBAL_RATE_LIMITS.upload.set_rate(upload)
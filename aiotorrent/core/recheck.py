@@ -0,0 +1,146 @@
+import os
+import mmap
+import asyncio
+import hashlib
+import logging
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+
+from bitstring import BitArray
+
+from aiotorrent.core.storage import Storage
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# Set up in every worker process by _init_worker()
+_files = None
+_offsets = None
+_piece_len = None
+_maps = dict()
+
+
+def _init_worker(files: list[tuple[str, int, int]], piece_len: int) -> None:
+	global _files, _offsets, _piece_len
+	_files, _piece_len = files, piece_len
+	_offsets = [offset for _, offset, _ in files]
+
+
+def _map(index: int):
+	"""Memory map of file `index`, None if it is missing or empty"""
+	if index not in _maps:
+		path = _files[index][0]
+		try:
+			with open(path, 'rb') as file:
+				_maps[index] = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+		except (FileNotFoundError, ValueError, OSError):
+			# mmap refuses empty files
+			_maps[index] = None
+	return _maps[index]
+
+
+def _segments(start: int, end: int):
+	"""Yields the file index, offset within the file and length of the parts of the torrent range [start, end)"""
+	for index in range(max(bisect_right(_offsets, start) - 1, 0), len(_files)):
+		_, offset, size = _files[index]
+		if offset >= end: break
+		if offset + size <= start or not size: continue
+		first = max(start, offset)
+		yield index, first - offset, min(end, offset + size) - first
+
+
+def _check_pieces(first: int, end: int, hashes: list[bytes]) -> list[bool]:
+	"""Hashes the pieces from `first` on, the torrent ends at `end`, and compares them with `hashes`"""
+	results = list()
+	for num, expected in enumerate(hashes, first):
+		start = num * _piece_len
+		hasher, complete = hashlib.sha1(), True
+		for index, offset, length in _segments(start, min(start + _piece_len, end)):
+			data = _map(index)
+			if data is None or len(data) < offset + length:
+				complete = False
+				break
+			hasher.update(memoryview(data)[offset:offset + length])
+		results.append(complete and hasher.digest() == expected)
+	return results
+
+
+
+class PieceChecker:
+	"""
+	Checks the data of a torrent on disk against its piece hashes.
+
+	The files are memory mapped in a pool of worker processes, so that
+	pieces are hashed on every CPU core without being copied between
+	processes. Pieces spanning several files are put together from the
+	offsets of the files in the FileTree. Every worker checks batches of
+	consecutive pieces worth about BATCH_SIZE bytes, and run() reports the
+	progress as the batches finish. Pieces whose data is missing or
+	truncated count as not verified.
+
+	torrent_info: dict
+		Info of the torrent, with 'name', 'piece_len', 'size' and 'piece_hashmap'
+	files: FileTree
+		Files of the torrent
+	workers: int
+		Number of worker processes, defaults to the number of CPUs
+	"""
+	BATCH_SIZE = 64 * 2 ** 20
+
+	def __init__(self, torrent_info: dict, files, workers: int = None) -> None:
+		self.piece_len = torrent_info['piece_len']
+		self.size = torrent_info['size']
+		self.piece_hashmap = torrent_info['piece_hashmap']
+		self.workers = workers or os.cpu_count() or 1
+
+		storage = Storage(torrent_info, files)
+		self.files = list()
+		for file in files:
+			self.files.append((str(storage.path(file)), file.offset, file.size))
+
+		self.total = len(self.piece_hashmap)
+		# Pieces which have been checked, and those which matched their hash
+		self.checked = 0
+		self.verified = BitArray(self.total)
+
+
+	def __repr__(self):
+		return f"PieceChecker({self.checked}/{self.total} checked, {self.verified.count(1)} verified)"
+
+
+	async def run(self) -> int:
+		"""Checks every piece, yielding the number of pieces checked whenever a batch is done"""
+		loop = asyncio.get_running_loop()
+		per_batch = max(self.BATCH_SIZE // self.piece_len, 1)
+
+		pool = ProcessPoolExecutor(self.workers, initializer=_init_worker, initargs=(self.files, self.piece_len))
+
+		async def check_batch(first: int, hashes: list[bytes]) -> tuple[int, list[bool]]:
+			return first, await loop.run_in_executor(pool, _check_pieces, first, self.size, hashes)
+
+		batches = list()
+		for first in range(0, self.total, per_batch):
+			hashes = [self.piece_hashmap[num] for num in range(first, min(first + per_batch, self.total))]
+			batches.append(asyncio.ensure_future(check_batch(first, hashes)))
+
+		try:
+			for done in asyncio.as_completed(batches):
+				first, results = await done
+				for num, valid in enumerate(results, first):
+					if valid: self.verified.set(True, num)
+				self.checked += len(results)
+				yield self.checked
+		finally:
+			for batch in batches: batch.cancel()
+			# Batches being hashed are left to finish in the background instead of blocking the event loop
+			pool.shutdown(wait=False, cancel_futures=True)
+
+		logger.info(f"Checked {self}")
+
+
+	async def check(self) -> BitArray:
+		"""Checks every piece and returns the bitfield of the verified ones"""
+		async for _ in self.run(): ...
+		return self.verified
@@ -0,0 +1,122 @@
+import time
+import asyncio
+import logging
+from functools import partial
+
+from aiotorrent.core.util import BLOCK_SIZE, MIN_REQUEST_QUEUE, MAX_REQUEST_QUEUE, REQUEST_QUEUE_TIME
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class RequestPipeline:
+	"""
+	Window of outstanding block requests for a single peer.
+
+	The depth of the window follows the bandwidth-delay product of the peer:
+	enough requests are kept in flight to cover one round trip plus
+	REQUEST_QUEUE_TIME seconds worth of data at the measured download rate.
+	Until the first rate sample exists the window grows by one request for
+	every block received, and it is halved whenever a request times out.
+	"""
+	# Rate samples are taken over at least this many seconds of activity
+	RATE_INTERVAL = 1
+	# Weight of a new sample in the moving averages
+	ALPHA = 0.3
+
+	def __init__(self, min_depth: int = MIN_REQUEST_QUEUE, max_depth: int = MAX_REQUEST_QUEUE) -> None:
+		self.min_depth = min_depth
+		self.max_depth = max_depth
+		self.depth = min_depth
+		self.outstanding = 0
+
+		self.rate = 0.0		# Download rate in bytes per second
+		self.rtt = None		# Smoothed request round trip time in seconds
+		self.min_rtt = None	# Lowest round trip time observed, i.e. without queueing delay
+
+		self._slot_freed = asyncio.Event()
+		self._sample_bytes = 0
+		self._sample_start = time.monotonic()
+		self._idle_since = self._sample_start
+
+
+	def __repr__(self):
+		return f"RequestPipeline({self.outstanding}/{self.depth})"
+
+
+	async def acquire(self, wanted: int = 1) -> int:
+		"""
+		Waits until the window has room and reserves up to `wanted` slots.
+		Returns the number of slots reserved, which is at least one.
+		"""
+		while self.outstanding >= self.depth:
+			self._slot_freed.clear()
+			await self._slot_freed.wait()
+
+		# Time spent without any request in flight does not count towards the rate
+		if self.outstanding == 0:
+			self._sample_start += time.monotonic() - self._idle_since
+
+		slots = min(wanted, self.depth - self.outstanding)
+		self.outstanding += slots
+		return slots
+
+
+	def release(self, slots: int) -> None:
+		"""Gives back slots which were reserved with acquire() but not used for a request"""
+		self.outstanding = max(self.outstanding - slots, 0)
+		if self.outstanding == 0: self._idle_since = time.monotonic()
+		self._slot_freed.set()
+
+
+	def track(self, future: asyncio.Future, length: int) -> None:
+		"""Releases the slot held by the request behind `future` once it finishes"""
+		future.add_done_callback(partial(self._release, time.monotonic(), length))
+
+
+	def _release(self, requested_at: float, length: int, future: asyncio.Future) -> None:
+		now = time.monotonic()
+		self.outstanding = max(self.outstanding - 1, 0)
+		if self.outstanding == 0: self._idle_since = now
+
+		# A cancelled request timed out or was abandoned
+		if future.cancelled():
+			self.depth = max(self.depth // 2, self.min_depth)
+
+		# A request resolved to None was withdrawn because another peer sent the block first
+		elif future.exception() is None and future.result() is not None:
+			self._update_rtt(now - requested_at)
+			self._update_rate(now, length)
+			self._resize()
+
+		self._slot_freed.set()
+
+
+	def _update_rtt(self, rtt: float) -> None:
+		self.rtt = rtt if self.rtt is None else (1 - self.ALPHA) * self.rtt + self.ALPHA * rtt
+		self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+
+
+	def _update_rate(self, now: float, length: int) -> None:
+		self._sample_bytes += length
+		elapsed = now - self._sample_start
+		if elapsed < self.RATE_INTERVAL:
+			return
+
+		sample = self._sample_bytes / elapsed
+		self.rate = sample if not self.rate else (1 - self.ALPHA) * self.rate + self.ALPHA * sample
+		self._sample_bytes = 0
+		self._sample_start = now
+
+
+	def _resize(self) -> None:
+		if not self.rate:
+			# Slow start until the first rate sample is available
+			depth = self.depth + 1
+		else:
+			# The minimum RTT is used so that queueing delay caused by a deep window does not inflate it further
+			queue_time = self.min_rtt + REQUEST_QUEUE_TIME
+			depth = int(self.rate * queue_time / BLOCK_SIZE)
+
+		self.depth = min(max(depth, self.min_depth), self.max_depth)
@@ -2,7 +2,9 @@ import logging
 from struct import unpack
 from bitstring import BitArray
 
-from aiotorrent.core.util import Block
+import fastbencode
+
+from aiotorrent.core.util import Block, BLOCK_SIZE, FAST_EXTENSION, EXTENSION_PROTOCOL
 
 
 logger = logging.getLogger(__name__)
@@ -10,50 +12,84 @@ logger.addHandler(logging.NullHandler())
 
 
 class PeerResponseHandler:
+	"""
+	Applies the messages decoded by the PeerResponseParser to the peer.
+
+	Messages are handled one after the other in the order they arrived, so
+	that blocks sent before a choke reach their requests before the choke
+	withdraws them, and the last of several choke and unchoke messages wins.
+	Blocks are handed to the peer as they come up, see Peer.receive_block().
+
+	artifacts: list[tuple]
+		(message name, value) pairs returned by PeerResponseParser.parse()
+	"""
 	def __init__(self, artifacts, Peer=None):
 		self.artifacts = artifacts
 		self.Peer = Peer
 
+		self.handlers = {
+			'keep_alive': self.handle_keep_alive,
+			'choke': self.handle_choke,
+			'unchoke': self.handle_unchoke,
+			'handshake': self.handle_handshake,
+			'bitfield': self.handle_bitfield,
+			'have_all': self.handle_have_all,
+			'have_none': self.handle_have_none,
+			'have': self.handle_have,
+			'interested': self.handle_interested,
+			'not_interested': self.handle_not_interested,
+			'request': self.handle_request,
+			'cancel': self.handle_cancel,
+			'port': self.handle_port,
+			'suggest': self.handle_suggest,
+			'reject': self.handle_reject,
+			'allowed_fast': self.handle_allowed_fast,
+			'extended': self.handle_extended,
+			'piece': self.handle_piece,
+		}
 
-	async def handle(self):
 
-		if logger.isEnabledFor(logging.DEBUG):
-			for key, value in self.artifacts.items():
-				if isinstance(value, bytes):
-					logger.debug(f"{key}: {value[:32]}")
+	async def handle(self) -> list[Block]:
+		"""Handles every message in order and returns the blocks among them"""
+		blocks = list()
+		for name, value in self.artifacts:
+			if logger.isEnabledFor(logging.DEBUG) and isinstance(value, bytes):
+				logger.debug(f"{name}: {value[:32]}")
 
-		while self.artifacts:
-			if "keep_alive" in self.artifacts: self.handle_keep_alive() 
-			if "choke" in self.artifacts: await self.handle_choke()
-			if "unchoke" in self.artifacts: self.handle_unchoke()
-			if "handshake" in self.artifacts: await self.handle_handshake()
-			# Merged have_handler into bitfield_handler
-			if "have" in self.artifacts: self.handle_bitfield()
-			if "bitfield" in self.artifacts: self.handle_bitfield()
-			# Piece handler is special as it returns values
-			if "pieces" in self.artifacts: return self.handle_piece()
+			result = self.handlers[name](value)
+			# The handshake is the only message whose handler has to wait for the peer
+			if name == 'handshake': await result
+			elif name == 'piece': blocks.append(result)
 
+		self.artifacts = list()
+		return blocks
 
 
-	def handle_keep_alive(self):
+	def handle_keep_alive(self, _):
 		logger.debug(f'Keep-Alive from {self.Peer}')
-		self.artifacts.pop('keep_alive')
 
 
-	async def handle_choke(self):
-		await self.Peer.disconnect(f"Choked client!")
-		self.artifacts.pop('choke')
+	def handle_choke(self, _):
+		# The connection is kept open. The peer discards our outstanding requests,
+		# so they are withdrawn and left to other peers until we are unchoked again.
+		# With the Fast Extension every discarded request is rejected explicitly instead.
+		self.Peer.choking_me = True
+		self.Peer.unchoked.clear()
+		if not self.Peer.supports_fast:
+			self.Peer.withdraw_requests()
+		logger.debug(f"Choke from {self.Peer}")
+		self.Peer.publish('choke')
 
 
-	def handle_unchoke(self):
+	def handle_unchoke(self, _):
 		self.Peer.choking_me = False
 		self.Peer.am_interested = True
+		self.Peer.unchoked.set()
 		logger.debug(f"Unchoke from {self.Peer}")
-		self.artifacts.pop('unchoke')
+		self.Peer.publish('unchoke')
 
 
-	async def handle_handshake(self):
-		message = self.artifacts['handshake']
+	async def handle_handshake(self, message):
 		if not message or len(message) < 68:
 			# if empty or no response, peer is inactive
 			# if response is less than 68, wrong response by peer
@@ -74,47 +110,126 @@ class PeerResponseHandler:
 
 		self.Peer.has_handshaked = True
 		self.Peer.handshake_response = handshake_response
+		self.Peer.supports_fast = bool(res & FAST_EXTENSION)
+		self.Peer.supports_extensions = bool(res & EXTENSION_PROTOCOL)
 
 		logger.debug(f"Handshake from {self.Peer}")
-		self.artifacts.pop('handshake')
 
 
-	def handle_bitfield(self):
-		# Create bitfield from bitfield message if available
-		# If not available, create empty bitfield_message
-		if 'bitfield' in self.artifacts:
-			message = self.artifacts['bitfield']
-			pieces = BitArray(message)
-		else:
-			num_pieces = len(self.Peer.torrent_info['piece_hashmap'])
-			pieces = BitArray(num_pieces)
+	def handle_bitfield(self, message):
+		# The bitfield is padded to a whole number of bytes, so it may hold
+		# more bits than there are pieces in the torrent
+		num_pieces = len(self.Peer.torrent_info['piece_hashmap'])
+		pieces = BitArray(num_pieces)
+		bitfield = BitArray(message)[:num_pieces]
+		pieces.overwrite(bitfield, 0)
+		self._set_pieces(pieces)
+
+
+	def handle_have_all(self, _):
+		# Fast Extension replacement of a bitfield with every piece set
+		num_pieces = len(self.Peer.torrent_info['piece_hashmap'])
+		self._set_pieces(~BitArray(num_pieces))
+
 
-		# Merge have requests if available
-		if 'have' in self.artifacts:
-			for piece_num in self.artifacts['have']:
-				pieces[piece_num] = True
+	def handle_have_none(self, _):
+		num_pieces = len(self.Peer.torrent_info['piece_hashmap'])
+		self._set_pieces(BitArray(num_pieces))
 
-		# Finally set Peer pieces value to local pieces value
+
+	def _set_pieces(self, pieces):
 		self.Peer.pieces = pieces
+		self.Peer.has_bitfield = True
+		self.Peer.bitfield_received.set()
+		logger.debug(f"Bitfield from {self.Peer}")
+		self.Peer.publish('bitfield', pieces)
+
+
+	def handle_have(self, piece_num):
+		# Have messages update the bitfield we already know of
+		if piece_num >= len(self.Peer.torrent_info['piece_hashmap']): return
+		self.Peer.update_piece_info(piece_num, True)
+		self.Peer.publish('have', piece_num)
+		logger.debug(f"Have #{piece_num} from {self.Peer}")
+
+
+	def handle_interested(self, _):
+		self.Peer.peer_interested = True
+
+
+	def handle_not_interested(self, _):
+		self.Peer.peer_interested = False
+
+
+	def handle_request(self, request):
+		# Uploading is not supported yet, requests from the peer are ignored
+		index, offset, length = request
+		logger.debug(f"{self.Peer} requested Block #{index}-{offset // BLOCK_SIZE} ({length})")
+
+
+	def handle_cancel(self, _):
+		...
+
+
+	def handle_port(self, port):
+		self.Peer.dht_port = port
+		logger.debug(f"{self.Peer} listens for DHT on port {self.Peer.dht_port}")
+
+
+	def handle_suggest(self, piece_num):
+		# Suggestions are not used for picking pieces
+		logger.debug(f"{self.Peer} suggests Piece #{piece_num}")
+
+
+	def handle_reject(self, reject):
+		index, offset, length = reject
+		logger.debug(f"{self.Peer} rejected Block #{index}-{offset // BLOCK_SIZE}")
+		self.Peer.reject_request(index, offset)
+
+
+	def handle_allowed_fast(self, piece_num):
+		# Pieces which may be requested even while the peer chokes us
+		if piece_num < len(self.Peer.torrent_info['piece_hashmap']):
+			self.Peer.allowed_fast.add(piece_num)
+		logger.debug(f"Allowed fast pieces from {self.Peer}: {self.Peer.allowed_fast}")
+
+
+	def handle_extended(self, extended):
+		names = {extended_id: name for name, extended_id in self.Peer.EXTENSIONS.items()}
+		extended_id, payload = extended
+		# Id 0 is the extension handshake, every other id is one we assigned in ours
+		if extended_id == 0:
+			self.handle_extension_handshake(payload)
+		elif extended_id in names:
+			self.Peer.publish('extended', names[extended_id], payload)
+		else:
+			logger.debug(f"Unknown extended message {extended_id=} from {self.Peer}")
+
+
+	def handle_extension_handshake(self, payload):
 		try:
-			if 'have' in self.artifacts: self.artifacts.pop('have')
-			if 'bitfield' in self.artifacts: self.artifacts.pop('bitfield')
-		except KeyError:
-			...
-		finally:
-			logger.debug(f"Bitfield from {self.Peer}")
+			message = fastbencode.bdecode(bytes(payload))
+			extensions = {
+				name.decode(): extended_id for name, extended_id in message.get(b'm', dict()).items()
+				# An id of 0 means that the extension has been disabled
+				if isinstance(extended_id, int) and extended_id
+			}
+		except (ValueError, AttributeError, UnicodeDecodeError) as E:
+			logger.warning(f"Malformed extension handshake from {self.Peer}: {E}")
+			return
 
+		self.Peer.extensions = extensions
+		logger.debug(f"Extensions of {self.Peer}: {extensions}")
 
-	def handle_piece(self):
+
+	def handle_piece(self, block_info):
 		# This is the only method which returns any value
-		blocks = list()
-		for block_info in self.artifacts['pieces']:
-			try:
-				index, offset, data = block_info
-				block = Block(index, offset, data)
-				blocks.append(block)
-			except TypeError:
-				raise TypeError(f"Handler: Failed To Extract Piece sent by {self.Peer}")
-			
-		self.artifacts.pop('pieces')
-		return blocks
+		try:
+			index, offset, data = block_info
+			block = Block(index, offset, data)
+		except TypeError:
+			raise TypeError(f"Handler: Failed To Extract Piece sent by {self.Peer}")
+
+		# Handed to the request waiting for it straight away, before any later choke withdraws it
+		if self.Peer is not None: self.Peer.receive_block(block)
+		return block
@@ -1,5 +1,5 @@
 import logging
-from struct import unpack
+from struct import unpack_from
 from struct import error as UnpackError
 
 
@@ -7,120 +7,221 @@ logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+HANDSHAKE_LEN = 68
+
+
 class PeerResponseParser:
-	def __init__(self, response):
-		self.response = response
-		
+	"""
+	Incremental parser for the peer wire protocol.
+
+	Bytes are appended with feed() and every complete message is decoded by
+	parse(), which returns (message name, value) pairs in the order the
+	messages arrived, so that e.g. blocks received before a choke are still
+	handled before it. The parser keeps a read offset into its buffer instead of slicing
+	consumed messages off the front, and block payloads are handed out as
+	memoryviews into the buffer, so a reply is never copied while parsing.
+	An incomplete message at the end of the buffer is kept until the rest of
+	it has been fed.
+
+	response: bytes
+		Optional initial data, kept for backwards compatibility with the
+		Parser(response).parse() usage
+	"""
+	def __init__(self, response=b''):
+		self._buffer = b''
+		self._offset = 0
+
 		self.messages = {
-		# self created index. Does not necessarily follow bittorrent protocol specification
 			0: self.parse_choke,
 			1: self.parse_unchoke,
+			2: self.parse_interested,
+			3: self.parse_not_interested,
 			4: self.parse_have,
 			5: self.parse_bitfield,
+			6: self.parse_request,
 			7: self.parse_piece,
-			19: self.parse_handshake,
-			None: self.parse_keep_alive
+			8: self.parse_cancel,
+			9: self.parse_port,
+			# BEP 6 Fast Extension
+			13: self.parse_suggest,
+			14: self.parse_have_all,
+			15: self.parse_have_none,
+			16: self.parse_reject,
+			17: self.parse_allowed_fast,
+			20: self.parse_extended,
 		}
-		self.artifacts = dict()
+		self.artifacts = list()
+
+		if response: self.feed(response)
+
+
+	def feed(self, data) -> None:
+		"""
+		Appends `data` to the buffer. The parser takes ownership of `data`,
+		it must not be modified by the caller afterwards.
+		"""
+		# Nothing left over from earlier reads, parse straight out of the new chunk
+		if self._offset >= len(self._buffer):
+			self._buffer, self._offset = data, 0
+			return
+
+		if isinstance(self._buffer, bytearray):
+			try:
+				del self._buffer[:self._offset]
+				self._buffer += data
+				self._offset = 0
+				return
+			# Blocks handed out earlier still reference the buffer, so it cannot be resized
+			except BufferError:
+				...
+
+		# Only the incomplete tail is copied into a new buffer
+		buffer = bytearray(memoryview(self._buffer)[self._offset:])
+		buffer += data
+		self._buffer, self._offset = buffer, 0
+
+
+	def pending(self) -> int:
+		"""Returns the number of buffered bytes which do not form a complete message yet"""
+		return len(self._buffer) - self._offset
+
+
+	def parse(self) -> list[tuple]:
+		buffer = memoryview(self._buffer)
+		end = len(buffer)
 
+		while self._offset < end:
+			start = self._offset
 
-	def parse(self):
+			# If the first byte is 19, it's a handshake. The length prefix of
+			# every other message starts with a zero byte.
+			if buffer[start] == 19:
+				if end - start < HANDSHAKE_LEN: break
+				self.parse_handshake(buffer[start:start + HANDSHAKE_LEN])
+				self._offset = start + HANDSHAKE_LEN
+				continue #	issue #1
+
+			if end - start < 4: break
+			message_len = unpack_from('>I', buffer, start)[0]
+			message_end = start + 4 + message_len
+			if message_end > end: break
+
+			self._offset = message_end
+
+			# keep-alive messages have length 0 and no message_id
+			if message_len == 0:
+				self.parse_keep_alive()
+				continue
+
+			payload = buffer[start + 4:message_end]
+			message_id = payload[0]
+			if logger.isEnabledFor(logging.DEBUG):
+				logger.debug(f"{message_len=}, {message_id=}, {bytes(payload[:16])=}")
+
+			# Unknown messages are skipped, their length tells us where the next one starts
+			if message_id not in self.messages:
+				logger.warning(f"{message_id=}, {message_len=}, {bytes(payload[:16])}")
+				continue
 
-		while self.response:
 			try:
-				# if first byte of response is 19 bytes, it's a handshake
-				if self.response[0] == 19:
-					self.parse_handshake()
-					continue #	issue #1
-
-				# message len and id need to be class wide accessible because message len
-				# needs to be updated in case of a bitfield and piece requests
-				self.message_len = unpack('>I', self.response[:4])[0]
-				self.message_id = unpack('>B', self.response[4:5])[0] if self.message_len != 0 else None
-					
-				# keep-alive messages have length 0 and no message_id
-				if self.message_len == 0 and not self.message_id: self.parse_keep_alive()
-
-				# if msg id not in message index, clear response
-				if self.message_id not in self.messages:
-					logger.warning(f"{self.message_id=}, {self.message_len=}, {self.response[:16]}")
-					self.response = bytes()
-
-				# finally parse the blob of response
-				logger.debug(f"{self.message_len=}, {self.message_id=}, {self.response[:16]=}")
-				self.messages[self.message_id]()
-
-			# In case of general exception, clear the response
-			except Exception as E:
-				logger.warning(f"Parser: {E}")
-				self.response = bytes()
-			
-		return self.artifacts
-
-		
+				self.messages[message_id](payload)
+			except (IndexError, UnpackError) as E:
+				logger.warning(f"Parser: Malformed message {message_id=}, {message_len=}: {E}")
+
+		artifacts, self.artifacts = self.artifacts, list()
+		return artifacts
+
+
 	def parse_keep_alive(self):
-		# keep-alive
-		message = self.response[:4]
-		self.response = self.response[4:]
-		self.artifacts.update({'keep_alive': True})
-		
-	
-	def parse_choke(self):
+		self.artifacts.append(('keep_alive', True))
+
+
+	def parse_choke(self, payload):
 		# client got choked by peer
-		message = self.response[:5]
-		self.response = self.response[5:]
-		self.artifacts.update({'choke': True})
-		
-		
-	def parse_unchoke(self):
-		message = self.response[:5]
-		self.response = self.response[5:]
-		self.artifacts.update({'unchoke': True})
-		
-		
-	def parse_have(self):
-		message = self.response[:9]
-		# We just need the piece index so we can ignore the first 5 bytes of message.
+		self.artifacts.append(('choke', True))
+
+
+	def parse_unchoke(self, payload):
+		self.artifacts.append(('unchoke', True))
+
+
+	def parse_interested(self, payload):
+		self.artifacts.append(('interested', True))
+
+
+	def parse_not_interested(self, payload):
+		self.artifacts.append(('not_interested', True))
+
+
+	def parse_have(self, payload):
+		# We just need the piece index so we can ignore the message id.
 		# Unpack returns tuple , selecting first element.
-		piece_index = unpack('>I', message[5:])[0]
-		self.response = self.response[9:]
-		self.artifacts.update({'have': {piece_index: True}})
-		
-	
-	def parse_piece(self):
-		# Returns index, offset and block except when there's
-		# an unpack error. In the second case, It raises a TypeError
-		if not 'pieces' in self.artifacts: self.artifacts['pieces'] = list()
-		block_len = self.message_len - 9
-		total = block_len + 13
-		try:
-			index, offset = unpack('>II', self.response[5: 13])
-			data = self.response[13:total]
-			block_info = (index, offset, data)
-			self.artifacts['pieces'].append(block_info)
-		except UnpackError:
-			raise TypeError("Parser: Failed to extract piece")
-		finally:
-			self.response = self.response[total:]
-		
-		
-	def parse_bitfield(self):
-		# Since bitfield len is 1+X. X is length of bitfield
-		self.message_len -= 1
-		total = self.message_len + self.message_id
-		message = self.response[5:total]
-		self.response = self.response[total:]
-		self.artifacts.update({'bitfield': message})
-		
-		
-	def parse_handshake(self):
-		# Total is 68 bytes
-		total = 68
-		message = self.response[:total]
-		self.response = self.response[total:]
-		self.artifacts.update({'handshake': message})
-
-		
+		piece_index = unpack_from('>I', payload, 1)[0]
+		self.artifacts.append(('have', piece_index))
+
+
+	def parse_bitfield(self, payload):
+		self.artifacts.append(('bitfield', bytes(payload[1:])))
+
+
+	def parse_request(self, payload):
+		# Both request and cancel messages are made of index, begin and length
+		request = unpack_from('>III', payload, 1)
+		self.artifacts.append(('request', request))
+
+
+	def parse_piece(self, payload):
+		# Returns index, offset and a view of the block
+		index, offset = unpack_from('>II', payload, 1)
+		block_info = (index, offset, payload[9:])
+		self.artifacts.append(('piece', block_info))
+
+
+	def parse_cancel(self, payload):
+		cancel = unpack_from('>III', payload, 1)
+		self.artifacts.append(('cancel', cancel))
+
+
+	def parse_port(self, payload):
+		# DHT port of the peer
+		port = unpack_from('>H', payload, 1)[0]
+		self.artifacts.append(('port', port))
+
+
+	def parse_suggest(self, payload):
+		piece_index = unpack_from('>I', payload, 1)[0]
+		self.artifacts.append(('suggest', piece_index))
+
+
+	def parse_have_all(self, payload):
+		self.artifacts.append(('have_all', True))
+
+
+	def parse_have_none(self, payload):
+		self.artifacts.append(('have_none', True))
+
+
+	def parse_reject(self, payload):
+		# Rejected requests are made of index, begin and length
+		reject = unpack_from('>III', payload, 1)
+		self.artifacts.append(('reject', reject))
+
+
+	def parse_allowed_fast(self, payload):
+		piece_index = unpack_from('>I', payload, 1)[0]
+		self.artifacts.append(('allowed_fast', piece_index))
+
+
+	def parse_extended(self, payload):
+		# BEP 10: extended message id followed by the bencoded message
+		extended = (payload[1], payload[2:])
+		self.artifacts.append(('extended', extended))
+
+
+	def parse_handshake(self, message):
+		self.artifacts.append(('handshake', bytes(message)))
+
+
 
 if __name__ == "__main__":
-	...
\ No newline at end of file
+	...
@@ -0,0 +1,161 @@
+import os
+import time
+import logging
+from pathlib import Path
+
+import fastbencode
+from bitstring import BitArray
+
+from aiotorrent.core.file_utils import safe_path
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class ResumeData:
+	"""
+	Fast-resume file of a torrent, recording which pieces are on disk.
+
+	Pieces are only recorded once they have been verified and written to
+	every file they belong to. The file is a bencoded dictionary with the
+	info hash, the piece length, the bitfield of the pieces and, for every
+	file, its size and modification time when the bitfield was saved:
+
+		{'info-hash': ..., 'piece length': ..., 'pieces': ..., 'files': [{'length': ..., 'mtime': ...}]}
+
+	The pieces of a file are only trusted on startup if the size and the
+	modification time of the file are still the recorded ones. Pieces are
+	added as they are written, and the file is written to a temporary file
+	and renamed over the previous one, so a crash leaves either the old or
+	the new version.
+
+	torrent_info: dict
+		Info of the torrent, with 'name', 'info_hash', 'piece_len' and 'piece_hashmap'
+	files: FileTree
+		Files of the torrent
+	"""
+	FILENAME = '.aiotorrent.resume'
+	# Seconds between saves while downloading
+	SAVE_INTERVAL = 10
+
+	def __init__(self, torrent_info: dict, files) -> None:
+		self.info_hash = torrent_info['info_hash']
+		self.piece_len = torrent_info['piece_len']
+		self.directory = Path(safe_path(torrent_info['name']))
+		self.path = self.directory / self.FILENAME
+		self.files = files
+
+		self.pieces = BitArray(len(torrent_info['piece_hashmap']))
+		self._saved = time.monotonic()
+		self._dirty = False
+
+
+	def __repr__(self):
+		return f"ResumeData({self.pieces.count(1)}/{len(self.pieces)} pieces present)"
+
+
+	def have(self, num: int) -> bool:
+		"""True if piece `num` has been verified and written to disk"""
+		return self.pieces[num]
+
+
+	def present(self, file) -> set[int]:
+		"""Pieces of `file` which have been verified and written to disk"""
+		return {num for num in file.pieces if self.pieces[num]}
+
+
+	def add(self, num: int) -> None:
+		self.pieces.set(True, num)
+		self._dirty = True
+
+
+	def set_verified(self, verified: BitArray) -> None:
+		"""Replaces the recorded pieces with those set in `verified`"""
+		self.pieces = BitArray(verified)
+		self._dirty = True
+
+
+	def snapshot(self) -> BitArray:
+		"""
+		Copy of the recorded pieces to be saved while the download goes on.
+		Pieces added afterwards are left for the next save.
+		"""
+		self._dirty = False
+		return BitArray(self.pieces)
+
+
+	def due(self) -> bool:
+		"""True if pieces have been added since the last save, which was SAVE_INTERVAL seconds ago"""
+		return self._dirty and time.monotonic() - self._saved >= self.SAVE_INTERVAL
+
+
+	def load(self) -> bool:
+		"""Reads the resume file if there is one. Returns True if it belongs to this torrent."""
+		try:
+			data = fastbencode.bdecode(self.path.read_bytes())
+			if data[b'info-hash'] != self.info_hash or data[b'piece length'] != self.piece_len:
+				logger.info(f"Ignoring resume data of another torrent in {self.path}")
+				return False
+			entries = data[b'files']
+			if len(entries) != len(self.files): raise ValueError("File count does not match")
+			pieces = BitArray(bytes=data[b'pieces'], length=len(self.pieces))
+		except FileNotFoundError:
+			return False
+		except (ValueError, KeyError, TypeError) as E:
+			logger.warning(f"Ignoring malformed resume data in {self.path}: {E}")
+			return False
+
+		for file, entry in zip(self.files, entries):
+			if not any(pieces[num] for num in file.pieces): continue
+
+			# Files which were truncated, replaced, touched or deleted since are downloaded again
+			try:
+				stat = os.stat(self.directory / file.path)
+			except FileNotFoundError:
+				stat = None
+			if stat is None or stat.st_size != entry[b'length'] or stat.st_mtime_ns != entry[b'mtime']:
+				logger.info(f"{file} changed since the resume data was saved, its pieces are downloaded again")
+				pieces.set(False, file.pieces)
+
+		self.pieces = pieces
+		logger.info(f"Loaded {self}")
+		return True
+
+
+	def save(self, pieces: BitArray = None) -> None:
+		"""
+		Writes the resume file atomically, with `pieces` taken by snapshot()
+		or the pieces recorded now. The data of the pieces added since the
+		last save has to be flushed to the files first.
+		"""
+		if pieces is None: pieces = self.snapshot()
+
+		entries = list()
+		for file in self.files:
+			try:
+				stat = os.stat(self.directory / file.path) if any(pieces[num] for num in file.pieces) else None
+			except FileNotFoundError:
+				stat = None
+			entries.append({
+				b'length': stat.st_size if stat else 0,
+				b'mtime': stat.st_mtime_ns if stat else 0,
+			})
+
+		data = fastbencode.bencode({
+			b'info-hash': self.info_hash,
+			b'piece length': self.piece_len,
+			b'pieces': pieces.tobytes(),
+			b'files': entries,
+		})
+
+		self.directory.mkdir(exist_ok=True)
+		temporary = self.path.with_name(self.path.name + '.tmp')
+		with open(temporary, 'wb') as resume_file:
+			resume_file.write(data)
+			resume_file.flush()
+			os.fsync(resume_file.fileno())
+		os.replace(temporary, self.path)
+
+		self._saved = time.monotonic()
+		logger.debug(f"Saved {pieces.count(1)} pieces to {self.path}")
@@ -0,0 +1,245 @@
+import os
+import logging
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+
+from aiotorrent.core.file_utils import safe_path
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# Buffers passed to a single vectored write at most
+_IOV_MAX = getattr(os, 'IOV_MAX', None) or 1024
+
+
+class Storage:
+	"""
+	Files of a torrent on disk, addressed by piece.
+
+	The torrent is the concatenation of its files, so any range of a piece
+	maps to one or more segments of consecutive files. Pieces are written
+	and read whole with positional I/O (os.pwritev and os.preadv), and a
+	piece spanning several files is split across all of them at once.
+	Files are opened on first use and kept open in a pool of at most
+	MAX_OPEN_FILES descriptors, the least recently used one being closed
+	when the pool is full. The storage may be used from several threads,
+	descriptors in use by one of them are not closed.
+
+	torrent_info: dict
+		Info of the torrent, with 'name', 'piece_len' and 'size'
+	files: FileTree
+		Files of the torrent
+	directory: str
+		Directory the files are stored in, defaults to the name of the torrent
+		below the working directory
+	"""
+	MAX_OPEN_FILES = 64
+
+	def __init__(self, torrent_info: dict, files, directory: str = None) -> None:
+		self.directory = Path(directory if directory is not None else safe_path(torrent_info['name']))
+		self.piece_len = torrent_info['piece_len']
+		self.size = torrent_info['size']
+		self.files = files
+
+		self._offsets = [file.offset for file in files]
+		# Open file descriptors, least recently used first, and how many threads use each
+		self._fds = OrderedDict()
+		self._users = dict()
+		self._lock = threading.Lock()
+		# Without positional I/O a seek and the read or write after it must not
+		# be interleaved with those of another thread on the same descriptor
+		self._seek_locks = dict()
+
+
+	def __repr__(self):
+		return f"Storage({self.directory}, {len(self.files)} files, {len(self._fds)} open)"
+
+
+	def path(self, file) -> Path:
+		"""
+		Location of `file` on disk. Raises a ValueError when the path leaves
+		the download directory, e.g. through a symlink inside it.
+		"""
+		path = self.directory / file.path
+		if not path.resolve().is_relative_to(self.directory.resolve()):
+			raise ValueError(f"{file.path} is outside of {self.directory}")
+		return path
+
+
+	def piece_size(self, num: int) -> int:
+		"""Length of piece `num`, only the last piece can be shorter than the others"""
+		return min(self.piece_len, self.size - num * self.piece_len)
+
+
+	def segments(self, num: int, offset: int = 0, length: int = None) -> list[tuple]:
+		"""
+		Returns the (file, file offset, length) segments which `length` bytes
+		at `offset` within piece `num` are stored in, in order. By default
+		the rest of the piece from `offset` on is mapped.
+		"""
+		if length is None: length = self.piece_size(num) - offset
+		start = num * self.piece_len + offset
+		end = start + length
+
+		segments = list()
+		# The last file starting at or before `start`, empty files are skipped
+		for index in range(max(bisect_right(self._offsets, start) - 1, 0), len(self.files)):
+			file = self.files[index]
+			if file.offset >= end: break
+			if file.offset + file.size <= start or not file.size: continue
+			first = max(start, file.offset)
+			segments.append((file, first - file.offset, min(end, file.offset + file.size) - first))
+		return segments
+
+
+	def _acquire(self, file) -> int:
+		"""Returns a descriptor of `file`, which stays open until it is released"""
+		with self._lock:
+			if file not in self._seek_locks: self._seek_locks[file] = threading.Lock()
+			fd = self._fds.get(file)
+			if fd is not None:
+				self._fds.move_to_end(file)
+			else:
+				fd = self._fds[file] = self._open(file)
+				self._evict()
+			self._users[file] = self._users.get(file, 0) + 1
+			return fd
+
+
+	def _release(self, file) -> None:
+		with self._lock:
+			self._users[file] -= 1
+			if not self._users[file]: del self._users[file]
+			self._evict()
+
+
+	def _evict(self) -> None:
+		# Closes the least recently used descriptors which are not in use beyond the limit
+		for file in list(self._fds):
+			if len(self._fds) <= self.MAX_OPEN_FILES: break
+			if file not in self._users: os.close(self._fds.pop(file))
+
+
+	def _open(self, file) -> int:
+		path = self.path(file)
+		path.parent.mkdir(parents=True, exist_ok=True)
+		fd = os.open(path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o666)
+		# Anything beyond the end of the file was left by an earlier version of it
+		if os.fstat(fd).st_size > file.size:
+			os.ftruncate(fd, file.size)
+		return fd
+
+
+	def open(self, file) -> None:
+		"""Creates `file` if it does not exist yet, even if nothing is ever written to it"""
+		self._acquire(file)
+		self._release(file)
+
+
+	def write(self, num: int, data, offset: int = 0) -> None:
+		"""Writes `data` at `offset` within piece `num` to every file it belongs to"""
+		self.writev(num, [data], offset)
+
+
+	def writev(self, num: int, buffers: list, offset: int = 0) -> None:
+		"""
+		Writes `buffers` one after the other from `offset` within piece `num`
+		on, which may reach into the following pieces. Every file is written
+		with a single vectored call.
+		"""
+		buffers = [memoryview(buffer) for buffer in buffers]
+		total = sum(len(buffer) for buffer in buffers)
+		index, position = 0, 0
+
+		for file, file_offset, length in self.segments(num, offset, total):
+			# The parts of the buffers which belong to this segment
+			views = list()
+			while length:
+				take = min(length, len(buffers[index]) - position)
+				views.append(buffers[index][position:position + take])
+				length -= take
+				position += take
+				if position == len(buffers[index]): index, position = index + 1, 0
+
+			fd = self._acquire(file)
+			try:
+				_pwritev(fd, views, file_offset, self._seek_locks[file])
+			finally:
+				self._release(file)
+
+
+	def readinto(self, num: int, buffer, offset: int = 0) -> int:
+		"""
+		Reads piece `num` from `offset` on into `buffer`, for as long as the
+		buffer is. Returns the number of bytes read, which is less if the
+		files are shorter than they should be.
+		"""
+		buffer, position = memoryview(buffer), 0
+		for file, file_offset, length in self.segments(num, offset, len(buffer)):
+			fd = self._acquire(file)
+			try:
+				read = _pread(fd, buffer[position:position + length], file_offset, self._seek_locks[file])
+			finally:
+				self._release(file)
+			position += read
+			if read < length: break
+		return position
+
+
+	def flush(self) -> None:
+		"""Makes sure that everything written so far is on disk"""
+		with self._lock:
+			files = list(self._fds)
+		for file in files:
+			fd = self._acquire(file)
+			try:
+				os.fsync(fd)
+			finally:
+				self._release(file)
+
+
+	def close(self) -> None:
+		"""Closes every file, none of them may be in use"""
+		with self._lock:
+			while self._fds:
+				_, fd = self._fds.popitem()
+				os.close(fd)
+
+
+
+def _pwritev(fd: int, views: list[memoryview], offset: int, seek_lock: threading.Lock) -> None:
+	while views:
+		if hasattr(os, 'pwritev'):
+			written = os.pwritev(fd, views[:_IOV_MAX], offset)
+		else:
+			# Windows has no positional I/O
+			with seek_lock:
+				os.lseek(fd, offset, os.SEEK_SET)
+				written = os.write(fd, views[0])
+		offset += written
+
+		# Drop what has been written, a partial write leaves the rest of a view
+		while views and written >= len(views[0]):
+			written -= len(views[0])
+			views.pop(0)
+		if written: views[0] = views[0][written:]
+
+
+def _pread(fd: int, buffer: memoryview, offset: int, seek_lock: threading.Lock) -> int:
+	position = 0
+	while position < len(buffer):
+		if hasattr(os, 'preadv'):
+			read = os.preadv(fd, [buffer[position:]], offset + position)
+		else:
+			with seek_lock:
+				os.lseek(fd, offset + position, os.SEEK_SET)
+				chunk = os.read(fd, len(buffer) - position)
+			buffer[position:position + len(chunk)] = chunk
+			read = len(chunk)
+		if not read: break
+		position += read
+	return position
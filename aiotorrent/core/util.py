@@ -1,12 +1,21 @@
 import asyncio
 import logging
 from enum import Enum
-from pathlib import Path
 
 
 BLOCK_SIZE = 2 ** 14
-MIN_BLOCKS_PER_CYCLE = 8
-BLOCKS_PER_CYCLE = MIN_BLOCKS_PER_CYCLE
+# Bounds of the per-peer window of outstanding block requests
+MIN_REQUEST_QUEUE = 4
+MAX_REQUEST_QUEUE = 256
+# Seconds worth of data kept requested from a peer on top of one round trip
+REQUEST_QUEUE_TIME = 1
+# Seconds after which an unanswered block request is abandoned
+REQUEST_TIMEOUT = 5
+# Seconds without any requested block arriving after which a peer is considered to snub us
+SNUB_TIMEOUT = 15
+# Reserved handshake bits, counted from the least significant bit of the last reserved byte
+FAST_EXTENSION = 0x04 # BEP 6
+EXTENSION_PROTOCOL = 0x100000 # BEP 10
 
 class DownloadStrategy(Enum):
 	DEFAULT = 0
@@ -30,44 +39,6 @@ class Block:
 
 
 
-class PieceWriter:
-	def __init__(self, directory_name, file):
-		self.file = file
-		self.directory = directory_name
-		# Create a directory with the same name as torrent name to download files to
-		Path(self.directory).mkdir(exist_ok=True)
-
-
-	def __enter__(self):
-		filepath = f"{self.directory}/{self.file.name}"
-		self.target_file = open(filepath, 'wb')
-		return self
-
-
-	def write(self, piece):
-		# Zero based index of piece within the file
-		piece_index = piece.num - self.file.start_piece
-
-		# Calculate offset of piece within the file
-		# Reduce file.start_byte from offset in case the file does not start at offset 0 of the piece.
-		# In other words, the piece has parts of more than one file.
-		offset = (piece_index * piece.piece_size) - self.file.start_byte
-
-		# A negative offset means that this piece contained data for other files
-		# Reset offset to 0 in case of a negative offset
-		if offset < 0: offset = 0
-
-		# Move the file pointer to the correct offset and write the piece data
-		self.target_file.seek(offset)
-		self.target_file.write(piece.data)
-		logger.info(f"Wrote {piece} to {self.file.name}")
-
-
-	def __exit__(self, exc_type, exc_value, exc_traceback):
-		self.target_file.close()
-
-
-
 def chunk(string, size):
 	"""A function that splits a string into specified chunk size
 
@@ -85,14 +56,13 @@ def chunk(string, size):
 
 class SequentialPieceDispatcher:
 	MEMORY_LIMIT = 1024 * 1024  * 64 # 64MB
-	pieces_queue = asyncio.PriorityQueue()
-	_pieces_in_queue = 0
-	_file_piece_size = 0
 
 
 	def __init__(self, file, piece_len) -> None:
 		self.current = file.start_piece
 		self.end = file.end_piece
+		self.pieces_queue = asyncio.PriorityQueue()
+		self._pieces_in_queue = 0
 		self._file_piece_size = piece_len
 
 
@@ -0,0 +1,757 @@
+import time
+import random
+import socket
+import asyncio
+import logging
+import weakref
+from struct import Struct
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+# Packet types (BEP 29)
+ST_DATA, ST_FIN, ST_STATE, ST_RESET, ST_SYN = range(5)
+VERSION = 1
+# type and version, extension, connection_id, timestamp_microseconds,
+# timestamp_difference_microseconds, wnd_size, seq_nr, ack_nr
+HEADER = Struct('>BBHIIIHH')
+SELECTIVE_ACK = 1
+SEQ_MASK = 0xffff
+
+
+def timestamp() -> int:
+	"""Microseconds of the monotonic clock, truncated to 32 bits like in the packet headers"""
+	return int(time.monotonic() * 1_000_000) & 0xffffffff
+
+
+def seq_before(a: int, b: int) -> bool:
+	"""True if sequence number `a` comes before `b`, taking wrap-around into account"""
+	return a != b and ((b - a) & SEQ_MASK) < 0x8000
+
+
+
+class Packet:
+	"""A packet which has been sent and waits to be acknowledged"""
+	__slots__ = ('type', 'seq_nr', 'payload', 'sent_at', 'transmissions', 'lost')
+
+	def __init__(self, type: int, seq_nr: int, payload: bytes = b'') -> None:
+		self.type = type
+		self.seq_nr = seq_nr
+		self.payload = payload
+		self.sent_at = 0.0
+		self.transmissions = 0
+		# Lost packets are sent again and do not count as in flight until then
+		self.lost = False
+
+
+
+class UTPConnection(asyncio.Transport):
+	"""
+	A uTP (BEP 29) connection, presenting the transport interface of a TCP
+	connection to its asyncio protocol. Data is received into the buffer of
+	a BufferedProtocol (or passed to data_received() of a plain Protocol) in
+	order, whatever order the packets arrive in.
+
+	The send rate follows LEDBAT: the congestion window grows while the one
+	way delay measured by the other side stays below TARGET_DELAY above the
+	lowest delay seen, and shrinks when it rises above it, so uTP yields to
+	other traffic on a shared link. Lost packets are detected by timeouts,
+	duplicate acks and selective acks, and sent again.
+
+	Like with TCP, close() reports the connection as lost to the protocol
+	once everything written has been handed over. The connection lingers in
+	its endpoint until the rest has been acknowledged.
+	"""
+	# Payload bytes per packet
+	PACKET_SIZE = 1400
+	# LEDBAT parameters
+	TARGET_DELAY = 0.1
+	GAIN = 1
+	MIN_WINDOW = 2 * PACKET_SIZE
+	INITIAL_WINDOW = 16 * PACKET_SIZE
+	MAX_WINDOW = 4 * 2 ** 20
+	# Bytes of received data we are willing to buffer
+	RECEIVE_WINDOW = 2 ** 20
+	# Out of order packets further ahead than this are dropped
+	REORDER_LIMIT = 4096
+	# Retransmission timeouts in seconds
+	CONNECT_TIMEOUT = 1
+	MIN_TIMEOUT = 0.5
+	MAX_TIMEOUT = 30
+	MAX_SYN_TRANSMISSIONS = 3
+	MAX_TRANSMISSIONS = 6
+	# Seconds a closed connection waits for the FIN of the other side
+	LINGER = 5
+	TICK = 0.05
+	WRITE_HIGH_WATER = 2 ** 20
+	WRITE_LOW_WATER = 2 ** 18
+	# Data packets are acknowledged in batches of this many, or after ACK_DELAY seconds
+	ACK_EVERY = 4
+	ACK_DELAY = 0.005
+
+	def __init__(self, endpoint, address, recv_id: int, send_id: int, protocol) -> None:
+		super().__init__()
+		self._loop = asyncio.get_running_loop()
+		self.endpoint = endpoint
+		self.address = address
+		self.recv_id = recv_id
+		self.send_id = send_id
+		self._protocol = protocol
+
+		self.seq_nr = 1	# Sequence number of the next packet
+		self.ack_nr = 0	# Last packet received in order
+
+		self._inflight = dict()		# seq_nr -> Packet, in the order they were sent
+		self._bytes_in_flight = 0	# Payload bytes in flight which are not considered lost
+		self._lost = 0				# Packets in flight waiting to be sent again
+		self._send_buffer = bytearray()
+		self._reorder = dict()		# seq_nr -> payload of packets received out of order
+		self._backlog = deque()		# In order data waiting while reading is paused
+		self._backlog_size = 0
+
+		self.cwnd = self.INITIAL_WINDOW
+		self._ssthresh = self.MAX_WINDOW
+		self.peer_window = self.RECEIVE_WINDOW
+		self.rtt = None
+		self._rtt_var = 0.0
+		self.rto = self.CONNECT_TIMEOUT
+		self._delay_minima = deque()	# (minute, lowest delay) of the last two minutes
+		self._reply_micro = 0
+		self._last_ack = None
+		self._duplicate_acks = 0
+		self._last_loss = 0.0
+
+		self._connected = False
+		self._connecting = None
+		self._made = False			# connection_made() has been called
+		self._closing = False
+		self._fin_sent = False
+		self._eof_seq = None
+		self._eof = False
+		self._lost_connection = False
+		self._destroyed = False
+		self._closed_at = None
+		self._reading_paused = False
+		self._writing_paused = False
+		self._ack_timer = None
+		self._unacked = 0			# Packets received since we last sent one
+		self._timer = self._loop.call_later(self.TICK, self._tick)
+
+
+	def __repr__(self):
+		return f"UTPConnection({self.address}, {self.recv_id=}, cwnd={self.cwnd:.0f})"
+
+
+	# Transport interface
+
+	def get_extra_info(self, name, default=None):
+		if name == 'peername': return self.address
+		if name == 'sockname': return self.endpoint.address
+		return default
+
+
+	def get_protocol(self):
+		return self._protocol
+
+
+	def set_protocol(self, protocol) -> None:
+		self._protocol = protocol
+
+
+	def is_closing(self) -> bool:
+		return self._closing or self._lost_connection
+
+
+	def is_reading(self) -> bool:
+		return not self._reading_paused
+
+
+	def pause_reading(self) -> None:
+		self._reading_paused = True
+
+
+	def resume_reading(self) -> None:
+		self._reading_paused = False
+		while self._backlog and not self._reading_paused:
+			data = self._backlog.popleft()
+			self._backlog_size -= len(data)
+			self._feed(data)
+		self._check_eof()
+
+
+	def can_write_eof(self) -> bool:
+		return False
+
+
+	def get_write_buffer_size(self) -> int:
+		return len(self._send_buffer) + self._bytes_in_flight
+
+
+	def write(self, data) -> None:
+		if self.is_closing(): return
+		self._send_buffer += data
+		self._flush()
+		self._check_write_buffer()
+
+
+	def writelines(self, list_of_data) -> None:
+		if self.is_closing(): return
+		for data in list_of_data: self._send_buffer += data
+		self._flush()
+		self._check_write_buffer()
+
+
+	def close(self) -> None:
+		if self.is_closing(): return
+		self._closing = True
+		if not self._connected:
+			self._lose(None)
+			self._destroy()
+			return
+		# The FIN goes out after everything written so far
+		self._flush()
+
+
+	def abort(self) -> None:
+		if self._connected and not self._destroyed:
+			self._send(ST_RESET, self.seq_nr)
+		self._lose(None)
+		self._destroy()
+
+
+	# Sending
+
+	def _send(self, type: int, seq_nr: int, payload=b'') -> None:
+		extension, extensions = 0, b''
+		if type == ST_STATE and self._reorder:
+			extension, extensions = SELECTIVE_ACK, self._selective_ack()
+
+		connection_id = self.recv_id if type == ST_SYN else self.send_id
+		header = HEADER.pack(
+			(type << 4) | VERSION, extension, connection_id, timestamp(),
+			self._reply_micro, self._receive_window(), seq_nr, self.ack_nr,
+		)
+		self.endpoint.sendto(header + extensions + payload, self.address)
+		# Every packet acknowledges what has been received so far
+		self._unacked = 0
+
+
+	def _selective_ack(self) -> bytes:
+		# Bit i of the mask stands for packet ack_nr + 2 + i
+		mask = bytearray(4)
+		for seq_nr in self._reorder:
+			bit = (seq_nr - self.ack_nr - 2) & SEQ_MASK
+			if bit >= 8 * 64: continue
+			if bit // 8 >= len(mask): mask.extend(bytes(4 * (bit // 32 + 1) - len(mask)))
+			mask[bit // 8] |= 1 << (bit % 8)
+		return bytes((0, len(mask))) + mask
+
+
+	def _receive_window(self) -> int:
+		buffered = self._backlog_size + len(self._reorder) * self.PACKET_SIZE
+		return max(self.RECEIVE_WINDOW - buffered, 0)
+
+
+	def _queue(self, type: int, payload=b'') -> None:
+		packet = Packet(type, self.seq_nr, payload)
+		self.seq_nr = (self.seq_nr + 1) & SEQ_MASK
+		self._inflight[packet.seq_nr] = packet
+		self._bytes_in_flight += len(payload)
+		self._transmit(packet)
+
+
+	def _transmit(self, packet: Packet) -> None:
+		if packet.lost:
+			packet.lost = False
+			self._lost -= 1
+			self._bytes_in_flight += len(packet.payload)
+		packet.sent_at = time.monotonic()
+		packet.transmissions += 1
+		self._send(packet.type, packet.seq_nr, packet.payload)
+
+
+	def _can_send(self, size: int) -> bool:
+		# One packet may always be in flight, even if the other side advertises no window
+		window = min(self.cwnd, self.peer_window)
+		return not self._bytes_in_flight or self._bytes_in_flight + size <= window
+
+
+	def _flush(self) -> None:
+		if not self._connected or self._destroyed: return
+
+		if self._lost:
+			for packet in list(self._inflight.values()):
+				if not packet.lost: continue
+				if not self._can_send(len(packet.payload)): return
+				self._transmit(packet)
+
+		while self._send_buffer:
+			size = min(len(self._send_buffer), self.PACKET_SIZE)
+			if not self._can_send(size): break
+			payload = bytes(self._send_buffer[:size])
+			del self._send_buffer[:size]
+			self._queue(ST_DATA, payload)
+
+		if self._closing and not self._send_buffer and not self._fin_sent:
+			self._queue(ST_FIN)
+			self._fin_sent = True
+			self._closed_at = time.monotonic()
+			# Everything has been handed over, the rest is up to the connection
+			self._lose(None)
+
+		self._check_write_buffer()
+
+
+	def _check_write_buffer(self) -> None:
+		size = len(self._send_buffer)
+		if not self._writing_paused and size > self.WRITE_HIGH_WATER:
+			self._writing_paused = True
+			self._protocol.pause_writing()
+		elif self._writing_paused and size <= self.WRITE_LOW_WATER:
+			self._writing_paused = False
+			self._protocol.resume_writing()
+
+
+	def _schedule_ack(self, now: bool = False) -> None:
+		# The event loop hands us one datagram at a time, so acks are delayed to batch them.
+		# Anything out of the ordinary is acknowledged right away.
+		self._unacked += 1
+		if now or self._unacked >= self.ACK_EVERY:
+			if self._ack_timer is not None: self._ack_timer.cancel()
+			self._ack_timer = self._loop.call_soon(self._send_ack)
+		elif self._ack_timer is None:
+			self._ack_timer = self._loop.call_later(self.ACK_DELAY, self._send_ack)
+
+
+	def _send_ack(self) -> None:
+		self._ack_timer = None
+		# Packets sent in the meantime have carried the ack already
+		if self._unacked and not self._destroyed:
+			self._send(ST_STATE, self.seq_nr)
+
+
+	# Receiving
+
+	def packet_received(self, type: int, sent_at: int, delay: int, window: int, seq_nr: int, ack_nr: int, selective_ack, payload) -> None:
+		"""Handles a packet sent to this connection, called by the endpoint"""
+		if self._destroyed: return
+		now = time.monotonic()
+		self._reply_micro = (timestamp() - sent_at) & 0xffffffff
+		self.peer_window = window
+
+		if type == ST_RESET:
+			self._lose(ConnectionResetError(f"{self} has been reset"))
+			self._destroy()
+			return
+
+		# The other side did not get our answer to its SYN
+		if type == ST_SYN:
+			self._schedule_ack(now=True)
+			return
+
+		if not self._connected:
+			if type != ST_STATE: return
+			self._connected = True
+			self.ack_nr = (seq_nr - 1) & SEQ_MASK
+			self._made = True
+			self._protocol.connection_made(self)
+			if not self._connecting.done(): self._connecting.set_result(None)
+
+		self._on_ack(ack_nr, selective_ack, delay, now, type == ST_STATE)
+		if type in (ST_DATA, ST_FIN): self._receive(type, seq_nr, payload)
+		self._flush()
+
+		# Done once the FIN of both sides has gone through
+		if self._fin_sent and not self._inflight and self._eof_seq is not None and not self._reorder:
+			self._destroy()
+
+
+	def _on_ack(self, ack_nr: int, selective_ack, delay: int, now: float, is_state: bool) -> None:
+		acked = 0
+		while self._inflight:
+			packet = next(iter(self._inflight.values()))
+			if seq_before(ack_nr, packet.seq_nr): break
+			acked += self._acknowledge(packet, now)
+
+		if selective_ack:
+			acked += self._on_selective_ack(ack_nr, selective_ack, now)
+
+		# Three acks for the same packet while more is in flight mean the next one got lost
+		if acked or not is_state or ack_nr != self._last_ack or not self._inflight:
+			self._duplicate_acks = 0
+		else:
+			self._duplicate_acks += 1
+			if self._duplicate_acks == 3:
+				self._mark_lost(next(iter(self._inflight.values())))
+				self._on_loss(now)
+		self._last_ack = ack_nr
+
+		if acked: self._congestion_control(acked, delay)
+
+
+	def _acknowledge(self, packet: Packet, now: float) -> int:
+		del self._inflight[packet.seq_nr]
+		if packet.lost:
+			self._lost -= 1
+		else:
+			self._bytes_in_flight -= len(packet.payload)
+
+		# Packets sent more than once give ambiguous round trip times
+		if packet.transmissions == 1:
+			sample = now - packet.sent_at
+			if self.rtt is None:
+				self.rtt, self._rtt_var = sample, sample / 2
+			else:
+				self._rtt_var += (abs(self.rtt - sample) - self._rtt_var) / 4
+				self.rtt += (sample - self.rtt) / 8
+			self.rto = min(max(self.rtt + 4 * self._rtt_var, self.MIN_TIMEOUT), self.MAX_TIMEOUT)
+		return len(packet.payload)
+
+
+	def _on_selective_ack(self, ack_nr: int, mask: bytes, now: float) -> int:
+		acked, sacked = 0, list()
+		for bit in range(len(mask) * 8):
+			if not mask[bit // 8] & (1 << (bit % 8)): continue
+			seq_nr = (ack_nr + 2 + bit) & SEQ_MASK
+			sacked.append(seq_nr)
+			if seq_nr in self._inflight:
+				acked += self._acknowledge(self._inflight[seq_nr], now)
+
+		# Packets with three or more packets acknowledged after them are considered lost
+		if len(sacked) >= 3:
+			threshold = sacked[-3]
+			lost = False
+			for packet in self._inflight.values():
+				if not seq_before(packet.seq_nr, threshold): break
+				if not packet.lost and now - packet.sent_at > (self.rtt or 0):
+					self._mark_lost(packet)
+					lost = True
+			if lost: self._on_loss(now)
+		return acked
+
+
+	def _mark_lost(self, packet: Packet) -> None:
+		if packet.lost: return
+		packet.lost = True
+		self._lost += 1
+		self._bytes_in_flight -= len(packet.payload)
+
+
+	def _on_loss(self, now: float) -> None:
+		# The window is halved at most once per round trip
+		if now - self._last_loss < (self.rtt or self.rto): return
+		self._last_loss = now
+		self.cwnd = max(self.cwnd / 2, self.MIN_WINDOW)
+		self._ssthresh = self.cwnd
+
+
+	def _congestion_control(self, acked: int, delay: int) -> None:
+		queuing_delay = 0.0
+		if delay:
+			# The lowest delay of the last two minutes is taken as the delay without queuing
+			minute = int(time.monotonic() // 60)
+			if self._delay_minima and self._delay_minima[-1][0] == minute:
+				if delay < self._delay_minima[-1][1]: self._delay_minima[-1] = (minute, delay)
+			else:
+				self._delay_minima.append((minute, delay))
+				while self._delay_minima[0][0] < minute - 1: self._delay_minima.popleft()
+			base_delay = min(lowest for _, lowest in self._delay_minima)
+			queuing_delay = (delay - base_delay) / 1_000_000
+
+		if self.cwnd < self._ssthresh and queuing_delay < self.TARGET_DELAY / 2:
+			# Slow start until a loss or the first signs of queuing
+			self.cwnd += acked
+		else:
+			self._ssthresh = min(self._ssthresh, self.cwnd)
+			off_target = (self.TARGET_DELAY - queuing_delay) / self.TARGET_DELAY
+			self.cwnd += self.GAIN * off_target * acked * self.PACKET_SIZE / self.cwnd
+		self.cwnd = min(max(self.cwnd, self.MIN_WINDOW), self.MAX_WINDOW)
+
+
+	def _receive(self, type: int, seq_nr: int, payload) -> None:
+		distance = (seq_nr - self.ack_nr - 1) & SEQ_MASK
+		self._schedule_ack(now=bool(distance) or bool(self._reorder) or type == ST_FIN)
+		if self._eof_seq is not None and seq_before(self._eof_seq, seq_nr): return
+
+		# Packets received before are only acknowledged again
+		if distance >= 0x8000 or distance >= self.REORDER_LIMIT: return
+		if type == ST_FIN: self._eof_seq = seq_nr
+
+		if distance:
+			self._reorder.setdefault(seq_nr, payload)
+			return
+
+		self._deliver(payload)
+		self.ack_nr = seq_nr
+		while (self.ack_nr + 1) & SEQ_MASK in self._reorder:
+			self.ack_nr = (self.ack_nr + 1) & SEQ_MASK
+			self._deliver(self._reorder.pop(self.ack_nr))
+		self._check_eof()
+
+
+	def _deliver(self, data) -> None:
+		if not data or self._lost_connection: return
+		if self._reading_paused or self._backlog:
+			self._backlog.append(data)
+			self._backlog_size += len(data)
+			return
+		self._feed(data)
+
+
+	def _feed(self, data) -> None:
+		if not isinstance(self._protocol, asyncio.BufferedProtocol):
+			self._protocol.data_received(bytes(data))
+			return
+
+		view = memoryview(data)
+		while view:
+			buffer = self._protocol.get_buffer(len(view))
+			size = min(len(buffer), len(view))
+			buffer[:size] = view[:size]
+			self._protocol.buffer_updated(size)
+			view = view[size:]
+			# The protocol may pause reading in the middle of a packet
+			if view and self._reading_paused:
+				self._backlog.appendleft(view)
+				self._backlog_size += len(view)
+				return
+
+
+	def _check_eof(self) -> None:
+		if self._eof or self._eof_seq != self.ack_nr or self._backlog: return
+		self._eof = True
+		if self._lost_connection: return
+		if not self._protocol.eof_received(): self.close()
+
+
+	# Timers and teardown
+
+	def _tick(self) -> None:
+		if self._destroyed: return
+		now = time.monotonic()
+
+		if self._closed_at is not None and now - self._closed_at > self.LINGER:
+			self._destroy()
+			return
+
+		if self._inflight:
+			packet = next(iter(self._inflight.values()))
+			if now - packet.sent_at > self.rto: self._on_timeout(packet)
+
+		if not self._destroyed:
+			self._timer = self._loop.call_later(self.TICK, self._tick)
+
+
+	def _on_timeout(self, packet: Packet) -> None:
+		limit = self.MAX_TRANSMISSIONS if self._connected else self.MAX_SYN_TRANSMISSIONS
+		if packet.transmissions >= limit:
+			self._lose(TimeoutError(f"{self} timed out"))
+			self._destroy()
+			return
+
+		if not self._connected:
+			self.rto *= 2
+			self._transmit(packet)
+			return
+
+		# Like in TCP, a timeout collapses the window and everything in flight is sent again
+		self._ssthresh = max(self.cwnd / 2, self.MIN_WINDOW)
+		self.cwnd = self.MIN_WINDOW
+		self.rto = min(self.rto * 2, self.MAX_TIMEOUT)
+		for packet in self._inflight.values(): self._mark_lost(packet)
+		self._flush()
+
+
+	def _lose(self, exc) -> None:
+		# Reports the connection as lost to the protocol, once
+		if self._lost_connection: return
+		self._lost_connection = True
+		self._closing = True
+
+		if self._connecting is not None and not self._connecting.done():
+			self._connecting.set_exception(exc or ConnectionAbortedError(f"{self} has been closed"))
+		if self._made:
+			self._loop.call_soon(self._protocol.connection_lost, exc)
+
+
+	def _destroy(self) -> None:
+		if self._destroyed: return
+		self._destroyed = True
+		self._timer.cancel()
+		if self._ack_timer is not None: self._ack_timer.cancel()
+		self.endpoint._remove(self)
+
+
+	async def _connect(self) -> None:
+		self._connecting = self._loop.create_future()
+		self._queue(ST_SYN)
+		await self._connecting
+
+
+	def _accept(self, seq_nr: int) -> None:
+		# Answer a SYN. Our first data packet gets the sequence number of the answer.
+		self._connected = True
+		self.ack_nr = seq_nr
+		self.seq_nr = random.randrange(SEQ_MASK + 1)
+		# The answer goes out before anything the protocol writes when it is told about the connection
+		self._send(ST_STATE, self.seq_nr)
+		self._made = True
+		self._protocol.connection_made(self)
+
+
+
+class UTPEndpoint(asyncio.DatagramProtocol):
+	"""
+	UDP socket shared by uTP connections, which are told apart by the address
+	and connection id of every packet. Incoming connections are accepted if a
+	protocol_factory is given, like with a server.
+	"""
+	SOCKET_BUFFER = 4 * 2 ** 20
+
+	def __init__(self, protocol_factory=None) -> None:
+		self.protocol_factory = protocol_factory
+		self.transport = None
+		self._connections = dict()	# (address, recv_id) -> UTPConnection
+
+
+	def __repr__(self):
+		return f"UTPEndpoint({self.address}, {len(self._connections)} connections)"
+
+
+	@property
+	def address(self):
+		return self.transport.get_extra_info('sockname') if self.transport else None
+
+
+	def connection_made(self, transport) -> None:
+		self.transport = transport
+		# Bursts of a whole congestion window should not overflow the socket buffers
+		sock = transport.get_extra_info('socket')
+		for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+			try:
+				sock.setsockopt(socket.SOL_SOCKET, option, self.SOCKET_BUFFER)
+			except OSError:
+				...
+
+
+	def connection_lost(self, exc) -> None:
+		for connection in list(self._connections.values()):
+			connection._lose(exc or ConnectionAbortedError("uTP socket closed"))
+			connection._destroy()
+		self.transport = None
+
+
+	def error_received(self, exc) -> None:
+		logger.debug(f"{self}: {exc}")
+
+
+	def datagram_received(self, data: bytes, address) -> None:
+		if len(data) < HEADER.size: return
+		type_version, extension, connection_id, sent_at, delay, window, seq_nr, ack_nr = HEADER.unpack_from(data)
+		type, version = type_version >> 4, type_version & 0x0f
+		if version != VERSION or type > ST_SYN: return
+
+		# Walk the chain of extensions, only selective acks are understood
+		offset, selective_ack = HEADER.size, None
+		while extension:
+			if offset + 2 > len(data): return
+			next_extension, length = data[offset], data[offset + 1]
+			if extension == SELECTIVE_ACK: selective_ack = data[offset + 2:offset + 2 + length]
+			extension, offset = next_extension, offset + 2 + length
+		payload = memoryview(data)[offset:]
+
+		connection = self._connections.get((address, connection_id))
+		if connection is None and type == ST_SYN:
+			# A SYN carries the id the initiator receives on, it sends with that id + 1
+			connection = self._connections.get((address, (connection_id + 1) & SEQ_MASK))
+			if connection is None:
+				self._accept(address, connection_id, seq_nr)
+				return
+
+		# Packets of unknown connections are dropped, they time out on the other side
+		if connection is not None:
+			connection.packet_received(type, sent_at, delay, window, seq_nr, ack_nr, selective_ack, payload)
+
+
+	def sendto(self, data: bytes, address) -> None:
+		if self.transport is not None and not self.transport.is_closing():
+			self.transport.sendto(data, address)
+
+
+	def _accept(self, address, connection_id: int, seq_nr: int) -> None:
+		if self.protocol_factory is None: return
+		recv_id = (connection_id + 1) & SEQ_MASK
+		connection = UTPConnection(self, address, recv_id, connection_id, self.protocol_factory())
+		self._connections[(address, recv_id)] = connection
+		connection._accept(seq_nr)
+		logger.debug(f"Accepted {connection}")
+
+
+	def _remove(self, connection: UTPConnection) -> None:
+		key = (connection.address, connection.recv_id)
+		if self._connections.get(key) is connection:
+			del self._connections[key]
+
+
+	async def connect(self, protocol_factory, address) -> tuple:
+		"""Opens a connection to `address`, returns (transport, protocol) like loop.create_connection()"""
+		while True:
+			recv_id = random.randrange(SEQ_MASK + 1)
+			send_id = (recv_id + 1) & SEQ_MASK
+			if (address, recv_id) not in self._connections and (address, send_id) not in self._connections:
+				break
+
+		protocol = protocol_factory()
+		connection = UTPConnection(self, address, recv_id, send_id, protocol)
+		self._connections[(address, recv_id)] = connection
+		try:
+			await connection._connect()
+		except BaseException:
+			# Also reached when the caller gives up waiting
+			connection._lose(None)
+			connection._destroy()
+			raise
+		return connection, protocol
+
+
+	def close(self) -> None:
+		if self.transport is not None: self.transport.close()
+
+
+
+# Endpoint used for outgoing connections, one per event loop
+_endpoints = weakref.WeakKeyDictionary()
+
+
+async def create_utp_endpoint(host: str = '0.0.0.0', port: int = 0, protocol_factory=None) -> UTPEndpoint:
+	"""Binds a UDP socket for uTP. Incoming connections are accepted if `protocol_factory` is given."""
+	loop = asyncio.get_running_loop()
+	_, endpoint = await loop.create_datagram_endpoint(lambda: UTPEndpoint(protocol_factory), local_addr=(host, port))
+	return endpoint
+
+
+async def open_utp_connection(protocol_factory, host: str, port: int) -> tuple:
+	"""
+	Opens a uTP connection to (host, port) from an endpoint shared by all
+	outgoing connections. Returns (transport, protocol) like loop.create_connection().
+	"""
+	if ':' in host:
+		raise OSError(f"uTP over IPv6 is not supported: {host}")
+
+	loop = asyncio.get_running_loop()
+	endpoint = _endpoints.get(loop)
+	if endpoint is None:
+		endpoint = _endpoints[loop] = loop.create_task(create_utp_endpoint())
+	try:
+		endpoint = await asyncio.shield(endpoint)
+	except OSError:
+		_endpoints.pop(loop, None)
+		raise
+	if endpoint.transport is None:
+		_endpoints.pop(loop, None)
+		return await open_utp_connection(protocol_factory, host, port)
+
+	return await endpoint.connect(protocol_factory, (host, port))
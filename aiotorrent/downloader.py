@@ -1,10 +1,17 @@
 import asyncio
 import logging
+from math import ceil
 from pathlib import Path
 
+from aiotorrent.peer import PeerChoked
 from aiotorrent.piece import Piece
+from aiotorrent.piece_picker import PiecePicker
 from aiotorrent.core.util import BLOCK_SIZE
 from aiotorrent.core.file_utils import File, FileTree
+from aiotorrent.core.piece_verifier import PieceVerifier
+from aiotorrent.core.resume import ResumeData
+from aiotorrent.core.storage import Storage
+from aiotorrent.core.disk_writer import DiskWriter
 from aiotorrent.core.util import SequentialPieceDispatcher
 
 logger = logging.getLogger(__name__)
@@ -12,7 +19,29 @@ logger.addHandler(logging.NullHandler())
 
 
 class FilesDownloadManager:
-	def __init__(self, torrent_info: dict, active_peers: list):
+	"""
+	Downloads the pieces of a file with one worker task per peer.
+
+	Every worker asks the PiecePicker for the next piece its peer has and
+	downloads it from that peer. Completed pieces are handed to the
+	PieceVerifier, which hashes them in its thread pool while the worker
+	goes on with the next piece. Pieces which could not be completed or
+	failed verification go back to the picker, so the next free peer picks
+	them up again. Pieces recorded as present in the ResumeData are not
+	downloaded again. While the cache of the DiskWriter is full, the workers
+	do not start on new pieces until the disk has caught up.
+
+	Pieces are handed out whole, also those which are shared with other
+	files, so that they can be written to every file they belong to at once.
+	"""
+	# Pieces handed out ahead of the next piece to be yielded in sequential mode
+	SEQUENTIAL_WINDOW = 10
+	# Peers are dropped once this many pieces failed verification because of them
+	MAX_HASH_FAILURES = 3
+	# Seconds after which a snubbed peer is given another chance
+	OPTIMISTIC_RETRY = 30
+
+	def __init__(self, torrent_info: dict, active_peers: list, verifier: PieceVerifier = None, resume: ResumeData = None, storage: Storage = None, disk_writer: DiskWriter = None):
 		# Extract torrent size and piece size values from torrent info
 		piece_size = torrent_info['piece_len']
 		torrent_size = torrent_info['size']
@@ -33,6 +62,7 @@ class FilesDownloadManager:
 		total_pieces -= 1
 
 		piece_info = {
+			'piece_len': piece_size,
 			'total_pieces': total_pieces,
 			'total_blocks': total_blocks,
 			'last_piece': last_piece,
@@ -42,101 +72,399 @@ class FilesDownloadManager:
 		self.piece_info = piece_info
 		self.piece_hashmap = torrent_info['piece_hashmap']
 		self.file_tree = FileTree(torrent_info)
+		self.verifier = verifier if verifier is not None else PieceVerifier()
+		self.resume = resume
+		self.storage = storage if storage is not None else Storage(torrent_info, self.file_tree)
+		self.disk_writer = disk_writer
+
+		self.picker = PiecePicker(len(self.piece_hashmap))
+		self.peers = list()
+		self._workers = dict()
+		# Tasks waiting for the hash check of a piece
+		self._verifying = set()
+		# Pieces being downloaded or put back incomplete, kept so that their blocks are not fetched again
+		self._pieces = dict()
+		# Copies of pieces which failed verification with blocks from several peers
+		self._failed = dict()
+		# Verified pieces in the order they were completed
+		self._completed = asyncio.Queue()
+		self._file = None
+		self._end = None
+		self._endgame = False
 
-		peer_def = 10   # Peer default priority
-		self.peer_queue = asyncio.PriorityQueue()
 		for peer in active_peers:
-			self.peer_queue.put_nowait((peer_def, peer))
+			self.add_peer(peer)
 
-		# Queue for storing pieces for a file
-		self.file_pieces = asyncio.PriorityQueue()
-		
 
+	def add_peer(self, peer) -> None:
+		if peer not in self.peers:
+			self.peers.append(peer)
 
-	def create_pieces_queue(self, file: File) -> None:
-		piece_def = 3   # Default piece priority
-		for piece_num in range(file.start_piece, file.end_piece + 1):
-			self.file_pieces.put_nowait((piece_def, piece_num))
+		# Peers which connect while a file is being downloaded join in straight away
+		if self._file is not None:
+			self.picker.add_peer(peer)
+			self._start_worker(peer)
 
 
-	def file_downloaded(self) -> bool:
+	def _start_worker(self, peer) -> None:
+		worker = self._workers.get(peer)
+		if not peer.active or (worker is not None and not worker.done()):
+			return
+		self._workers[peer] = asyncio.create_task(self._peer_worker(peer))
+
+
+	@staticmethod
+	def file_slice(file: File, piece: Piece) -> memoryview:
 		'''
-		Returns true if all the pieces have been downloaded, false otherwise
+		Returns a view of the part of the piece buffer which belongs to `file`,
+		so that pieces shared with other files are not copied.
 		'''
-		return True if self.file_pieces.empty() else False
+		start = file.start_byte if file.start_piece == piece.num else 0
+		end = file.end_byte if file.end_piece == piece.num else len(piece.data)
+		return memoryview(piece.data)[start:end]
 
 
-	async def get_file(self, file: File) -> Piece:
-		self.create_pieces_queue(file)
-		task_list = list()
+	def _slice_length(self, file: File, num: int) -> int:
+		"""Number of bytes of piece `num` which belong to `file`"""
+		start = file.start_byte if file.start_piece == num else 0
+		end = file.end_byte if file.end_piece == num else self.storage.piece_size(num)
+		return end - start
+
+
+	def _present(self, file: File) -> set[int]:
+		"""Pieces of `file` which are on disk already"""
+		return self.resume.present(file) if self.resume is not None else set()
 
-		while not self.file_downloaded():
-			prio_piece, num = await self.file_pieces.get()
-			piece = Piece(num, prio_piece, self.piece_info)
-			task = asyncio.create_task(piece.download(self.peer_queue))
-			task_list.append(task)
 
-		for task in asyncio.as_completed(task_list):
-			piece = await task
+	def _count_present(self, file: File, present: set[int]) -> None:
+		size = sum(self._slice_length(file, num) for num in present)
+		file._set_bytes_downloaded(file.get_bytes_downloaded() + size)
+		file._set_bytes_written(file.get_bytes_written() + size)
 
-			if not Piece.is_valid(piece, self.piece_hashmap):
-				self.file_pieces.put_nowait((1, piece.num))
+
+	async def _read_piece(self, num: int) -> Piece:
+		"""Reads piece `num` back from disk, in a thread of the DiskWriter if there is one"""
+		piece = Piece(num, 3, self.piece_info)
+		if self.disk_writer is not None:
+			await self.disk_writer.run(self.storage.readinto, num, piece.data)
+		else:
+			await asyncio.to_thread(self.storage.readinto, num, piece.data)
+		return piece
+
+
+	def file_downloaded(self) -> bool:
+		'''
+		Returns true if all the pieces have been downloaded, false otherwise
+		'''
+		return self.picker.finished()
+
+
+	async def _peer_worker(self, peer) -> None:
+		while peer.active and not self.picker.finished():
+			# Completed pieces wait in memory until they are written, so no more are downloaded meanwhile
+			if self.disk_writer is not None and self.disk_writer.full:
+				await self.disk_writer.wait_for_room()
 				continue
 
-			if file.start_piece == piece.num:
-				piece.data = piece.data[file.start_byte:]
+			end = self._end() if self._end else None
+
+			if peer.choking_me:
+				# Allowed fast pieces may be downloaded while the peer chokes us (BEP 6)
+				num = self.picker.pick(peer, end=end, only=peer.allowed_fast) if peer.allowed_fast else None
+
+				# Otherwise work resumes as soon as the peer unchokes us, the connection is kept meanwhile
+				if num is None:
+					if not await peer.wait_unchoked(): return
+					continue
+
+			else:
+				# A snubbed peer gets no work for a while. Afterwards it is given a
+				# piece again, and it stays snubbed until it sends a block.
+				if peer.snubbed:
+					logger.debug(f"Not handing out work to snubbed {peer}")
+					await asyncio.sleep(self.OPTIMISTIC_RETRY)
+					if not peer.active: return
+
+				# Blocks of pieces in progress which nobody has been asked for yet come first,
+				# so that large pieces are spread over all the peers which have them
+				piece = self._joinable_piece(peer)
+				if piece is not None:
+					await self._fetch(peer, piece, join=True)
+					continue
+
+				num = self.picker.pick(peer, end=end)
+
+				if num is None:
+					# Once every remaining piece is being downloaded, idle peers duplicate the requests
+					piece = self._endgame_piece(peer)
+					if piece is not None:
+						await self._fetch(peer, piece, join=True, duplicate=True)
+						continue
+
+					# Wait until a piece this peer has is put back, or the peer announces new pieces
+					self.picker.changed.clear()
+					await self.picker.changed.wait()
+					continue
+
+			# Blocks of a piece which was put back are not fetched again
+			piece = self._pieces.get(num)
+			if piece is None:
+				piece = self._pieces[num] = Piece(num, 3, self.piece_info)
+				# A piece which failed verification with blocks from several peers
+				# is fetched from a single peer, so that the culprit can be found
+				piece.exclusive = num in self._failed
+
+			if not await self._fetch(peer, piece):
+				self.picker.abort(num)
+				continue
 
-			if file.end_piece == piece.num:
-				piece.data = piece.data[:file.end_byte]
+			self._pieces.pop(num, None)
+			self._file._set_bytes_downloaded(
+				self._file.get_bytes_downloaded() + len(self.file_slice(self._file, piece))
+			)
+
+			# Most of the piece has been hashed as its blocks arrived in order, the rest
+			# is hashed in the pool. Waits only while the hashing queue is full.
+			hasher, unhashed = piece.unhashed()
+			result = await self.verifier.submit(unhashed, self.piece_hashmap[num], hasher)
+			task = asyncio.create_task(self._on_verified(piece, result))
+			self._verifying.add(task)
+			task.add_done_callback(self._verifying.discard)
+
+
+	async def _on_verified(self, piece: Piece, result: asyncio.Future) -> None:
+		if not await result:
+			await self._on_hash_failure(piece)
+			self.picker.abort(piece.num)
+			return
+
+		await self._trace_hash_failure(piece)
+		self.picker.done(piece.num)
+		self._completed.put_nowait(piece)
+
+
+	async def _fetch(self, peer, piece: Piece, join: bool = False, duplicate: bool = False) -> bool:
+		"""
+		Downloads the missing blocks of `piece` from `peer`. Returns True if the piece is complete.
+
+		With `join`, the peer only helps with a piece downloaded by another peer,
+		and only its share of the blocks which have not been requested yet (or
+		with `duplicate`, which have not been requested from this peer) is fetched.
+		"""
+		try:
+			if join:
+				limit = None if duplicate else self._share(peer, piece)
+				await piece.fetch_blocks(piece.gen_offsets(), peer, duplicate=duplicate, limit=limit)
+			else:
+				await piece.download(peer)
+			return piece.is_piece_complete()
+
+		except BrokenPipeError:
+			return False
+
+		except PeerChoked:
+			# The piece goes back to the picker so that other peers can continue it
+			logger.debug(f"{peer} choked us while downloading {piece}")
+			return False
+
+		except TimeoutError as E:
+			# A slow peer still has the piece, its score and snubbing keep it from getting much work
+			logger.debug(f"{peer} timed out sending {piece}: {E}")
+			return False
+
+		except IOError as E:
+			# The peer rejected the requests, leave the piece to the others
+			logger.debug(f"{peer} failed to send {piece}: {E}")
+			self.picker.forget(peer, piece.num)
+			return False
+
+
+	def _share(self, peer, piece: Piece) -> int:
+		"""
+		Returns how many of the unrequested blocks of `piece` `peer` may take,
+		in proportion to its score among the connected peers which have the piece.
+		"""
+		unrequested = len(piece.unrequested())
+		scores = {
+			other: other.score.value() for other in self.picker.index.peers_with(piece.num)
+			if other.active and not other.choking_me
+		}
+		scores[peer] = peer.score.value()
+
+		# Peers which have not been rated yet are assumed to be average
+		rated = [score for score in scores.values() if score is not None]
+		default = sum(rated) / len(rated) if rated else 1
+		scores = {other: default if score is None else score for other, score in scores.items()}
+
+		total = sum(scores.values())
+		if not total: return unrequested
+		return max(ceil(unrequested * scores[peer] / total), 1)
+
+
+	def _joinable_piece(self, peer) -> Piece:
+		"""Returns a piece in progress elsewhere with blocks nobody has been asked for, which `peer` has"""
+		for num in self.picker.in_progress_from(peer):
+			piece = self._pieces.get(num)
+			if piece is not None and not piece.exclusive and piece.unrequested():
+				return piece
+
+		return None
+
+
+	def _endgame_piece(self, peer) -> Piece:
+		"""
+		Returns a piece in progress elsewhere which `peer` can help with, if
+		every remaining piece has been handed out. Blocks already requested from
+		other peers are requested again, and the slower copy is cancelled.
+		"""
+		if not self.picker.endgame(): return None
+
+		for num in self.picker.in_progress_from(peer):
+			piece = self._pieces.get(num)
+			if piece is not None and not piece.exclusive and piece.gen_offsets() - piece.requested_from(peer):
+				if not self._endgame:
+					logger.info(f"Entering endgame for {self._file}")
+					self._endgame = True
+				return piece
+
+		return None
+
+
+	async def _on_hash_failure(self, piece: Piece) -> None:
+		suppliers = piece.suppliers()
+		logger.warning(f"{piece} from {suppliers} failed verification")
+
+		# A piece from a single peer can only be that peer's fault. Otherwise the
+		# failed copy is kept, and once the piece verifies the peers whose blocks
+		# differ from the good copy are blamed.
+		if len(suppliers) == 1:
+			await self._blame(suppliers.pop(), piece)
+		elif piece.num not in self._failed:
+			self._failed[piece.num] = piece
+
+
+	async def _trace_hash_failure(self, piece: Piece) -> None:
+		failed = self._failed.pop(piece.num, None)
+		if failed is None: return
+
+		culprits = set()
+		for block_num, peer in failed.sources.items():
+			start = block_num * BLOCK_SIZE
+			end = start + failed.block_length(start)
+			if failed.data[start:end] != piece.data[start:end]:
+				culprits.add(peer)
+
+		for peer in culprits:
+			await self._blame(peer, failed)
+
+
+	async def _blame(self, peer, piece: Piece) -> None:
+		peer.hash_failures += 1
+		peer.score.record_hash_failure()
+		logger.warning(f"{peer} sent corrupt data for {piece}, {peer.hash_failures} hash failures")
+
+		# The peer is not trusted with this piece again
+		self.picker.forget(peer, piece.num)
+		if peer.hash_failures >= self.MAX_HASH_FAILURES and peer.active:
+			peer.banned = True
+			await peer.disconnect("Peer sent too many corrupt pieces!")
+
+
+	async def _download(self, file: File, sequential: bool = False, present: set[int] = frozenset()) -> Piece:
+		"""Yields the verified pieces of `file` in the order they are completed, except those `present`"""
+		self._file = file
+		self._endgame = False
+		self.picker.sequential = sequential
+		wanted = [num for num in file.pieces if num not in present]
+		self.picker.want(wanted)
+		remaining = len(wanted)
+
+		for peer in self.peers:
+			self.picker.add_peer(peer)
+
+		# The best scoring peers get to pick first. Peers which have not been rated
+		# yet, as on a fresh start, are ranked by how many needed pieces they have.
+		index = self.picker.index
+		for peer in sorted(self.peers, key=lambda peer: (-(peer.score.value() or 0), -index.interest(peer))):
+			self._start_worker(peer)
+
+		try:
+			while remaining:
+				piece = await self._completed.get()
+				remaining -= 1
+				yield piece
+
+		finally:
+			for task in (*self._workers.values(), *self._verifying): task.cancel()
+			self._workers.clear()
+			self._verifying.clear()
+			self._pieces.clear()
+			self._failed.clear()
+			self.picker.close()
+			self._file = self._end = None
+
+
+	async def get_file(self, file: File) -> Piece:
+		present = self._present(file)
+		self._count_present(file, present)
 
-			file._set_bytes_written(file.get_bytes_written() + len(piece.data))
+		async for piece in self._download(file, present=present):
+			file._set_bytes_written(file.get_bytes_written() + self._slice_length(file, piece.num))
 			yield piece
 
-		logger.info(f"File {file} downloaded")
+		logger.info(f"File {file} downloaded, {self.verifier}")
 
 
-	async def get_file_sequential(self, file: File, piece_len) -> Piece:
-		task_list = []
+	async def _dispatch(self, dispatch_manager: SequentialPieceDispatcher, file: File, present: set[int], read: bool) -> Piece:
+		"""Yields the pieces which are next in order, reading those present on disk if `read` is set"""
+		while True:
+			if dispatch_manager.current in present:
+				num = dispatch_manager.current
+				dispatch_manager.current += 1
+				if read: yield await self._read_piece(num)
+				continue
+
+			dispatched = False
+			async for piece in dispatch_manager.dispatch():
+				dispatched = True
+				yield piece
+			if not dispatched: return
+
+
+	async def get_file_sequential(self, file: File, piece_len, include_present: bool = True) -> Piece:
+		"""
+		Yields the pieces of `file` in order. Pieces which are on disk already
+		are read back from it, or skipped unless `include_present` is set.
+		Like get_file(), whole pieces are yielded, see file_slice().
+		"""
 		dispatch_manager = SequentialPieceDispatcher(file, piece_len)
+		present = self._present(file)
+		if include_present:
+			file._set_bytes_downloaded(file.get_bytes_downloaded() + sum(self._slice_length(file, num) for num in present))
+		else:
+			self._count_present(file, present)
+
+		# Pieces are only handed out a few ahead of the next one to be yielded,
+		# which also bounds the pieces held back by the dispatcher
+		window = min(self.SEQUENTIAL_WINDOW, dispatch_manager.MEMORY_LIMIT // piece_len)
+		self._end = lambda: dispatch_manager.current + max(window, 1)
+
+		# The pieces on disk up to the first missing one are handed out before downloading
+		async for piece in self._dispatch(dispatch_manager, file, present, include_present):
+			file._set_bytes_written(file.get_bytes_written() + self._slice_length(file, piece.num))
+			yield piece
+
+		async for piece in self._download(file, sequential=True, present=present):
+			await dispatch_manager.put(piece)
+			async for piece in self._dispatch(dispatch_manager, file, present, include_present):
+				file._set_bytes_written(file.get_bytes_written() + self._slice_length(file, piece.num))
+				yield piece
 
-		self.create_pieces_queue(file)
-		max_concurrent_pieces = 10
-		sema = asyncio.Semaphore(max_concurrent_pieces)
-
-		while not self.file_downloaded():
-			async with sema:
-				await sema.acquire()
-				prio_piece, num = await self.file_pieces.get()
-				piece = Piece(num, prio_piece, self.piece_info)
-				# Passing semaphore so that piece can release it when it finishes fetching
-				# all the blocks for itself
-				task = asyncio.create_task(piece.download(self.peer_queue, _semaphore=sema))
-				task_list.append(task)
-
-				for task in task_list:
-					if not task.done():
-						break
-					else:
-						task_list.remove(task)
-						piece = task.result()
-						file._set_bytes_downloaded(file.get_bytes_downloaded() + len(piece.data))
-						# yield piece
-	
-						if not Piece.is_valid(piece, self.piece_hashmap):
-							self.file_pieces.put_nowait((1, piece.num))
-							continue
-
-						if file.start_piece == piece.num:
-							piece.data = piece.data[file.start_byte:]
-
-						if file.end_piece == piece.num:
-							piece.data = piece.data[:file.end_byte]
-							
-						await dispatch_manager.put(piece)
-						async for piece in dispatch_manager.dispatch():
-							file._set_bytes_written(file.get_bytes_written() + len(piece.data))
-							yield piece
+			# The window has moved on, let idle workers pick from it
+			self.picker.changed.set()
 
 		async for piece in dispatch_manager.drain():
-			file._set_bytes_written(file.get_bytes_written() + len(piece.data))
+			file._set_bytes_written(file.get_bytes_written() + self._slice_length(file, piece.num))
 			yield piece
+
+		logger.info(f"File {file} downloaded, {self.verifier}")
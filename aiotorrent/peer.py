@@ -1,50 +1,117 @@
+import time
 import asyncio
 import logging
+from functools import partial
+from collections import defaultdict
 from bitstring import BitArray
 
 from aiotorrent.core.response_handler import PeerResponseHandler as Handler
 from aiotorrent.core.response_parser import PeerResponseParser as Parser
+from aiotorrent.core.peer_protocol import PeerProtocol
+from aiotorrent.core.utp import open_utp_connection
+from aiotorrent.core.rate_limiter import GLOBAL_RATE_LIMITS
+from aiotorrent.core.request_pipeline import RequestPipeline
+from aiotorrent.core.peer_score import PeerScore
 from aiotorrent.core.message_generator import MessageGenerator as Generator
+from aiotorrent.core.util import SNUB_TIMEOUT
 
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 
+class PeerChoked(Exception):
+	"""Raised when blocks are requested from a peer which is choking us"""
+
+
+
 class Peer:
-	def __init__(self, address, torrent_info, priority = 10):
+	# Extensions we support (BEP 10), mapped to the extended message ids we assigned to them
+	EXTENSIONS = {'ut_pex': 1}
+
+	# Seconds to wait for a uTP connection before falling back to TCP
+	UTP_CONNECT_TIMEOUT = 1.5
+
+	def __init__(self, address, torrent_info, utp=False, rate_limits=None):
 		self.address = address
 		self.torrent_info = torrent_info
+		# Connect over uTP (BEP 29) first if enabled, and over TCP if the peer does not answer
+		self.utp = utp
+		self.protocol = None
+		# Bandwidth limits of this peer, below those of its torrent and the global ones
+		self.rate_limits = rate_limits if rate_limits is not None else GLOBAL_RATE_LIMITS.peer()
 
 		self.active = False
-		self.priority = priority
 		# self.busy = False
 		self.total_disconnects = 0
+		# Pieces which failed verification because of data sent by this peer, and
+		# whether the address must not be connected to again because of them
+		self.hash_failures = 0
+		self.banned = False
 
 		self.choking_me = True
 		self.am_interested = False
 		self.has_handshaked = False
 		self.has_bitfield = False
+		self.peer_interested = False
+		self.dht_port = None
+		# BEP 6 Fast Extension, negotiated in the handshake
+		self.supports_fast = False
+		self.allowed_fast = set()
+		# BEP 10 extension protocol, and the extended message ids assigned by the peer
+		self.supports_extensions = False
+		self.extensions = dict()
+		self.unchoked = asyncio.Event()
+		self.bitfield_received = asyncio.Event()
+		self.closed = asyncio.Event()
 
 		# create empty BitArray of length equal to total number of pieces in the torrent
 		num_pieces = len(torrent_info['piece_hashmap'])
 		self.pieces = BitArray(num_pieces)
 
+		# Block requests waiting for a piece message, keyed by (piece index, offset)
+		self._pending_blocks = dict()
+		self.pipeline = RequestPipeline()
+		self.score = PeerScore()
+		# Time since which requested blocks have been awaited without any arriving, and the
+		# time spent waiting by earlier requests which ended without a block since the last one
+		self._stalled_since = None
+		self._stalled_for = 0.0
+		self._reported_snub = False
+		# Callbacks interested in messages from this peer, keyed by event name
+		self._subscribers = defaultdict(list)
+		self._receive_task = None
+
 
 	def __repr__(self):
 		return f"Peer({self.address})"
-	
+
+
+	@property
+	def snubbed(self) -> bool:
+		"""
+		True if blocks have been awaited for more than SNUB_TIMEOUT seconds
+		since the last one arrived. Time without outstanding requests does not count.
+		"""
+		if self._stalled_since is None: return self._stalled_for > SNUB_TIMEOUT
+		return time.monotonic() - self._stalled_since > SNUB_TIMEOUT
+
 
 	def __lt__(self, other):
-		return self.priority < other.priority
+		# Better scoring peers sort first, peers which have not been rated yet last
+		return (self.score.value() or 0) > (other.score.value() or 0)
 
 
 	async def connect(self):
 		ip, port = self.address
 		try:
-			# creating connection variable for readability
-			connection = asyncio.open_connection(ip, port)
-			self.reader, self.writer = await asyncio.wait_for(connection, timeout=3)
+			if self.utp:
+				self.protocol = await self._connect_utp()
+
+			if self.protocol is None:
+				# creating connection variable for readability
+				connection = asyncio.get_running_loop().create_connection(self._protocol_factory, ip, port)
+				_, self.protocol = await asyncio.wait_for(connection, timeout=3)
 			self.active = True
 			logger.debug(f"Opened Connection to {self}")
 
@@ -57,14 +124,52 @@ class Peer:
 		except asyncio.TimeoutError: await self.disconnect("Timed out while connecting!")
 
 
+	async def _connect_utp(self):
+		# Returns the protocol of a uTP connection, or None if the peer does not speak uTP
+		ip, port = self.address
+		try:
+			connection = open_utp_connection(self._protocol_factory, ip, port)
+			_, protocol = await asyncio.wait_for(connection, timeout=self.UTP_CONNECT_TIMEOUT)
+			logger.debug(f"Connected to {self} over uTP")
+			return protocol
+		except (OSError, asyncio.TimeoutError) as E:
+			logger.debug(f"No uTP connection to {self}: {E!r}")
+			self.utp = False
+			return None
+
+
+	def _protocol_factory(self):
+		# Received data counts against the download limits
+		return PeerProtocol(bucket=self.rate_limits.download)
+
+
 	async def disconnect(self, message=''):
 		self.active = False
 		self.total_disconnects += 1
-		if hasattr(self, 'writer'):
-			await self.writer.drain()
-			self.writer.close()
-			await self.writer.wait_closed()
+		self.unchoked.clear()
+		self.closed.set()
+
+		# Fail every request still waiting on this connection so that the
+		# callers can move on to other peers instead of waiting for a timeout
+		for future in self._pending_blocks.values():
+			if not future.done():
+				future.set_exception(BrokenPipeError(f"Connection to {self} has been closed"))
+		self._pending_blocks.clear()
+
+		# The receive loop itself calls disconnect() when the peer goes away
+		if self._receive_task and self._receive_task is not asyncio.current_task():
+			self._receive_task.cancel()
+		self._receive_task = None
+
+		if self.protocol is not None:
+			try:
+				await self.protocol.drain()
+				self.protocol.close()
+				await self.protocol.wait_closed()
+			except (ConnectionResetError, ConnectionAbortedError, BrokenPipeError):
+				...
 		logger.debug(f"{self} {message} Closed Connnection")
+		self.publish('disconnect')
 
 
 	async def handshake(self):
@@ -72,75 +177,275 @@ class Peer:
 		if self.active:
 			ih = self.torrent_info['info_hash']
 			handshake_message = Generator.gen_handshake(ih)
-			response = await self.send_message(handshake_message)
+			await self.send_message(handshake_message)
+
+			try:
+				response = await asyncio.wait_for(self.protocol.read_handshake(), timeout=3)
+			except asyncio.TimeoutError:
+				return await self.disconnect("Timed out while waiting for handshake!")
+			except (asyncio.IncompleteReadError, ConnectionResetError, ConnectionAbortedError):
+				return await self.disconnect("Connection closed during handshake!")
+
 			artifacts = Parser(response).parse()
 			await Handler(artifacts, Peer=self).handle()
 
+			# Everything sent by the peer from here on is read by the receive loop
+			if self.active and self.has_handshaked:
+				self._receive_task = asyncio.create_task(self._receive_loop())
+
+			# Announce the extensions we support. Peer exchange is not allowed on private torrents.
+			if self.active and self.supports_extensions:
+				extensions = dict() if self.torrent_info.get('private') else self.EXTENSIONS
+				try:
+					await self.send_message(Generator.gen_extended_handshake(extensions))
+				except BrokenPipeError:
+					...
 
 
 	async def intrested(self):
-		# send intrested message if handshake is done and client is choked
-		if self.active and self.has_handshaked:# and not self.choking_me:
+		# send intrested message if handshake is done. The peer answers with an
+		# unchoke whenever it is ready to serve us, which sets self.unchoked
+		if self.active and self.has_handshaked:
 			interested_message = Generator.gen_interested()
-			response = await self.send_message(interested_message)
-			artifacts = Parser(response).parse()
-			await Handler(artifacts, Peer=self).handle()
+			await self.send_message(interested_message)
+			self.am_interested = True
 
 
-	async def send_message(self, message, timeout=3):
-		# Raise error if send_message() is called but peer is inactive
-		# If send_message was called and the current status of the peer is not active
-		# This means that this peer dropped the connection mid execution
-		# So, we will re-establish a connection and re-raise the exception
-		if not self.active:
-			if self.total_disconnects > 10:
-				return
-			await self.connect()
-			await self.handshake()
-			await self.intrested()
+	async def wait_unchoked(self) -> bool:
+		"""Waits until the peer unchokes us or the connection is closed. Returns True if unchoked."""
+		if self.active and not self.choking_me: return True
+
+		waiters = [asyncio.create_task(self.unchoked.wait()), asyncio.create_task(self.closed.wait())]
+		try:
+			await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+		finally:
+			for waiter in waiters: waiter.cancel()
 
-			if self.active:
-				logger.warning(f"Tried sending message to inactive {self}. Successfully re-established connection!")
-			else:
-				logger.warning(f"Tried sending message to inactive {self}. Failed to re-establish connection!")
+		return self.active and not self.choking_me
 
-			# Now raise BrokenPipeError so that the caller of send_message() can handle it
-			raise BrokenPipeError(f"Tried sending message to inactive peer")
 
+	async def send_message(self, *messages):
+		# Raise error if send_message() is called but peer is inactive.
+		# Lost connections are not re-established here, the ConnectionManager
+		# replaces them with new peers from its reserve pool instead.
 		if not self.active:
 			raise BrokenPipeError(f"Connection to {self} has been closed")
-			
-		EMPTY_RESPONSE_THRESHOLD = 5
-		response_buffer = bytes()
-		self.writer.write(message)
-		try:
-			while True:
-				response = await asyncio.wait_for(self.reader.read(1024), timeout=timeout)
-				response_buffer += response
 
-				logger.debug(f"{self}, {response=}")
-				if len(response) <= 0: EMPTY_RESPONSE_THRESHOLD -= 1
-				if EMPTY_RESPONSE_THRESHOLD < 0:
-					await self.disconnect(f"Empty Response Threshold Exceeded!")
+		upload = self.rate_limits.upload
+		if upload.limited: await upload.throttle(sum(len(message) for message in messages))
 
-		# Timeout here is intentional and guaranteed. This is done to
-		# receive full message because message gets sent in parts
-		except asyncio.TimeoutError:
-			...
+		try:
+			# Several messages go out in a single vectored write
+			self.protocol.writelines(messages)
+			await self.protocol.drain()
 
 		# ConnectionRefusedError: [WinError 1225] The remote computer refused the network connection
 		# ConnectionAbortedError: [WinError 10053] An established connection was aborted by the software in your host machine
 		# ConnectionResetError: [WinError 10054] An existing connection was forcibly closed by the remote host
 		except(ConnectionRefusedError, ConnectionResetError, ConnectionAbortedError):
 			await self.disconnect(f"Connection Refused/Reset/Aborted in SEND!")
+			raise BrokenPipeError(f"Connection to {self} has been closed")
 
-		finally:
-			return response_buffer
 
+	async def request_blocks(self, requests: list[tuple[int, int, int]], timeout=None) -> list[asyncio.Future]:
+		"""
+		Sends a request message for every (piece index, offset, length) in `requests`
+		as a single write and returns one future per request. Each future resolves
+		to the Block once the receive loop has read it, to None if the request is
+		withdrawn with cancel_blocks(), fails with BrokenPipeError if the
+		connection is lost first, or is cancelled after `timeout` seconds.
+
+		Callers are expected to reserve a slot in self.pipeline for every request,
+		the slot is released when the future finishes. Raises PeerChoked without
+		sending anything if the peer is choking us, unless all the requested
+		pieces are allowed fast.
+
+		With download limits, the requests are held back until the data already
+		requested is due to arrive soon enough, see TokenBucket.reserve().
+		"""
+		choked = lambda: self.choking_me and any(index not in self.allowed_fast for index, _, _ in requests)
+		if choked(): raise PeerChoked(f"{self} is choking us")
+
+		download = self.rate_limits.download
+		reserved = download.limited
+		if reserved:
+			size = sum(length for _, _, length in requests)
+			await download.reserve(size)
+			# The peer may have choked us while we waited
+			if choked():
+				download.settle(size)
+				raise PeerChoked(f"{self} is choking us")
+
+		loop = asyncio.get_running_loop()
+		futures = list()
+		messages = list()
+		if self._stalled_since is None: self._stalled_since = time.monotonic() - self._stalled_for
+
+		for index, offset, length in requests:
+			future = loop.create_future()
+			future.add_done_callback(partial(self._forget_request, (index, offset)))
+			self.pipeline.track(future, length)
+			self.score.track(future, length)
+			if timeout is not None:
+				timer = loop.call_later(timeout, future.cancel)
+				future.add_done_callback(lambda _, timer=timer: timer.cancel())
+			# A reservation ends with its request, whichever way that finishes
+			if reserved:
+				future.add_done_callback(lambda _, length=length: download.settle(length))
+
+			self._pending_blocks[(index, offset)] = future
+			futures.append(future)
+			messages.append(Generator.gen_request(index, offset, length))
 
-	def update_piece_info(self, piece_num: int, has_piece: bool):
-		# Utility function to update piece information of peer
-		self.pieces[piece_num] = has_piece
+		try:
+			await self.send_message(*messages)
+		except BrokenPipeError:
+			for future in futures: future.cancel()
+			raise
+
+		return futures
+
+
+	def withdraw_requests(self) -> None:
+		"""Resolves every outstanding request to None, e.g. because the peer discarded them when choking us"""
+		for future in self._pending_blocks.values():
+			if not future.done(): future.set_result(None)
+		self._pending_blocks.clear()
+		self._stalled_since = None
+		self._stalled_for = 0.0
+
+
+	def reject_request(self, index: int, offset: int) -> None:
+		"""Fails the request for a block which the peer refused to send (BEP 6)"""
+		future = self._pending_blocks.pop((index, offset), None)
+		self._stop_stall_clock()
+		if future is None or future.done(): return
+
+		# Requests rejected because the peer choked us are only withdrawn
+		if self.choking_me:
+			future.set_result(None)
+		else:
+			future.set_exception(ConnectionRefusedError(f"{self} rejected the request for {index=}, {offset=}"))
+
+
+	def cancel_blocks(self, requests: list[tuple[int, int, int]]) -> None:
+		"""
+		Withdraws the requests for (piece index, offset, length) in `requests`
+		which are still outstanding, e.g. because another peer has already sent
+		the blocks. Their futures resolve to None and a cancel message is sent
+		to the peer for each of them.
+		"""
+		messages = list()
+		for index, offset, length in requests:
+			future = self._pending_blocks.pop((index, offset), None)
+			if future is None or future.done(): continue
+			future.set_result(None)
+			messages.append(Generator.gen_cancel(index, offset, length))
+		self._stop_stall_clock()
+
+		# Requests are withdrawn from callbacks, so the cancels are only buffered here
+		# and go out with the next drain of the connection
+		if messages and self.active and not self.protocol.is_closing():
+			self.protocol.writelines(messages)
+
+
+	def _forget_request(self, key, future):
+		# Drop a finished or abandoned request, unless it has been re-requested in the meantime
+		if self._pending_blocks.get(key) is future:
+			self._pending_blocks.pop(key)
+
+		# Snubbing shows as requests timing out one after another
+		if future.cancelled() and self.active and self.snubbed and not self._reported_snub:
+			logger.debug(f"{self} is snubbing us")
+			self._reported_snub = True
+			self.publish('snubbed')
+		self._stop_stall_clock()
+
+
+	def _stop_stall_clock(self) -> None:
+		# Without outstanding requests the peer is not stalling, the time waited so far is
+		# kept and the clock goes on from there with the next request
+		if not self._pending_blocks and self._stalled_since is not None:
+			self._stalled_for = time.monotonic() - self._stalled_since
+			self._stalled_since = None
+
+
+	async def _receive_loop(self):
+		"""
+		Reads and handles every message sent by the peer for as long as the
+		connection is open. Blocks are routed to the futures of the requests
+		waiting for them, everything else updates the peer state and is
+		published to the subscribers.
+		"""
+		loop = asyncio.get_running_loop()
+		parser = Parser()
+		try:
+			while messages := await self.protocol.read_messages():
+				parser.feed(messages)
+				artifacts = parser.parse()
+				# Blocks are routed to their requests by receive_block() as the messages are handled in order
+				await Handler(artifacts, Peer=self).handle()
+
+				# Blocks are views into the receive buffer. The done callbacks of their
+				# futures copy them into the pieces, and are run before this.
+				loop.call_soon(self.protocol.release, messages)
+
+				# A handler (e.g. for a choke) may have closed the connection
+				if not self.active: return
+
+			reason = "Connection closed by peer!"
+
+		except ValueError as E:
+			reason = f"{E}!"
+
+		except OSError:
+			reason = "Connection Reset/Aborted in RECEIVE!"
 
+		except Exception as E:
+			# A bug handling the messages must not leave the requests waiting
+			# for a timeout and the connection slot taken by a dead peer
+			logger.exception(f"Unexpected error handling the messages of {self}")
+			reason = f"Unexpected error in RECEIVE: {E!r}!"
 
+		if self.active:
+			await self.disconnect(reason)
+
+
+	def receive_block(self, block) -> None:
+		"""Resolves the request waiting for `block`, blocks nobody waits for any more are dropped"""
+		future = self._pending_blocks.pop((block.piece_num, block.offset), None)
+		if future is not None and not future.done():
+			future.set_result(block)
+			self._stalled_since = time.monotonic() if self._pending_blocks else None
+			self._stalled_for = 0.0
+			if self._reported_snub:
+				logger.debug(f"{self} stopped snubbing us")
+				self._reported_snub = False
+				self.publish('unsnubbed')
+
+
+	def subscribe(self, event: str, callback) -> None:
+		"""
+		Registers `callback` to be called as callback(peer, *args) whenever `event`
+		('bitfield', 'have', 'choke', 'unchoke' or 'extended' with the name of the
+		extension and the message) is received from this peer,
+		the peer starts snubbing us ('snubbed'), sends a block again afterwards
+		('unsnubbed') or the connection is closed ('disconnect').
+		"""
+		self._subscribers[event].append(callback)
+
+
+	def unsubscribe(self, event: str, callback) -> None:
+		if callback in self._subscribers[event]:
+			self._subscribers[event].remove(callback)
 
+
+	def publish(self, event: str, *args) -> None:
+		# Callbacks may unsubscribe themselves while the event is published
+		for callback in list(self._subscribers[event]):
+			callback(self, *args)
+
+
+	def update_piece_info(self, piece_num: int, has_piece: bool):
+		# Utility function to update piece information of peer
+		self.pieces[piece_num] = has_piece
@@ -1,22 +1,24 @@
 import asyncio
 import hashlib
 import logging
+from functools import partial
+from bitstring import BitArray
 
+from aiotorrent.peer import PeerChoked
 from aiotorrent.core.util import Block
-from aiotorrent.core.response_parser import PeerResponseParser as Parser
-from aiotorrent.core.response_handler import PeerResponseHandler as Handler
-from aiotorrent.core.message_generator import MessageGenerator as Generator
 
-from aiotorrent.core.util import BLOCK_SIZE, BLOCKS_PER_CYCLE, MIN_BLOCKS_PER_CYCLE
+from aiotorrent.core.util import BLOCK_SIZE, REQUEST_TIMEOUT
 
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 #TODO: Update class paramater documentation
-#TODO: Rename peers_man to peer_queue
 #TODO: Use consistent naming convention for other variables
 class Piece:
+	# Bytes hashed on the event loop at most when a block arrives
+	HASH_CATCH_UP = 4 * BLOCK_SIZE
+
 	def __init__(self, num: int, priority: int, piece_info: dict[str, int]):
 		"""
 		num: int
@@ -24,168 +26,244 @@ class Piece:
 
 		piece_info: dict
 			dictionary containing information regarding pieces
-
-		peers_man: PeersManager
-			Object of PeersManager
 		"""
-		self.data = bytes()
-		self.blocks = dict()
 		self.num = num
 		self.priority = priority
 
 		self._is_last_piece = False
-		self.total_blocks = piece_info['total_blocks']
-		self.piece_size = self.total_blocks * BLOCK_SIZE
+		self.piece_len = piece_info['piece_len']
+		self.piece_size = self.piece_len
 
 		# If num matches the num of total pieces then it's the last piece.
+		# It is shorter than the others unless the torrent size is a multiple of the piece length.
 		if self.num == piece_info['total_pieces']:
 			self._is_last_piece = True
-			self.total_blocks, self._last_offset = divmod(piece_info['last_piece'], BLOCK_SIZE)
-			self.piece_size = (self.total_blocks * BLOCK_SIZE) + self._last_offset
+			self.piece_size = piece_info['last_piece'] or self.piece_len
+
+		self.total_blocks = -(-self.piece_size // BLOCK_SIZE)
+
+		# Blocks are written straight into this buffer at their offsets, and the same
+		# buffer is later hashed and written to disk. Bit n is set once block n is present.
+		self.data = bytearray(self.piece_size)
+		self.blocks = BitArray(self.total_blocks)
+		# SHA-1 of the contiguous prefix of blocks received so far, so that only
+		# the blocks which arrived out of order are left to hash on completion
+		self._hash = hashlib.sha1()
+		self._hashed = 0
+
+		# Outstanding requests for each block offset, keyed by peer. The blocks of
+		# a piece may be spread over several peers, and in endgame mode a block
+		# may be requested from more than one peer at a time.
+		self._requests = dict()
+		# Peer which supplied each block, so that a hash failure can be traced back
+		self.sources = dict()
+		# Exclusive pieces are downloaded from their own peer only
+		self.exclusive = False
+		# Set whenever a request for this piece finishes
+		self._progress = asyncio.Event()
 
 
 	def __repr__(self):
 		return (f"Piece #{self.num}")
 
 
-	async def fetch_blocks(self, block_offsets: list[int], peer) -> list[Block]:
+	async def fetch_blocks(self, block_offsets: list[int], peer, duplicate: bool = False, limit: int = None) -> list[int]:
 		"""
-		This function fetches a block from a peer. It returns
-		either an Block object or a None Object.
-	
+		This function fetches blocks from a peer. It returns the offsets
+		of the blocks which arrived before the timeout, whose data has been
+		copied into the piece (the blocks themselves point into the receive
+		buffer of the peer, which is reused).
+
+		Requests are streamed through the request pipeline of the peer, so a new
+		request goes out as soon as an earlier one completes. A block is only
+		requested if no other peer has been asked for it in the meantime, unless
+		`duplicate` is set (endgame mode), and at most `limit` blocks are
+		requested if it is given. Every block is written into the piece as soon
+		as it arrives, and requests for the same block to other peers are cancelled.
+
 		block_offsets: list[int]
 			Zero based block offsets which should be a multiple of
 			BLOCK_SIZE. If there are 10 blocks in piece #0, block
 			offset for block num 8 would be (8 * BLOCK_SIZE) = 131702
 		"""
-		requests = bytes()
+		offsets = self._unrequested(sorted(block_offsets), peer, duplicate)[:limit]
+		futures = list()
+
+		while offsets := self._unrequested(offsets, peer, duplicate):
+			slots = await peer.pipeline.acquire(len(offsets))
+
+			# Other peers may have taken some of the blocks while waiting for the pipeline
+			offsets = self._unrequested(offsets, peer, duplicate)
+			batch, offsets = offsets[:slots], offsets[slots:]
+			if len(batch) < slots: peer.pipeline.release(slots - len(batch))
+			if not batch: break
+
+			requests = list()
+			for offset in batch:
+				logger.debug(f"Requesting Block #{self.num}-{offset // BLOCK_SIZE} from {peer}")
+				requests.append((self.num, offset, self.block_length(offset)))
+				# Claim the block before the requests are written, see _unrequested()
+				self._requests.setdefault(offset, dict())[peer] = None
+
+			# The receive loop of the peer resolves each future as soon as its block arrives.
+			# Requests which are still outstanding after the timeout are cancelled.
+			try:
+				batch_futures = await peer.request_blocks(requests, timeout=REQUEST_TIMEOUT)
+			except (BrokenPipeError, PeerChoked) as E:
+				for offset in batch: self._forget_request(peer, offset, None)
+				# Nothing was requested, the slots are not released by any request
+				if isinstance(E, PeerChoked): peer.pipeline.release(len(batch))
+				# Keep the blocks which were received before the connection dropped or the peer choked us
+				if not futures: raise
+				break
 
-		for offset in block_offsets:
-			block_num = int(offset / BLOCK_SIZE)
-			logger.debug(f"Requesting Block #{self.num}-{block_num} from {peer}")
-			request_message = Generator.gen_request(self.num, offset)
+			for offset, future in zip(batch, batch_futures):
+				self._requests[offset][peer] = future
+				future.add_done_callback(partial(self._on_block, peer, offset))
+			futures += batch_futures
 
-			# Last block of last piece will be requested with second last block.
-			is_last_block = True if block_num == (self.total_blocks - 1) else False
+		if not futures: return []
 
-			if self._is_last_piece and is_last_block:
-				request_message = Generator.gen_request(self.num, offset, BLOCK_SIZE + self._last_offset)
+		await asyncio.wait(futures)
+		# Requests withdrawn because another peer sent the block first resolve to None
+		results = [future.result() for future in futures if not future.cancelled() and future.exception() is None]
+		errors = [future.exception() for future in futures if not future.cancelled() and future.exception() is not None]
+		blocks = [block for block in results if block is not None]
 
-			requests += request_message
+		# Rejected requests mean that the peer does not serve the piece, while
+		# requests which all timed out only mean that the peer is slow
+		if not results:
+			if errors: raise errors[0]
+			raise TimeoutError(f"{peer} sent none of the requested blocks in time")
 
-		response = await peer.send_message(requests, timeout=5)
+		if len(results) < len(futures):
+			logger.info(f"Requesting Blocks for {self} from {peer} returned {len(blocks)}/{len(futures)} blocks")
 
-		# If peer sends empty block, update the piece_info of peer
-		# by setting it to false and raise IOError
-		if not response:
-			peer.update_piece_info(self.num, False)
-			raise IOError(f"{peer} Sent Empty Blocks")
+		for block in blocks:
+			logger.debug(f"Got {block} from {peer}")
 
-		try:
-			artifacts = Parser(response).parse()
-			blocks = await Handler(artifacts, Peer=peer).handle()
-			for block in blocks:
-				logger.debug(f"Got {block} from {peer}")
+		return [block.offset for block in blocks]
 
-			return blocks
-		
-		except TypeError as E:
-			logging.info(f"Requesting Blocks for {self} from {peer} Returned None")
-			logging.warning(E)
-			self.adjust_blocks_per_cycle(-1)
-			return None
 
+	def _unrequested(self, offsets: list[int], peer, duplicate: bool = False) -> list[int]:
+		# Missing blocks which nobody has been asked for, or with `duplicate` which `peer` has not been asked for
+		missing = [offset for offset in offsets if not self.blocks[offset // BLOCK_SIZE]]
+		if duplicate:
+			return [offset for offset in missing if peer not in self._requests.get(offset, ())]
+		return [offset for offset in missing if offset not in self._requests]
 
-	def is_piece_complete(self) -> bool:
-		for block_num in range(self.total_blocks):
-			if not block_num in self.blocks:
-				return False
-		return True
 
+	def _forget_request(self, peer, offset: int, future) -> None:
+		requests = self._requests.get(offset, dict())
+		if requests.get(peer, future) is future: requests.pop(peer, None)
+		if not requests: self._requests.pop(offset, None)
+		self._progress.set()
 
-	def gen_offsets(self) -> set:
-		blocks = set()
-		total_blocks = self.total_blocks
-		if self._is_last_piece: total_blocks += 1
-		for block_num in range(self.total_blocks):
-			if not block_num in self.blocks:
-				block_offset = block_num * BLOCK_SIZE
-				blocks.add(block_offset)
-		return blocks
-
-
-	@staticmethod
-	def is_valid(piece, piece_hashmap):
-		#TODO: make this an instance method so that every piece can validate it's own data
-		piece_hash = hashlib.sha1(piece.data).digest()
-
-		if piece_hash != piece_hashmap[piece.num]:
-			logging.warning(f"Piece Hash Does Not Match for {piece}")
-			return False
-			
-		return True
+
+	def _on_block(self, peer, offset: int, future: asyncio.Future) -> None:
+		requests = self._requests.get(offset, dict())
+		self._forget_request(peer, offset, future)
+
+		if future.cancelled() or future.exception() is not None or future.result() is None:
+			return
+
+		# The first copy of a block wins, the requests still outstanding elsewhere are cancelled
+		block = future.result()
+		if self.blocks[block.num] or not self.add_block(block):
+			return
+		self.sources[block.num] = peer
+		for other in list(requests):
+			other.cancel_blocks([(self.num, offset, self.block_length(offset))])
+
+
+	def requested_from(self, peer) -> set:
+		"""Offsets of the blocks which are currently requested from `peer`"""
+		return {offset for offset, requests in self._requests.items() if peer in requests}
+
+
+	def unrequested(self) -> set:
+		"""Offsets of the missing blocks which have not been requested from any peer"""
+		return self.gen_offsets() - set(self._requests)
+
+
+	def suppliers(self) -> set:
+		"""Peers which supplied at least one block of this piece"""
+		return set(self.sources.values())
 
 
-	def adjust_blocks_per_cycle(self, value: int = 1):
+	def block_length(self, offset: int) -> int:
+		# Only the last block of the last piece can be shorter than BLOCK_SIZE
+		return min(BLOCK_SIZE, self.piece_size - offset)
+
+
+	def add_block(self, block: Block) -> bool:
 		"""
-		Increments / Decrements BLOCKS_PER_CYCLE by `value`
+		Copies the data of `block` into the piece buffer at its offset.
+		Returns False if the block does not fit this piece.
 		"""
-		global BLOCKS_PER_CYCLE
-		BLOCKS_PER_CYCLE += value
+		if block.piece_num != self.num or block.offset % BLOCK_SIZE or not 0 <= block.num < self.total_blocks:
+			logger.warning(f"Discarding {block} which does not belong to {self}")
+			return False
 
-		# Ensure BLOCKS_PER_CYCLE is always greater than MIN_BLOCKS_PER_CYCLE
-		BLOCKS_PER_CYCLE = max(BLOCKS_PER_CYCLE, MIN_BLOCKS_PER_CYCLE)
+		if len(block.data) != self.block_length(block.offset):
+			logger.warning(f"Discarding {block} with unexpected length {len(block.data)}")
+			return False
 
-		# Ensure BLOCKS_PER_CYCLE is always less than total_blocks in a piece
-		BLOCKS_PER_CYCLE = min(BLOCKS_PER_CYCLE, self.total_blocks)
+		self.data[block.offset:block.offset + len(block.data)] = block.data
+		self.blocks.set(True, block.num)
+		self._hash_prefix()
+		return True
 
 
-	async def download(self, peers_man, _semaphore = None) -> 'Piece':
-		priority, peer = await peers_man.get()
+	def _hash_prefix(self) -> None:
+		# Feeds the blocks following the hashed prefix into the running hash. A
+		# late block can complete a long run at once, which is caught up on over
+		# the next blocks so that the event loop is not held up by a large piece.
+		budget = self.HASH_CATCH_UP
+		while budget > 0 and self._hashed < self.piece_size and self.blocks[self._hashed // BLOCK_SIZE]:
+			length = self.block_length(self._hashed)
+			self._hash.update(memoryview(self.data)[self._hashed:self._hashed + length])
+			self._hashed += length
+			budget -= length
 
-		while not self.is_piece_complete():
-			task_list = list()
-			block_offsets = self.gen_offsets()
 
-			# If number of block offsets to be downloaded is less than BLOCKS_PER_CYCLE,
-			# all blocks can be downloaded in a single cycle.
-			if len(block_offsets) >= BLOCKS_PER_CYCLE:
-				offsets = {block_offsets.pop() for _ in range(BLOCKS_PER_CYCLE)}
-				block_offsets.difference_update(offsets)
-			else:
-				offsets = self.gen_offsets()
+	def unhashed(self) -> tuple:
+		"""
+		Returns the running SHA-1 hash of the start of the piece and a view of
+		the rest of the piece, which has to be fed into it to get the piece hash
+		"""
+		return self._hash, memoryview(self.data)[self._hashed:]
 
-			blocks = self.fetch_blocks(offsets, peer)
-			task = asyncio.create_task(blocks)
-			task_list.append(task)
 
-			try:
-				# Get results and increment BLOCKS_PER_CYCLE if successful
-				results = await asyncio.gather(*task_list)
-				self.adjust_blocks_per_cycle(1)
-
-			except (BrokenPipeError, IOError):
-				# If BrokenPipe or IOError recieved then we need to reduce the peers priority
-				current_priority, current_peer = priority, peer
-				priority, peer = await peers_man.get()
-				await peers_man.put((current_priority + 1, current_peer))
-				continue
+	def is_piece_complete(self) -> bool:
+		return self.blocks.all(True)
+
+
+	def gen_offsets(self) -> set:
+		# Offsets of the blocks which are not present yet
+		return {block_num * BLOCK_SIZE for block_num in self.blocks.findall('0b0')}
 
-			# Remove NoneType objects and merge inner lists to outerlists
-			results = [result for result in results if result]
-			results = sum(results, [])
 
-			# In case of successful retrieval of block, add block to self.blocks
-			for block in results:
-				if block.data:
-					self.blocks.update({block.num: block})
+	async def download(self, peer) -> 'Piece':
+		"""
+		Fetches the missing blocks of this piece from `peer` until the piece is
+		complete. Blocks received before an error are kept, so that another peer
+		can complete the piece. Other peers may download blocks of the same
+		piece at the same time, in which case the blocks they have been asked for
+		are waited for instead of being requested again.
+
+		Raises BrokenPipeError if the connection to the peer is lost, PeerChoked
+		if the peer chokes us, TimeoutError if none of the requested blocks
+		arrive in time and ConnectionRefusedError if the peer rejects them.
+		"""
+		while not self.is_piece_complete():
+			if self._unrequested(self.gen_offsets(), peer):
+				# Blocks are written into the piece buffer as they arrive
+				await self.fetch_blocks(self.gen_offsets(), peer)
+				continue
 
-		# Concatenate all the block values
-		for block_num in range(self.total_blocks):
-			self.data += self.blocks[block_num].data
+			# The remaining blocks have been requested from other peers
+			self._progress.clear()
+			await self._progress.wait()
 
-		await peers_man.put((priority - 1, peer))
-		# Release semaphore so that the next task can begin
-		if _semaphore is not None:
-			_semaphore.release()
 		return self
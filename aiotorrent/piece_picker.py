@@ -0,0 +1,127 @@
+import random
+import asyncio
+import logging
+
+from aiotorrent.core.availability import AvailabilityIndex
+
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+
+class PiecePicker:
+	"""
+	Decides which piece a peer should download next.
+
+	The picker keeps an AvailabilityIndex over the bitfields of the peers,
+	updated incrementally from their bitfield, have and disconnect events,
+	and hands out pieces rarest first among the pieces the asking peer
+	actually has. In sequential mode the lowest numbered piece is handed
+	out instead.
+	"""
+	def __init__(self, num_pieces: int, sequential: bool = False) -> None:
+		self.num_pieces = num_pieces
+		self.sequential = sequential
+		self.index = AvailabilityIndex(num_pieces)
+
+		# Pieces handed out to a peer, as a mask in the format of the index
+		self.in_progress = 0
+
+		# Set whenever new work may have become available
+		self.changed = asyncio.Event()
+
+
+	def __repr__(self):
+		wanted = (self.index.needed & ~self.in_progress).bit_count()
+		return f"PiecePicker({wanted} wanted, {self.in_progress.bit_count()} in progress)"
+
+
+	def add_peer(self, peer) -> None:
+		if peer in self.index: return
+		self._on_bitfield(peer, peer.pieces)
+
+		peer.subscribe('bitfield', self._on_bitfield)
+		peer.subscribe('have', self._on_have)
+		peer.subscribe('disconnect', self.remove_peer)
+
+
+	def remove_peer(self, peer) -> None:
+		if peer not in self.index: return
+		self.index.remove(peer)
+
+		peer.unsubscribe('bitfield', self._on_bitfield)
+		peer.unsubscribe('have', self._on_have)
+		peer.unsubscribe('disconnect', self.remove_peer)
+
+
+	def close(self) -> None:
+		for peer in self.index.peers():
+			self.remove_peer(peer)
+
+
+	def _on_bitfield(self, peer, pieces) -> None:
+		self.index.set_bitfield(peer, pieces)
+		self.changed.set()
+
+
+	def _on_have(self, peer, num: int) -> None:
+		if self.index.add_piece(peer, num):
+			self.changed.set()
+
+
+	def forget(self, peer, num: int) -> None:
+		"""The peer turned out not to serve piece `num`, so it is not picked for it again"""
+		self.index.remove_piece(peer, num)
+
+
+	def want(self, pieces) -> None:
+		self.index.want(pieces)
+		self.changed.set()
+
+
+	def finished(self) -> bool:
+		return not self.index.needed
+
+
+	def endgame(self) -> bool:
+		"""True once every remaining piece has been handed out to a peer"""
+		return bool(self.index.needed) and not self.index.needed & ~self.in_progress
+
+
+	def in_progress_from(self, peer) -> list[int]:
+		"""Pieces handed out to other peers which `peer` has as well"""
+		return list(self.index.iter_pieces(self.in_progress & self.index.pieces_of(peer)))
+
+
+	def pick(self, peer, end: int = None, only = None) -> int:
+		"""
+		Returns the next piece `peer` should download and marks it as in progress,
+		or None if the peer has none of the wanted pieces. Only pieces below
+		`end`, and only pieces in `only` are considered if they are given.
+		"""
+		candidates = self.index.wanted_from(peer) & ~self.in_progress
+		if end is not None: candidates &= (1 << max(end, 0)) - 1
+		if only is not None: candidates &= self.index.from_pieces(only)
+		if not candidates: return None
+
+		if self.sequential:
+			num = self.index.lowest(candidates)
+		else:
+			# Rarest first, ties are broken randomly so that peers spread out over equally rare pieces
+			rarest = self.index.rarest(candidates)
+			num = self.index.nth(rarest, random.randrange(rarest.bit_count()))
+
+		self.in_progress |= 1 << num
+		return num
+
+
+	def abort(self, num: int) -> None:
+		"""Puts a piece which could not be downloaded or failed verification back"""
+		self.in_progress &= ~(1 << num)
+		self.changed.set()
+
+
+	def done(self, num: int) -> None:
+		self.in_progress &= ~(1 << num)
+		self.index.have(num)
+		self.changed.set()
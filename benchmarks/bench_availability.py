@@ -0,0 +1,77 @@
+#!/usr/bin/python
+"""
+Compares the AvailabilityIndex against per-piece availability counts kept
+in a list and updated from BitArray bitfields in Python loops.
+
+	$ python benchmarks/bench_availability.py [num_pieces] [num_peers]
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bitstring import BitArray
+
+from aiotorrent.core.availability import AvailabilityIndex
+
+
+def random_bitfield(num_pieces, seeder):
+	if seeder: return ~BitArray(num_pieces)
+	return BitArray(bytes(random.getrandbits(8) for _ in range(-(-num_pieces // 8))))[:num_pieces]
+
+
+def timed(label, func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	print(f"{label:<42} {(time.perf_counter() - start) * 1000:9.1f} ms")
+	return result
+
+
+def legacy_counts(num_pieces, bitfields):
+	availability = [0] * num_pieces
+	for pieces in bitfields.values():
+		for num in pieces.findall('0b1'):
+			availability[num] += 1
+	return availability
+
+
+def legacy_rarest(availability, pieces, needed):
+	candidates = [num for num in needed if pieces[num]]
+	rarity = min(availability[num] for num in candidates)
+	return [num for num in candidates if availability[num] == rarity]
+
+
+def index_counts(num_pieces, bitfields):
+	index = AvailabilityIndex(num_pieces)
+	for peer, pieces in bitfields.items():
+		index.set_bitfield(peer, pieces)
+	return index
+
+
+def main():
+	num_pieces = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+	num_peers = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+	print(f"{num_pieces} pieces, {num_peers} peers")
+
+	bitfields = {peer: random_bitfield(num_pieces, random.random() < 0.2) for peer in range(num_peers)}
+	needed = set(random.sample(range(num_pieces), num_pieces // 2))
+
+	availability = timed("list: count all bitfields", legacy_counts, num_pieces, bitfields)
+	index = timed("index: count all bitfields", index_counts, num_pieces, bitfields)
+	index.want(needed)
+	assert index.counts() == availability
+
+	peers = random.sample(range(num_peers), 20)
+	legacy = timed("list: rarest needed pieces of 20 peers", lambda: [legacy_rarest(availability, bitfields[peer], needed) for peer in peers])
+	vectorized = timed("index: rarest needed pieces of 20 peers", lambda: [index.rarest(index.wanted_from(peer)) for peer in peers])
+	assert [set(pieces) for pieces in legacy] == [set(AvailabilityIndex.iter_pieces(mask)) for mask in vectorized]
+
+	num = random.randrange(num_pieces)
+	timed("index: peers with one piece", index.peers_with, num)
+	timed("index: drop every peer", lambda: [index.remove(peer) for peer in list(bitfields)])
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,115 @@
+#!/usr/bin/python
+"""
+Stores pieces arriving from a simulated network on a simulated slow disk,
+which takes a fixed time per write call plus a time per byte, once
+writing every piece on the event loop as the download used to and once
+through the DiskWriter. Shows the total time, the number of write calls
+and the longest time the event loop was blocked, during which no peer
+would have been served.
+
+	$ python benchmarks/bench_disk_writer.py [pieces] [piece kilobytes] [ms per write] [disk MiB/s]
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.file_utils import FileTree
+from aiotorrent.core.storage import Storage
+from aiotorrent.core.disk_writer import DiskWriter
+
+
+class SlowStorage(Storage):
+	"""
+	Storage whose every write takes `latency` seconds plus the time to move
+	the bytes at `bandwidth`. Like a single disk, it writes one call at a time.
+	"""
+	def __init__(self, *args, latency: float, bandwidth: float) -> None:
+		super().__init__(*args)
+		self.latency, self.bandwidth = latency, bandwidth
+		self.calls = 0
+		self._disk = threading.Lock()
+
+	def writev(self, num: int, buffers: list, offset: int = 0) -> None:
+		with self._disk:
+			super().writev(num, buffers, offset)
+			self.calls += 1
+			time.sleep(self.latency + sum(len(buffer) for buffer in buffers) / self.bandwidth)
+
+
+async def network(pieces: list, interval: float):
+	"""Yields the pieces as a download over a network would, one every `interval` seconds"""
+	start = time.perf_counter()
+	for num, data in enumerate(pieces):
+		await asyncio.sleep(max(start + num * interval - time.perf_counter(), 0))
+		yield num, data
+
+
+async def monitor(stalls: list) -> None:
+	"""Records the longest time the event loop did not get to run this task"""
+	while True:
+		before = time.perf_counter()
+		await asyncio.sleep(0.001)
+		stalls[0] = max(stalls[0], time.perf_counter() - before - 0.001)
+
+
+async def on_the_loop(storage: Storage, pieces: list, interval: float) -> None:
+	async for num, data in network(pieces, interval):
+		storage.write(num, data)
+	storage.flush()
+
+
+async def with_disk_writer(storage: Storage, pieces: list, interval: float) -> None:
+	writer = DiskWriter(storage)
+	async for num, data in network(pieces, interval):
+		await writer.write(num, data)
+	await writer.flush()
+	writer.close()
+
+
+async def measure(store, storage: Storage, pieces: list, interval: float) -> tuple[float, float]:
+	stalls = [0.0]
+	task = asyncio.create_task(monitor(stalls))
+	start = time.perf_counter()
+	await store(storage, pieces, interval)
+	elapsed = time.perf_counter() - start
+	task.cancel()
+	return elapsed, stalls[0]
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+	piece_len = int(sys.argv[2] if len(sys.argv) > 2 else 256) * 1024
+	latency = float(sys.argv[3] if len(sys.argv) > 3 else 4) / 1000
+	bandwidth = float(sys.argv[4] if len(sys.argv) > 4 else 200) * 2 ** 20
+
+	size = count * piece_len
+	torrent_info = {
+		'name': 'bench', 'size': size, 'piece_len': piece_len,
+		'files': [{'length': size // 2, 'path': ['file0.bin']}, {'length': size - size // 2, 'path': ['file1.bin']}],
+	}
+	files = FileTree(torrent_info)
+	data = os.urandom(size)
+	pieces = [data[start:start + piece_len] for start in range(0, size, piece_len)]
+	# The network delivers pieces a little faster than the disk writes them one by one
+	interval = (latency + piece_len / bandwidth) * 0.8
+	print(f"{count} pieces of {piece_len // 1024} KiB, one every {interval * 1000:.1f} ms, "
+		f"disk {latency * 1000:.0f} ms per write and {bandwidth / 2 ** 20:.0f} MiB/s")
+
+	for label, store in (("on the event loop", on_the_loop), ("DiskWriter", with_disk_writer)):
+		with tempfile.TemporaryDirectory() as directory:
+			storage = SlowStorage(torrent_info, files, directory, latency=latency, bandwidth=bandwidth)
+			elapsed, stall = asyncio.run(measure(store, storage, pieces, interval))
+			storage.close()
+
+			written = b''.join(open(os.path.join(directory, file.path), 'rb').read() for file in files)
+			assert written == data
+		print(f"  {label:<18} {elapsed:6.2f} s  {storage.calls:5} writes  longest stall {stall * 1000:6.1f} ms")
+
+
+if __name__ == "__main__":
+	main()
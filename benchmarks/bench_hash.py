@@ -0,0 +1,74 @@
+#!/usr/bin/python
+"""
+Verifies pieces on the event loop and with the PieceVerifier thread pool,
+and measures the hash throughput as well as how long the event loop was
+held up at worst, with a ticker task which should run every millisecond.
+
+	$ python benchmarks/bench_hash.py [piece megabytes] [pieces]
+"""
+import os
+import sys
+import time
+import asyncio
+import hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.piece_verifier import PieceVerifier
+
+
+async def ticker(stalls):
+	while True:
+		start = time.perf_counter()
+		await asyncio.sleep(0.001)
+		stalls.append(time.perf_counter() - start - 0.001)
+
+
+async def on_loop(pieces, digest):
+	for piece in pieces:
+		assert hashlib.sha1(piece).digest() == digest
+		# Downloads hand control back to the loop between pieces
+		await asyncio.sleep(0)
+
+
+async def in_pool(pieces, digest, workers):
+	verifier = PieceVerifier(workers)
+	results = [await verifier.submit(piece, digest) for piece in pieces]
+	assert all(await asyncio.gather(*results))
+	verifier.close()
+	return verifier
+
+
+async def run(verify):
+	stalls = list()
+	task = asyncio.create_task(ticker(stalls))
+	await asyncio.sleep(0.01)
+	start = time.perf_counter()
+	verifier = await verify()
+	elapsed = time.perf_counter() - start
+	task.cancel()
+	return elapsed, max(stalls), verifier
+
+
+def main():
+	piece_size = int(sys.argv[1] if len(sys.argv) > 1 else 16) * 2 ** 20
+	count = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+	piece = os.urandom(piece_size)
+	digest = hashlib.sha1(piece).digest()
+	pieces = [bytearray(piece) for _ in range(count)]
+	total = piece_size * count / 2 ** 20
+
+	print(f"{count} pieces of {piece_size // 2 ** 20} MiB")
+	print(f"  {'':<14} {'throughput':>12} {'worst stall':>12}")
+	elapsed, stall, _ = asyncio.run(run(lambda: on_loop(pieces, digest)))
+	print(f"  {'event loop':<14} {total / elapsed:7.0f} MiB/s {stall * 1000:9.1f} ms")
+
+	for workers in (1, 2, 4, 8):
+		elapsed, stall, verifier = asyncio.run(run(lambda: in_pool(pieces, digest, workers)))
+		label = f"{workers} threads"
+		print(f"  {label:<14} {total / elapsed:7.0f} MiB/s {stall * 1000:9.1f} ms"
+			f"  ({verifier.throughput() / 2 ** 20:.0f} MiB/s per thread)")
+
+
+if __name__ == "__main__":
+	main()
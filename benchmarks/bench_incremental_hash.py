@@ -0,0 +1,67 @@
+#!/usr/bin/python
+"""
+Measures the time to the first verified piece of a stream, when the piece is
+hashed as a whole once complete and when its blocks are hashed as they
+arrive in order. Blocks are delivered at a fixed rate, in order and, to
+show the worst case, with the first block arriving last.
+
+	$ python benchmarks/bench_incremental_hash.py [piece megabytes] [MiB/s]
+"""
+import os
+import sys
+import time
+import asyncio
+import hashlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.piece import Piece
+from aiotorrent.core.util import Block, BLOCK_SIZE
+from aiotorrent.core.piece_verifier import PieceVerifier
+
+
+async def first_piece(data, rate, incremental, order):
+	"""Returns the seconds until the piece is verified, and after its last block arrived"""
+	piece = Piece(0, 3, {'piece_len': len(data), 'total_pieces': 1, 'last_piece': 0})
+	expected = hashlib.sha1(data).digest()
+	verifier = PieceVerifier(1)
+
+	start = time.perf_counter()
+	for num, offset in enumerate(order):
+		piece.add_block(Block(0, offset, data[offset:offset + BLOCK_SIZE]))
+		# Sleep in batches, the timer resolution is too coarse for every block
+		if num % 64 == 63:
+			await asyncio.sleep(max(start + (num + 1) * BLOCK_SIZE / rate - time.perf_counter(), 0))
+	completed = time.perf_counter()
+
+	if incremental:
+		hasher, unhashed = piece.unhashed()
+		assert await (await verifier.submit(unhashed, expected, hasher))
+	else:
+		assert await (await verifier.submit(piece.data, expected))
+	verified = time.perf_counter()
+
+	verifier.close()
+	return verified - start, verified - completed
+
+
+def main():
+	piece_size = int(sys.argv[1] if len(sys.argv) > 1 else 16) * 2 ** 20
+	rate = float(sys.argv[2] if len(sys.argv) > 2 else 200) * 2 ** 20
+	data = os.urandom(piece_size)
+	in_order = list(range(0, piece_size, BLOCK_SIZE))
+	first_last = in_order[1:] + in_order[:1]
+
+	print(f"First piece of {piece_size // 2 ** 20} MiB at {rate / 2 ** 20:.0f} MiB/s")
+	print(f"  {'':<30} {'first byte':>10} {'after last block':>17}")
+	for label, incremental, order in (
+		("whole piece", False, in_order),
+		("incremental, in order", True, in_order),
+		("incremental, first block last", True, first_last),
+	):
+		ttfb, latency = asyncio.run(first_piece(data, rate, incremental, order))
+		print(f"  {label:<30} {ttfb * 1000:7.1f} ms {latency * 1000:14.1f} ms")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python
+"""
+Compares the incremental PeerResponseParser against the slicing parser it
+replaced, on replies made of back to back piece messages.
+
+	$ python benchmarks/bench_parser.py
+"""
+import os
+import sys
+import time
+from struct import pack, unpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.util import BLOCK_SIZE
+from aiotorrent.core.response_parser import PeerResponseParser
+
+
+class LegacyPeerResponseParser:
+	"""Piece and keep-alive handling of the previous parser, which slices consumed bytes off the response"""
+	def __init__(self, response):
+		self.response = response
+		self.artifacts = dict()
+
+	def parse(self):
+		while self.response:
+			self.message_len = unpack('>I', self.response[:4])[0]
+			if self.message_len == 0:
+				self.response = self.response[4:]
+				continue
+			self.parse_piece()
+		return self.artifacts
+
+	def parse_piece(self):
+		if not 'pieces' in self.artifacts: self.artifacts['pieces'] = list()
+		total = self.message_len - 9 + 13
+		index, offset = unpack('>II', self.response[5: 13])
+		self.artifacts['pieces'].append((index, offset, self.response[13:total]))
+		self.response = self.response[total:]
+
+
+def make_reply(size):
+	block = os.urandom(BLOCK_SIZE)
+	messages = list()
+	for num in range(size // BLOCK_SIZE):
+		messages.append(pack('>IBII', 9 + BLOCK_SIZE, 7, 0, num * BLOCK_SIZE) + block)
+	return b''.join(messages)
+
+
+def bench(label, func, repeat=3):
+	best = min(timeit(func) for _ in range(repeat))
+	print(f"  {label:<28} {best * 1000:10.2f} ms")
+	return best
+
+
+def timeit(func):
+	start = time.perf_counter()
+	func()
+	return time.perf_counter() - start
+
+
+def main():
+	for megabytes in (1, 4, 16):
+		reply = make_reply(megabytes * 2 ** 20)
+		print(f"{megabytes} MiB reply ({len(reply) // (BLOCK_SIZE + 13)} piece messages)")
+
+		legacy = bench("legacy (slicing)", lambda: LegacyPeerResponseParser(reply).parse())
+		current = bench("incremental (one chunk)", lambda: PeerResponseParser(reply).parse())
+
+		# Same reply arriving in socket sized reads
+		def streamed(chunk_size=64 * 1024):
+			parser = PeerResponseParser()
+			for start in range(0, len(reply), chunk_size):
+				parser.feed(reply[start:start + chunk_size])
+				parser.parse()
+
+		bench("incremental (64 KiB reads)", streamed)
+		print(f"  speedup: {legacy / current:.1f}x\n")
+
+
+if __name__ == "__main__":
+	main()
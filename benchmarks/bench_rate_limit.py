@@ -0,0 +1,90 @@
+#!/usr/bin/python
+"""
+Receives piece messages over loopback TCP with the PeerProtocol, limited by
+token buckets, and compares the achieved rate with the configured one.
+
+	$ python benchmarks/bench_rate_limit.py [seconds]
+"""
+import os
+import sys
+import time
+import asyncio
+from struct import pack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.util import BLOCK_SIZE
+from aiotorrent.core.peer_protocol import PeerProtocol
+from aiotorrent.core.rate_limiter import RateLimits
+
+MiB = 2 ** 20
+
+
+def make_stream(size):
+	block = os.urandom(BLOCK_SIZE)
+	messages = [b'\x13' + bytes(67)]
+	for num in range(size // BLOCK_SIZE):
+		messages.append(pack('>IBII', 9 + BLOCK_SIZE, 7, 0, num * BLOCK_SIZE) + block)
+	return b''.join(messages)
+
+
+class Sender(asyncio.Protocol):
+	"""Writes the whole stream as soon as it is connected and closes the connection"""
+	def __init__(self, stream):
+		self.stream = stream
+
+	def connection_made(self, transport):
+		transport.write(self.stream)
+		transport.close()
+
+
+async def receive(port, bucket):
+	loop = asyncio.get_running_loop()
+	_, protocol = await loop.create_connection(lambda: PeerProtocol(bucket=bucket), '127.0.0.1', port)
+	await protocol.read_handshake()
+	received = 0
+	while messages := await protocol.read_messages():
+		received += len(messages)
+		protocol.release(messages)
+	return received
+
+
+async def transfer(peers, size, limits):
+	"""Receives `size` bytes from each of `peers` connections below `limits`"""
+	loop = asyncio.get_running_loop()
+	server = await loop.create_server(lambda: Sender(make_stream(size)), '127.0.0.1', 0)
+	port = server.sockets[0].getsockname()[1]
+	start = time.perf_counter()
+	received = await asyncio.gather(*(receive(port, limits.peer().download) for _ in range(peers)))
+	elapsed = time.perf_counter() - start
+	server.close()
+	return sum(received), elapsed
+
+
+def main():
+	seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+
+	# (label, peers, torrent limit, limit of each peer) in MiB/s
+	scenarios = [
+		("unlimited", 1, None, None),
+		("torrent 2 MiB/s", 1, 2, None),
+		("torrent 10 MiB/s", 1, 10, None),
+		("peer 5 MiB/s", 1, None, 5),
+		("4 peers of 5, torrent 8", 4, 8, 5),
+		("4 peers of 1, torrent 8", 4, 8, 1),
+	]
+
+	print(f"{'scenario':<26} {'limit':>10} {'achieved':>10}")
+	for label, peers, torrent, peer in scenarios:
+		limits = RateLimits(torrent and torrent * MiB)
+		limits.peer_download = peer and peer * MiB
+		expected = min(filter(None, (torrent, peer and peer * peers)), default=None)
+		# Enough data for the transfer to last `seconds` at the expected rate
+		size = int((expected or 256) * MiB * seconds / peers)
+		received, elapsed = asyncio.run(transfer(peers, size, limits))
+		achieved = received / elapsed / MiB
+		print(f"{label:<26} {f'{expected} MiB/s' if expected else '-':>10} {achieved:6.2f} MiB/s")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+"""
+Rechecks a torrent of several files written to a temporary directory,
+once reading and hashing one piece at a time in this process and then
+with the PieceChecker and an increasing number of worker processes.
+
+	$ python benchmarks/bench_recheck.py [megabytes] [piece kilobytes]
+"""
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.file_utils import FileTree
+from aiotorrent.core.recheck import PieceChecker
+
+
+def make_torrent(directory, size, piece_len):
+	"""Writes files of random data and returns the torrent info describing them"""
+	sizes = [size // 2, size // 3, size - size // 2 - size // 3]
+	files, hashes = list(), dict()
+	data = b''
+	for num, length in enumerate(sizes):
+		chunk = os.urandom(length)
+		with open(os.path.join(directory, f"file{num}.bin"), 'wb') as file:
+			file.write(chunk)
+		files.append({'length': length, 'path': [f"file{num}.bin"]})
+		data += chunk
+
+	for num, start in enumerate(range(0, size, piece_len)):
+		hashes[num] = hashlib.sha1(data[start:start + piece_len]).digest()
+
+	return {'name': directory, 'size': size, 'piece_len': piece_len, 'files': files, 'piece_hashmap': hashes}
+
+
+def one_at_a_time(torrent_info, files):
+	"""Reads every piece with regular file reads and hashes it, as a naive recheck would"""
+	piece_len, verified = torrent_info['piece_len'], 0
+	handles = [open(os.path.join(torrent_info['name'], file.name), 'rb') for file in files]
+	current, buffer = 0, b''
+	for num, expected in torrent_info['piece_hashmap'].items():
+		while len(buffer) < piece_len and current < len(handles):
+			buffer += handles[current].read(piece_len - len(buffer))
+			if len(buffer) < piece_len: current += 1
+		piece, buffer = buffer[:piece_len], buffer[piece_len:]
+		verified += hashlib.sha1(piece).digest() == expected
+	for handle in handles: handle.close()
+	return verified
+
+
+def main():
+	size = int(sys.argv[1] if len(sys.argv) > 1 else 512) * 2 ** 20
+	piece_len = int(sys.argv[2] if len(sys.argv) > 2 else 256) * 1024
+
+	with tempfile.TemporaryDirectory() as directory:
+		torrent_info = make_torrent(directory, size, piece_len)
+		files = FileTree(torrent_info)
+		total = len(torrent_info['piece_hashmap'])
+		print(f"{size // 2 ** 20} MiB in {total} pieces of {piece_len // 1024} KiB, {os.cpu_count()} CPUs")
+
+		start = time.perf_counter()
+		verified = one_at_a_time(torrent_info, files)
+		elapsed = time.perf_counter() - start
+		assert verified == total, verified
+		print(f"  {'one piece at a time':<22} {size / 2 ** 20 / elapsed:7.0f} MiB/s")
+
+		for workers in sorted({1, 2, 4, os.cpu_count()}):
+			start = time.perf_counter()
+			verified = asyncio.run(PieceChecker(torrent_info, files, workers).check())
+			elapsed = time.perf_counter() - start
+			assert verified.all(True), verified.count(1)
+			label = f"PieceChecker, {workers} proc"
+			print(f"  {label:<22} {size / 2 ** 20 / elapsed:7.0f} MiB/s")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,78 @@
+#!/usr/bin/python
+"""
+Writes the pieces of a torrent of many small files, once file by file as
+the download used to, where a piece shared by several files is fetched
+for every one of them and only its slice is written each time, and once
+with the Storage, which writes every piece once to all of its files.
+The best of three runs is shown.
+
+	$ python benchmarks/bench_storage.py [files] [file kilobytes] [piece kilobytes]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.file_utils import FileTree
+from aiotorrent.core.storage import Storage
+
+
+def per_file(directory, files, pieces, piece_len):
+	"""Opens every file in turn and writes the slices of all its pieces with seek() and write()"""
+	fetched = 0
+	for file in files:
+		with open(os.path.join(directory, file.path), 'wb') as target:
+			for num in file.pieces:
+				fetched += 1
+				start = file.start_byte if num == file.start_piece else 0
+				end = file.end_byte if num == file.end_piece else len(pieces[num])
+				offset = max((num - file.start_piece) * piece_len - file.start_byte, 0)
+				target.seek(offset)
+				target.write(pieces[num][start:end])
+	return fetched
+
+
+def with_storage(directory, torrent_info, files, pieces):
+	storage = Storage(torrent_info, files, directory)
+	for num, data in enumerate(pieces):
+		storage.write(num, data)
+	storage.close()
+	return len(pieces)
+
+
+def main():
+	count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+	file_size = int(float(sys.argv[2] if len(sys.argv) > 2 else 100) * 1024)
+	piece_len = int(sys.argv[3] if len(sys.argv) > 3 else 256) * 1024
+
+	size = count * file_size
+	torrent_info = {
+		'name': 'bench', 'size': size, 'piece_len': piece_len,
+		'files': [{'length': file_size, 'path': [f"file{num}.bin"]} for num in range(count)],
+	}
+	files = FileTree(torrent_info)
+	data = os.urandom(size)
+	pieces = [data[start:start + piece_len] for start in range(0, size, piece_len)]
+	print(f"{count} files of {file_size // 1024} KiB in {len(pieces)} pieces of {piece_len // 1024} KiB")
+
+	for label, write in (
+		("file by file", lambda directory: per_file(directory, files, pieces, piece_len)),
+		("Storage", lambda directory: with_storage(directory, torrent_info, files, pieces)),
+	):
+		# Disk writes are noisy, the best of a few runs is shown
+		elapsed = float('inf')
+		for _ in range(3):
+			with tempfile.TemporaryDirectory() as directory:
+				start = time.perf_counter()
+				fetched = write(directory)
+				elapsed = min(elapsed, time.perf_counter() - start)
+
+				written = b''.join(open(os.path.join(directory, file.path), 'rb').read() for file in files)
+				assert written == data
+		print(f"  {label:<14} {fetched:6} pieces fetched  {fetched * piece_len / 2 ** 20:8.1f} MiB  {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+"""
+Compares receiving piece messages over loopback with StreamReader reads
+against the PeerProtocol, which receives into a reusable buffer and frames
+the messages in place. The sender runs in its own process.
+
+	$ python benchmarks/bench_transport.py [megabytes]
+"""
+import os
+import sys
+import time
+import socket
+import asyncio
+import multiprocessing
+from struct import pack, unpack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.util import BLOCK_SIZE
+from aiotorrent.core.peer_protocol import PeerProtocol
+from aiotorrent.core.response_parser import PeerResponseParser
+
+
+def make_stream(size):
+	block = os.urandom(BLOCK_SIZE)
+	messages = [b'\x00' * 68]
+	for num in range(size // BLOCK_SIZE):
+		messages.append(pack('>IBII', 9 + BLOCK_SIZE, 7, 0, num * BLOCK_SIZE) + block)
+	return b''.join(messages)
+
+
+def serve(listener, stream, runs):
+	for _ in range(runs):
+		connection, _ = listener.accept()
+		connection.sendall(stream)
+		connection.close()
+
+
+async def receive_stream_reader(port, chunk_size):
+	"""Reads fixed size chunks and frames them in a growing bytes buffer"""
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	await reader.readexactly(68)
+	parser, blocks, buffer = PeerResponseParser(), 0, b''
+	while chunk := await reader.read(chunk_size):
+		buffer += chunk
+		while len(buffer) >= 4 and len(buffer) >= 4 + unpack('>I', buffer[:4])[0]:
+			end = 4 + unpack('>I', buffer[:4])[0]
+			parser.feed(buffer[:end])
+			blocks += sum(name == 'piece' for name, _ in parser.parse())
+			buffer = buffer[end:]
+	writer.close()
+	return blocks
+
+
+async def receive_readexactly(port):
+	"""Reads the length prefix and then exactly the message"""
+	reader, writer = await asyncio.open_connection('127.0.0.1', port)
+	await reader.readexactly(68)
+	parser, blocks = PeerResponseParser(), 0
+	while True:
+		try:
+			prefix = await reader.readexactly(4)
+			payload = await reader.readexactly(unpack('>I', prefix)[0])
+		except asyncio.IncompleteReadError:
+			break
+		parser.feed(prefix + payload)
+		blocks += sum(name == 'piece' for name, _ in parser.parse())
+	writer.close()
+	return blocks
+
+
+async def receive_protocol(port):
+	loop = asyncio.get_running_loop()
+	_, protocol = await loop.create_connection(PeerProtocol, '127.0.0.1', port)
+	await protocol.read_handshake()
+	parser, blocks = PeerResponseParser(), 0
+	while messages := await protocol.read_messages():
+		parser.feed(messages)
+		blocks += sum(name == 'piece' for name, _ in parser.parse())
+		protocol.release(messages)
+	protocol.close()
+	return blocks
+
+
+def main():
+	megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+	stream = make_stream(megabytes * 2 ** 20)
+	expected = megabytes * 2 ** 20 // BLOCK_SIZE
+
+	receivers = [
+		("StreamReader.read(1024)", lambda port: receive_stream_reader(port, 1024)),
+		("StreamReader.readexactly", receive_readexactly),
+		("PeerProtocol", receive_protocol),
+	]
+
+	listener = socket.create_server(('127.0.0.1', 0))
+	port = listener.getsockname()[1]
+	sender = multiprocessing.Process(target=serve, args=(listener, stream, len(receivers)))
+	sender.start()
+
+	print(f"{megabytes} MiB of piece messages over loopback")
+	for label, receive in receivers:
+		wall, cpu = time.perf_counter(), time.process_time()
+		blocks = asyncio.run(receive(port))
+		wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+		assert blocks == expected, (blocks, expected)
+		print(f"  {label:<26} {megabytes / wall:8.0f} MiB/s  {cpu * 1000:8.0f} ms CPU")
+
+	sender.join()
+
+
+if __name__ == "__main__":
+	main()
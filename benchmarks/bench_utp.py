@@ -0,0 +1,86 @@
+#!/usr/bin/python
+"""
+Sends piece messages between two in-process endpoints over loopback, once
+over TCP and once over uTP, and receives them with the PeerProtocol.
+
+	$ python benchmarks/bench_utp.py [megabytes]
+"""
+import os
+import sys
+import time
+import asyncio
+from struct import pack
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiotorrent.core.util import BLOCK_SIZE
+from aiotorrent.core.peer_protocol import PeerProtocol
+from aiotorrent.core.response_parser import PeerResponseParser
+from aiotorrent.core.utp import create_utp_endpoint, open_utp_connection
+
+
+def make_stream(size):
+	block = os.urandom(BLOCK_SIZE)
+	messages = [b'\x13' + bytes(67)]
+	for num in range(size // BLOCK_SIZE):
+		messages.append(pack('>IBII', 9 + BLOCK_SIZE, 7, 0, num * BLOCK_SIZE) + block)
+	return b''.join(messages)
+
+
+class Sender(asyncio.Protocol):
+	"""Writes the whole stream as soon as it is connected and closes the connection"""
+	def __init__(self, stream):
+		self.stream = stream
+
+	def connection_made(self, transport):
+		self.transport = transport
+		transport.write(self.stream)
+		transport.close()
+
+
+async def receive(protocol):
+	await protocol.read_handshake()
+	parser, blocks = PeerResponseParser(), 0
+	while messages := await protocol.read_messages():
+		parser.feed(messages)
+		blocks += sum(name == 'piece' for name, _ in parser.parse())
+		protocol.release(messages)
+	return blocks
+
+
+async def over_tcp(stream):
+	loop = asyncio.get_running_loop()
+	server = await loop.create_server(lambda: Sender(stream), '127.0.0.1', 0)
+	port = server.sockets[0].getsockname()[1]
+	_, protocol = await loop.create_connection(PeerProtocol, '127.0.0.1', port)
+	blocks = await receive(protocol)
+	server.close()
+	return blocks
+
+
+async def over_utp(stream):
+	sender = Sender(stream)
+	endpoint = await create_utp_endpoint('127.0.0.1', 0, lambda: sender)
+	_, protocol = await open_utp_connection(PeerProtocol, *endpoint.address)
+	blocks = await receive(protocol)
+	print(f"  uTP sender: congestion window {sender.transport.cwnd / 1024:.0f} KiB, rtt {sender.transport.rtt * 1000:.2f} ms")
+	endpoint.close()
+	return blocks
+
+
+def main():
+	megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+	stream = make_stream(megabytes * 2 ** 20)
+	expected = megabytes * 2 ** 20 // BLOCK_SIZE
+	print(f"{megabytes} MiB of piece messages over loopback")
+
+	for label, transfer in (("TCP", over_tcp), ("uTP", over_utp)):
+		wall, cpu = time.perf_counter(), time.process_time()
+		blocks = asyncio.run(transfer(stream))
+		wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+		assert blocks == expected, (blocks, expected)
+		print(f"  {label:<4} {megabytes / wall:8.1f} MiB/s  {cpu:6.2f} s CPU")
+
+
+if __name__ == "__main__":
+	main()
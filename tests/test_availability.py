@@ -0,0 +1,114 @@
+import random
+import unittest
+
+from bitstring import BitArray
+
+from aiotorrent.core.availability import AvailabilityIndex
+
+
+class TestMasks(unittest.TestCase):
+	def test_to_mask(self):
+		self.assertEqual(AvailabilityIndex.to_mask(BitArray('0b1010')), 0b0101)
+		self.assertEqual(AvailabilityIndex.to_mask(BitArray()), 0)
+
+	def test_from_pieces(self):
+		self.assertEqual(AvailabilityIndex.from_pieces([0, 3, 70]), 1 | 1 << 3 | 1 << 70)
+
+	def test_iter_pieces(self):
+		self.assertEqual(list(AvailabilityIndex.iter_pieces(1 | 1 << 3 | 1 << 70)), [0, 3, 70])
+		self.assertEqual(list(AvailabilityIndex.iter_pieces(0)), [])
+
+	def test_lowest_and_nth(self):
+		mask = AvailabilityIndex.from_pieces([2, 5, 9, 100])
+		self.assertEqual(AvailabilityIndex.lowest(mask), 2)
+		self.assertEqual([AvailabilityIndex.nth(mask, n) for n in range(4)], [2, 5, 9, 100])
+
+
+
+class TestAvailabilityIndex(unittest.TestCase):
+	NUM_PIECES = 300
+
+	def setUp(self):
+		self.index = AvailabilityIndex(self.NUM_PIECES)
+		# Plain sets the bit-sliced counts are checked against
+		self.model = dict()
+
+	def check(self):
+		counts = [sum(num in pieces for pieces in self.model.values()) for num in range(self.NUM_PIECES)]
+		self.assertEqual(self.index.counts(), counts)
+		for num in range(0, self.NUM_PIECES, 37):
+			expected = {peer for peer, pieces in self.model.items() if num in pieces}
+			self.assertEqual(set(self.index.peers_with(num)), expected)
+
+	def test_counts_follow_random_changes(self):
+		rng = random.Random(4)
+		for step in range(400):
+			peer = rng.randrange(12)
+			action = rng.random()
+			if action < 0.3:
+				pieces = {num for num in range(self.NUM_PIECES) if rng.random() < 0.4}
+				bits = BitArray(self.NUM_PIECES)
+				for num in pieces: bits.set(True, num)
+				self.index.set_bitfield(peer, bits)
+				self.model[peer] = pieces
+			elif action < 0.6:
+				num = rng.randrange(self.NUM_PIECES)
+				added = self.index.add_piece(peer, num)
+				self.assertEqual(added, num not in self.model.get(peer, set()))
+				self.model.setdefault(peer, set()).add(num)
+			elif action < 0.85:
+				num = rng.randrange(self.NUM_PIECES)
+				self.index.remove_piece(peer, num)
+				self.model.get(peer, set()).discard(num)
+			else:
+				self.index.remove(peer)
+				self.model.pop(peer, None)
+			if step % 20 == 0: self.check()
+		self.check()
+
+	def test_removing_every_peer_empties_the_planes(self):
+		for peer in range(20):
+			self.index.set_mask(peer, (1 << self.NUM_PIECES) - 1)
+		for peer in range(20):
+			self.index.remove(peer)
+		self.assertEqual(self.index.counts(), [0] * self.NUM_PIECES)
+		self.assertEqual(len(self.index), 0)
+		self.assertEqual(self.index._planes, [])
+
+	def test_rarest(self):
+		rng = random.Random(7)
+		for peer in range(9):
+			self.index.set_mask(peer, sum(1 << num for num in range(self.NUM_PIECES) if rng.random() < 0.5))
+		counts = self.index.counts()
+
+		for _ in range(20):
+			mask = sum(1 << num for num in range(self.NUM_PIECES) if rng.random() < 0.2)
+			nums = list(AvailabilityIndex.iter_pieces(mask))
+			lowest = min(counts[num] for num in nums)
+			expected = {num for num in nums if counts[num] == lowest}
+			self.assertEqual(set(AvailabilityIndex.iter_pieces(self.index.rarest(mask))), expected)
+
+	def test_wanted_from(self):
+		self.index.set_mask('peer', AvailabilityIndex.from_pieces([1, 2, 3, 4]))
+		self.index.want([2, 4, 6])
+		self.assertEqual(list(AvailabilityIndex.iter_pieces(self.index.wanted_from('peer'))), [2, 4])
+
+		self.index.have(4)
+		self.assertEqual(list(AvailabilityIndex.iter_pieces(self.index.wanted_from('peer'))), [2])
+		self.assertEqual(self.index.wanted_from('unknown'), 0)
+
+	def test_interest_ranks_peers(self):
+		self.index.want(range(10))
+		self.index.set_mask('few', AvailabilityIndex.from_pieces([1, 20, 30]))
+		self.index.set_mask('many', AvailabilityIndex.from_pieces([1, 2, 3, 4]))
+		self.assertEqual((self.index.interest('few'), self.index.interest('many')), (1, 4))
+		self.assertEqual(sorted(['few', 'many'], key=self.index.interest, reverse=True), ['many', 'few'])
+
+		# Pieces which are done no longer count
+		for num in (1, 2, 3): self.index.have(num)
+		self.assertEqual((self.index.interest('few'), self.index.interest('many')), (0, 1))
+		self.assertEqual(self.index.interest('unknown'), 0)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,109 @@
+import asyncio
+import threading
+import unittest
+
+from aiotorrent.core.disk_writer import DiskWriter
+
+
+class FakeStorage:
+	"""Records every write call, which blocks until the gate is opened"""
+	def __init__(self, error: Exception = None):
+		self.gate = threading.Event()
+		self.calls = list()
+		self.flushes = 0
+		self.error = error
+
+	def writev(self, num, buffers, offset=0):
+		self.gate.wait(5)
+		if self.error is not None: raise self.error
+		self.calls.append((num, [bytes(buffer) for buffer in buffers]))
+
+	def flush(self):
+		self.flushes += 1
+
+
+
+class TestDiskWriter(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.storage = FakeStorage()
+		self.written = list()
+
+	def writer(self, **kwargs):
+		writer = DiskWriter(self.storage, on_written=self.written.append, **kwargs)
+		self.addCleanup(writer.close)
+		self.addCleanup(self.storage.gate.set)
+		return writer
+
+	async def test_consecutive_pieces_are_coalesced(self):
+		writer = self.writer(workers=1)
+		# The first piece takes the only worker, the others queue up behind it
+		for num in (0, 1, 2, 3, 5, 6):
+			await writer.write(num, bytes([num]) * 4)
+		self.storage.gate.set()
+		await writer.flush()
+
+		self.assertEqual([(num, len(buffers)) for num, buffers in self.storage.calls], [(0, 1), (1, 3), (5, 2)])
+		self.assertEqual(self.storage.calls[1][1], [b'\x01' * 4, b'\x02' * 4, b'\x03' * 4])
+		self.assertEqual(sorted(self.written), [0, 1, 2, 3, 5, 6])
+		self.assertEqual((writer.pieces_written, writer.writes, writer.bytes_written), (6, 3, 24))
+		self.assertEqual(self.storage.flushes, 1)
+
+	async def test_runs_are_limited_to_max_run(self):
+		writer = self.writer(workers=1)
+		writer.MAX_RUN = 8
+		for num in range(5):
+			await writer.write(num, bytes(4))
+		self.storage.gate.set()
+		await writer.flush()
+		self.assertEqual([(num, len(buffers)) for num, buffers in self.storage.calls], [(0, 1), (1, 2), (3, 2)])
+
+	async def test_write_waits_while_the_cache_is_full(self):
+		writer = self.writer(workers=1, cache_size=20)
+		await writer.write(0, bytes(10))
+		await writer.write(1, bytes(10))
+		self.assertTrue(writer.full)
+
+		blocked = asyncio.create_task(writer.write(2, bytes(10)))
+		room = asyncio.create_task(writer.wait_for_room())
+		await asyncio.sleep(0.05)
+		self.assertFalse(blocked.done() or room.done())
+
+		self.storage.gate.set()
+		await asyncio.wait_for(asyncio.gather(blocked, room), 5)
+		await writer.flush()
+		self.assertEqual(sorted(self.written), [0, 1, 2])
+		self.assertEqual(writer.cached, 0)
+
+	async def test_piece_larger_than_the_cache(self):
+		writer = self.writer(cache_size=4)
+		self.storage.gate.set()
+		await asyncio.wait_for(writer.write(0, bytes(10)), 5)
+		await writer.flush()
+		self.assertEqual(self.written, [0])
+
+	async def test_errors_are_raised_by_flush(self):
+		self.storage.error = OSError("No space left on device")
+		writer = self.writer()
+		await writer.write(0, bytes(4))
+		self.storage.gate.set()
+		with self.assertRaises(OSError):
+			await writer.flush()
+
+		# Pieces which failed are not reported as written, and the error is raised once
+		self.assertEqual(self.written, [])
+		self.assertEqual(writer.cached, 0)
+		await writer.flush()
+
+	async def test_errors_are_raised_by_the_next_write(self):
+		self.storage.error = OSError("Input/output error")
+		writer = self.writer(workers=1)
+		self.storage.gate.set()
+		await writer.write(0, bytes(4))
+		# Runs after the failed write on the only worker thread
+		await writer.run(lambda: None)
+		with self.assertRaises(OSError):
+			await writer.write(1, bytes(4))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,33 @@
+import unittest
+
+from aiotorrent.core.rate_limiter import TokenBucket, RateLimits
+
+
+class TestTokenBucket(unittest.TestCase):
+	def test_debt_is_paid_back_at_the_rate(self):
+		bucket = TokenBucket(1000, burst=0)
+		self.assertAlmostEqual(bucket.consume(500), 0.5, places=2)
+
+	def test_slowest_bucket_in_the_chain(self):
+		parent = TokenBucket(100, burst=0)
+		bucket = TokenBucket(1000, burst=0, parent=parent)
+		self.assertAlmostEqual(bucket.consume(100), 1, places=2)
+		self.assertEqual(TokenBucket(parent=None).consume(10 ** 9), 0)
+
+	def test_rate_must_be_positive(self):
+		for rate in (0, -1):
+			with self.subTest(rate=rate):
+				with self.assertRaises(ValueError):
+					TokenBucket(rate)
+				with self.assertRaises(ValueError):
+					TokenBucket().set_rate(rate)
+
+	def test_invalid_limits_change_nothing(self):
+		limits = RateLimits(download=1000)
+		with self.assertRaises(ValueError):
+			limits.set(download=2000, peer_upload=0)
+		self.assertEqual((limits.download.rate, limits.peer_upload), (1000, None))
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+from struct import pack
+
+from aiotorrent.core.response_parser import PeerResponseParser, HANDSHAKE_LEN
+
+
+def message(message_id: int, payload: bytes = b'') -> bytes:
+	return pack('>IB', 1 + len(payload), message_id) + payload
+
+
+def piece(index: int, offset: int, data: bytes) -> bytes:
+	return message(7, pack('>II', index, offset) + data)
+
+
+
+class TestPeerResponseParser(unittest.TestCase):
+	def test_messages_in_wire_order(self):
+		data = piece(0, 0, b'abcd') + message(0) + message(1) + message(4, pack('>I', 3)) + pack('>I', 0)
+		messages = PeerResponseParser(data).parse()
+
+		self.assertEqual([name for name, _ in messages], ['piece', 'choke', 'unchoke', 'have', 'keep_alive'])
+		self.assertEqual(messages[3], ('have', 3))
+
+	def test_piece(self):
+		(name, (index, offset, block)), = PeerResponseParser(piece(2, 16384, b'data')).parse()
+		self.assertEqual((name, index, offset, bytes(block)), ('piece', 2, 16384, b'data'))
+
+	def test_block_is_a_view(self):
+		data = bytearray(piece(0, 0, b'data'))
+		(_, (_, _, block)), = PeerResponseParser(data).parse()
+		self.assertIsInstance(block, memoryview)
+		self.assertTrue(block.obj is data)
+
+	def test_messages_split_across_feeds(self):
+		data = piece(0, 0, bytes(range(256)) * 4) + message(4, pack('>I', 1)) + piece(1, 0, b'tail')
+		parser = PeerResponseParser()
+		messages = list()
+		# Feed one byte at a time, messages come out as soon as they are complete
+		for position in range(len(data)):
+			parser.feed(data[position:position + 1])
+			messages += parser.parse()
+
+		self.assertEqual([name for name, _ in messages], ['piece', 'have', 'piece'])
+		self.assertEqual(bytes(messages[0][1][2]), bytes(range(256)) * 4)
+		self.assertEqual(bytes(messages[2][1][2]), b'tail')
+		self.assertEqual(parser.pending(), 0)
+
+	def test_incomplete_message_is_kept(self):
+		data = piece(5, 0, b'abcdef')
+		parser = PeerResponseParser(data[:7])
+		self.assertEqual(parser.parse(), [])
+		self.assertEqual(parser.pending(), 7)
+
+		parser.feed(data[7:])
+		(name, (index, _, block)), = parser.parse()
+		self.assertEqual((name, index, bytes(block)), ('piece', 5, b'abcdef'))
+
+	def test_blocks_survive_later_feeds(self):
+		# A block handed out earlier keeps its data while the parser buffers more
+		data = piece(0, 0, b'first') + piece(1, 0, b'second')
+		parser = PeerResponseParser(bytearray(data[:len(data) - 3]))
+		(_, (_, _, first)), = parser.parse()
+		parser.feed(bytearray(data[len(data) - 3:]))
+		(_, (_, _, second)), = parser.parse()
+		self.assertEqual((bytes(first), bytes(second)), (b'first', b'second'))
+
+	def test_handshake(self):
+		handshake = pack('>B19sQ20s20s', 19, b'BitTorrent protocol', 0, b'i' * 20, b'p' * 20)
+		self.assertEqual(len(handshake), HANDSHAKE_LEN)
+		messages = PeerResponseParser(handshake + message(14)).parse()
+		self.assertEqual(messages, [('handshake', handshake), ('have_all', True)])
+
+	def test_fast_extension(self):
+		data = message(16, pack('>III', 1, 16384, 16384)) + message(17, pack('>I', 7)) + message(13, pack('>I', 2)) + message(15)
+		self.assertEqual(PeerResponseParser(data).parse(), [
+			('reject', (1, 16384, 16384)), ('allowed_fast', 7), ('suggest', 2), ('have_none', True),
+		])
+
+	def test_bitfield_and_requests(self):
+		data = message(5, b'\xff\x80') + message(6, pack('>III', 0, 0, 16384)) + message(8, pack('>III', 0, 0, 16384))
+		self.assertEqual(PeerResponseParser(data).parse(), [
+			('bitfield', b'\xff\x80'), ('request', (0, 0, 16384)), ('cancel', (0, 0, 16384)),
+		])
+
+	def test_extended(self):
+		(name, (extended_id, payload)), = PeerResponseParser(message(20, b'\x00d1:md')).parse()
+		self.assertEqual((name, extended_id, bytes(payload)), ('extended', 0, b'd1:md'))
+
+	def test_unknown_and_malformed_messages_are_skipped(self):
+		# An unknown id and a have without its index, followed by a valid message
+		data = message(99, b'xyz') + message(4) + message(1)
+		self.assertEqual(PeerResponseParser(data).parse(), [('unchoke', True)])
+
+	def test_parse_returns_new_messages_only(self):
+		parser = PeerResponseParser(message(0))
+		self.assertEqual(parser.parse(), [('choke', True)])
+		self.assertEqual(parser.parse(), [])
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+
+from aiotorrent.core.file_utils import FileTree
+from aiotorrent.core.resume import ResumeData
+
+
+class TestResumeData(unittest.TestCase):
+	def setUp(self):
+		# The files of a torrent are stored below its name in the working directory
+		directory = tempfile.TemporaryDirectory()
+		self.addCleanup(directory.cleanup)
+		self.addCleanup(os.chdir, os.getcwd())
+		os.chdir(directory.name)
+
+		self.info = {
+			'name': 'torrent', 'info_hash': b'i' * 20, 'piece_len': 16, 'size': 40,
+			'piece_hashmap': {num: b'h' * 20 for num in range(3)},
+			'files': [{'path': ['a.bin'], 'length': 24}, {'path': ['b.bin'], 'length': 16}],
+		}
+		self.files = FileTree(self.info)
+		os.mkdir('torrent')
+		for file in self.files:
+			with open(os.path.join('torrent', file.path), 'wb') as f: f.write(bytes(file.size))
+
+	def saved(self, *pieces):
+		resume = ResumeData(self.info, self.files)
+		for num in pieces: resume.add(num)
+		resume.save()
+		return resume
+
+	def loaded(self):
+		resume = ResumeData(self.info, self.files)
+		return resume.load(), [num for num in range(3) if resume.have(num)]
+
+	def test_round_trip(self):
+		self.saved(0, 2)
+		self.assertEqual(self.loaded(), (True, [0, 2]))
+
+	def test_missing_file(self):
+		self.assertEqual(self.loaded(), (False, []))
+
+	def test_other_torrent_is_ignored(self):
+		self.saved(0)
+		self.info['info_hash'] = b'j' * 20
+		self.assertEqual(self.loaded(), (False, []))
+
+	def test_malformed_file_is_ignored(self):
+		with open(os.path.join('torrent', ResumeData.FILENAME), 'wb') as f: f.write(b'not bencoded')
+		self.assertEqual(self.loaded(), (False, []))
+
+	def test_size_change_invalidates_the_file(self):
+		self.saved(0, 1, 2)
+		stat = os.stat('torrent/a.bin')
+		for size in (23, 25):
+			with self.subTest(size=size):
+				os.truncate('torrent/a.bin', size)
+				os.utime('torrent/a.bin', ns=(stat.st_atime_ns, stat.st_mtime_ns))
+				# Piece 1 is shared by both files, piece 2 only belongs to b.bin
+				self.assertEqual(self.loaded(), (True, [2]))
+
+	def test_mtime_change_invalidates_the_file(self):
+		self.saved(0, 1, 2)
+		stat = os.stat('torrent/b.bin')
+		for mtime in (stat.st_mtime_ns - 10 ** 9, stat.st_mtime_ns + 10 ** 9):
+			with self.subTest(mtime=mtime):
+				os.utime('torrent/b.bin', ns=(stat.st_atime_ns, mtime))
+				self.assertEqual(self.loaded(), (True, [0]))
+
+	def test_deleted_file_invalidates_the_file(self):
+		self.saved(0, 1, 2)
+		os.remove('torrent/b.bin')
+		self.assertEqual(self.loaded(), (True, [0]))
+
+	def test_snapshot_leaves_later_pieces_for_the_next_save(self):
+		resume = ResumeData(self.info, self.files)
+		resume.add(0)
+		pieces = resume.snapshot()
+		resume.add(1)
+		resume.save(pieces)
+		self.assertEqual(self.loaded(), (True, [0]))
+		self.assertTrue(resume._dirty)
+
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,133 @@
+import os
+import time
+import tempfile
+import unittest
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+
+from aiotorrent.core.file_utils import FileTree, safe_path
+from aiotorrent.core.storage import Storage
+
+
+def torrent_info(*files, piece_len=16, name='torrent'):
+	return {
+		'name': name, 'piece_len': piece_len, 'size': sum(length for _, length in files),
+		'files': [{'path': path, 'length': length} for path, length in files],
+	}
+
+
+
+class TestPaths(unittest.TestCase):
+	def test_safe_path(self):
+		self.assertEqual(safe_path(['dir', 'file.bin']), os.path.join('dir', 'file.bin'))
+		self.assertEqual(safe_path('file.bin'), 'file.bin')
+
+	def test_traversal_is_rejected(self):
+		with self.assertRaises(ValueError):
+			FileTree(torrent_info((['..', '..', 'etc', 'x'], 1)))
+
+	def test_absolute_path_is_rejected(self):
+		with self.assertRaises(ValueError):
+			FileTree(torrent_info((['/tmp/abs'], 1)))
+
+	def test_unsafe_components_are_rejected(self):
+		for path in ([], [''], ['.'], ['dir', '..'], ['a/../..'], ['a\\b'], ['C:'], ['c:file']):
+			with self.subTest(path=path), self.assertRaises(ValueError):
+				safe_path(path)
+
+	def test_unsafe_name_is_rejected(self):
+		info = torrent_info((['file.bin'], 1), name='..')
+		with self.assertRaises(ValueError):
+			Storage(info, FileTree(info))
+
+	def test_symlink_out_of_the_directory_is_rejected(self):
+		info = torrent_info((['link', 'file.bin'], 1))
+		with tempfile.TemporaryDirectory() as directory, tempfile.TemporaryDirectory() as outside:
+			os.symlink(outside, os.path.join(directory, 'link'))
+			storage = Storage(info, FileTree(info), directory)
+			with self.assertRaises(ValueError):
+				storage.write(0, b'x')
+			self.assertEqual(os.listdir(outside), [])
+
+
+
+class TestSegments(unittest.TestCase):
+	def segments(self, info, *args):
+		storage = Storage(info, FileTree(info), 'unused')
+		return [(file.name, offset, length) for file, offset, length in storage.segments(*args)]
+
+	def test_piece_within_a_file(self):
+		info = torrent_info((['a'], 40), (['b'], 8))
+		self.assertEqual(self.segments(info, 1), [('a', 16, 16)])
+		self.assertEqual(self.segments(info, 1, 4, 8), [('a', 20, 8)])
+
+	def test_piece_spanning_files(self):
+		info = torrent_info((['a'], 20), (['b'], 5), (['c'], 15))
+		# Piece 1 holds bytes 16-31: the end of a, all of b and the start of c
+		self.assertEqual(self.segments(info, 1), [('a', 16, 4), ('b', 0, 5), ('c', 0, 7)])
+		self.assertEqual(self.segments(info, 1, 6), [('b', 2, 3), ('c', 0, 7)])
+
+	def test_files_ending_on_piece_boundaries(self):
+		info = torrent_info((['a'], 16), (['b'], 16))
+		self.assertEqual(self.segments(info, 0), [('a', 0, 16)])
+		self.assertEqual(self.segments(info, 1), [('b', 0, 16)])
+
+	def test_last_piece_is_shorter(self):
+		info = torrent_info((['a'], 20), (['b'], 3))
+		self.assertEqual(self.segments(info, 1), [('a', 16, 4), ('b', 0, 3)])
+
+	def test_zero_length_files_are_skipped(self):
+		info = torrent_info((['empty0'], 0), (['a'], 20), (['empty1'], 0), (['empty2'], 0), (['b'], 12), (['empty3'], 0))
+		self.assertEqual(self.segments(info, 0), [('a', 0, 16)])
+		self.assertEqual(self.segments(info, 1), [('a', 16, 4), ('b', 0, 12)])
+
+	def test_writes_across_files(self):
+		info = torrent_info((['a'], 20), (['empty'], 0), (['dir', 'b'], 5), (['c'], 15))
+		data = os.urandom(info['size'])
+		with tempfile.TemporaryDirectory() as directory:
+			storage = Storage(info, FileTree(info), directory)
+			for file in storage.files: storage.open(file)
+			storage.writev(0, [data[:10], data[10:32]])
+			storage.write(2, data[32:])
+
+			buffer = bytearray(info['size'])
+			self.assertEqual(storage.readinto(0, buffer), info['size'])
+			storage.close()
+			self.assertEqual(bytes(buffer), data)
+			sizes = [os.path.getsize(os.path.join(directory, file.path)) for file in storage.files]
+			self.assertEqual(sizes, [20, 0, 5, 15])
+
+
+
+class TestFallbackIO(unittest.TestCase):
+	def test_threads_without_positional_io(self):
+		# Without pwritev and preadv every write and read seeks first, which
+		# threads sharing a descriptor must not interleave
+		info = torrent_info((['a.bin'], 4096 * 64), (['b.bin'], 4096 * 64), piece_len=4096)
+		data = os.urandom(info['size'])
+		lseek = os.lseek
+
+		def slow_lseek(*args):
+			# Gives the other threads a chance to run between the seek and the I/O
+			position = lseek(*args)
+			time.sleep(0.0001)
+			return position
+
+		with tempfile.TemporaryDirectory() as directory, mock.patch.multiple(os, create=True, pwritev=mock.DEFAULT, preadv=mock.DEFAULT), \
+				mock.patch.object(os, 'lseek', slow_lseek):
+			del os.pwritev, os.preadv
+			storage = Storage(info, FileTree(info), directory)
+			pieces = range(info['size'] // 4096)
+			with ThreadPoolExecutor(8) as executor:
+				list(executor.map(lambda num: storage.write(num, data[num * 4096:(num + 1) * 4096]), pieces))
+
+				def read(num):
+					buffer = bytearray(4096)
+					storage.readinto(num, buffer)
+					return bytes(buffer)
+				self.assertEqual(b''.join(executor.map(read, pieces)), data)
+			storage.close()
+
+
+if __name__ == '__main__':
+	unittest.main()
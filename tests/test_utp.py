@@ -0,0 +1,126 @@
+import os
+import random
+import asyncio
+import unittest
+
+from aiotorrent.core.utp import UTPConnection, create_utp_endpoint, open_utp_connection, seq_before
+
+
+class Sender(asyncio.Protocol):
+	"""Writes `data` as soon as it is connected and closes the connection"""
+	def __init__(self, data):
+		self.data = data
+
+	def connection_made(self, transport):
+		transport.write(self.data)
+		transport.close()
+
+
+class Receiver(asyncio.Protocol):
+	"""Collects everything received until the other side closes the connection"""
+	def __init__(self):
+		self.received = bytearray()
+		self.done = asyncio.get_running_loop().create_future()
+
+	def data_received(self, data):
+		self.received += data
+
+	def eof_received(self):
+		if not self.done.done(): self.done.set_result(bytes(self.received))
+
+	def connection_lost(self, exc):
+		if not self.done.done(): self.done.set_exception(exc or EOFError("Connection lost before EOF"))
+
+
+
+class TestSequenceNumbers(unittest.TestCase):
+	def test_order(self):
+		self.assertTrue(seq_before(1, 2))
+		self.assertFalse(seq_before(2, 1))
+		self.assertFalse(seq_before(5, 5))
+
+	def test_wrap_around(self):
+		self.assertTrue(seq_before(0xffff, 0))
+		self.assertTrue(seq_before(0xfff0, 0x0010))
+		self.assertFalse(seq_before(0x0010, 0xfff0))
+
+
+
+class TestLoopbackTransfer(unittest.IsolatedAsyncioTestCase):
+	async def transfer(self, data, sendto=None):
+		endpoint = await create_utp_endpoint('127.0.0.1', 0, lambda: Sender(data))
+		if sendto is not None: endpoint.sendto = sendto(endpoint.sendto)
+		try:
+			_, receiver = await open_utp_connection(Receiver, *endpoint.address)
+			return await asyncio.wait_for(receiver.done, 30)
+		finally:
+			endpoint.close()
+
+	async def test_transfer(self):
+		data = os.urandom(2 * 2 ** 20)
+		self.assertEqual(await self.transfer(data), data)
+
+	async def test_small_transfer(self):
+		self.assertEqual(await self.transfer(b'x'), b'x')
+
+	async def test_loss_and_reordering(self):
+		# Packets of the sending side are dropped or delayed, the receiver still gets everything in order
+		data = os.urandom(256 * 1024)
+		rng = random.Random(1)
+
+		def lossy(sendto):
+			def send(packet, address):
+				roll = rng.random()
+				if roll < 0.03: return
+				if roll < 0.06:
+					asyncio.get_running_loop().call_later(0.005, sendto, packet, address)
+					return
+				sendto(packet, address)
+			return send
+
+		self.assertEqual(await self.transfer(data, lossy), data)
+
+	async def test_connection_refused_without_factory(self):
+		# Endpoints without a protocol factory do not accept connections
+		endpoint = await create_utp_endpoint('127.0.0.1', 0)
+		UTPConnection.CONNECT_TIMEOUT, timeout = 0.05, UTPConnection.CONNECT_TIMEOUT
+		try:
+			with self.assertRaises(OSError):
+				await asyncio.wait_for(open_utp_connection(Receiver, *endpoint.address), 10)
+		finally:
+			UTPConnection.CONNECT_TIMEOUT = timeout
+			endpoint.close()
+
+
+
+class TestLedbat(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		self.endpoint = await create_utp_endpoint('127.0.0.1', 0)
+		self.connection = UTPConnection(self.endpoint, ('127.0.0.1', 1), 1, 2, asyncio.Protocol())
+		# Past slow start, the window follows the queuing delay
+		self.connection._ssthresh = self.connection.cwnd
+
+	async def asyncTearDown(self):
+		self.connection._destroy()
+		self.endpoint.close()
+
+	async def test_window_grows_below_target(self):
+		cwnd = self.connection.cwnd
+		for _ in range(10):
+			self.connection._congestion_control(UTPConnection.PACKET_SIZE, 1000)
+		self.assertGreater(self.connection.cwnd, cwnd)
+
+	async def test_window_shrinks_above_target(self):
+		connection = self.connection
+		# The lowest delay seen is the base delay, anything above it is queuing
+		connection._congestion_control(UTPConnection.PACKET_SIZE, 1000)
+		cwnd = connection.cwnd
+		queuing = int(connection.TARGET_DELAY * 3 * 1_000_000)
+		for _ in range(10):
+			connection._congestion_control(UTPConnection.PACKET_SIZE, 1000 + queuing)
+		self.assertLess(connection.cwnd, cwnd)
+		self.assertGreaterEqual(connection.cwnd, connection.MIN_WINDOW)
+
+
+if __name__ == '__main__':
+	unittest.main()